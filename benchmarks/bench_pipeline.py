@@ -0,0 +1,393 @@
+"""Measure the message pipeline end to end, in process.
+
+Synthetic telegram Updates are fed to the Application built by
+``main.build_application()``, so they take the same route as in production:
+handler matching, the per-user dispatcher, the handlers in ``main.py`` and
+the services behind them. Replies go through the real bot to a fake Bot API
+transport and the LLM is a local stub server, both with configurable
+latency, so the numbers show what the bot itself costs.
+
+Virtual users each send their next update once the previous one has been
+answered; every --command-every-th update is one of the commands. Provider
+and per-user rate limits are lifted so they do not dominate the results.
+
+Reported per stage (count, mean, p50, p95, p99 in ms) and overall:
+
+- handler.<name>: a whole handler call, one per command and messages
+- analyze, learning.*, personality.*, history, memory.*: service calls
+- llm, llm.first_chunk: the provider call through the router and cache
+- telegram.<method>: Bot API calls, answered by the fake transport
+- throughput: handled updates per second
+
+With --baseline the p95 (or --metric) of every stage and the throughput are
+compared with an earlier --output file; the run fails if any is worse by
+more than --tolerance and by at least --min-delta.
+
+Usage: python benchmarks/bench_pipeline.py [--users N] [--updates N]
+       [--llm-latency MS] [--output results.json] [--baseline results.json]
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from common import (WORDS, add_baseline_arguments, check_regressions, compare, load_json, make_text,
+                    report, save_json, summarize)
+from aiohttp import web
+from telegram import Chat, MessageEntity, Update
+from telegram.request import BaseRequest, RequestData
+
+COMMANDS = ["start", "help", "personality", "mood", "remember", "forget", "stats", "sync", "clear"]
+HANDLERS = ["start_command", "help_command", "clear_command", "personality_command", "mood_command",
+            "remember_command", "forget_command", "stats_command", "sync_command", "handle_message"]
+
+
+class Recorder:
+    """Latency samples per stage, collected by wrapping the callables that implement it."""
+
+    def __init__(self):
+        self.samples = {}
+        self.enabled = False
+
+    def add(self, stage: str, elapsed: float):
+        if self.enabled:
+            self.samples.setdefault(stage, []).append(elapsed)
+
+    def timed(self, stage: str, fn):
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def stream(*args, **kwargs):
+                started = time.perf_counter()
+                first = True
+                async for chunk in fn(*args, **kwargs):
+                    if first:
+                        self.add(stage + ".first_chunk", time.perf_counter() - started)
+                        first = False
+                    yield chunk
+                self.add(stage, time.perf_counter() - started)
+            return stream
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def call(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+            return call
+
+        @functools.wraps(fn)
+        def call_sync(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return call_sync
+
+    def wrap(self, owner, name: str, stage: str):
+        setattr(owner, name, self.timed(stage, getattr(owner, name)))
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API transport that answers locally after a delay, instead of calling telegram."""
+
+    def __init__(self, recorder: Recorder, latency: float):
+        self.recorder = recorder
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def _message(self, parameters: dict) -> dict:
+        message_id = parameters.get("message_id") or next(self.message_ids)
+        return {"message_id": message_id, "date": int(time.time()), "text": parameters.get("text", ""),
+                "chat": {"id": parameters.get("chat_id"), "type": Chat.PRIVATE}}
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         *args, **kwargs) -> Tuple[int, bytes]:
+        started = time.perf_counter()
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(parameters)
+        else:
+            result = True
+        if endpoint != "getMe":
+            self.calls += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.recorder.add("telegram." + endpoint, time.perf_counter() - started)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(bot, update_id: int, user_id: int, text: str) -> Update:
+    """A private-chat text message from user_id, as telegram would deliver it."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": Chat.PRIVATE, "first_name": f"User{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": MessageEntity.BOT_COMMAND, "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def make_command(rng: random.Random, index: int) -> str:
+    command = COMMANDS[index % len(COMMANDS)]
+    if command in ("remember", "forget"):
+        return f"/{command} {rng.choice(WORDS)} {rng.choice(WORDS)}"
+    return f"/{command}"
+
+
+class StubLLM:
+    """Local Gemini-compatible endpoint answering after a configurable delay."""
+
+    def __init__(self, latency: float, jitter: float, words: int, chunks: int, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.words = words
+        self.chunks = max(1, chunks)
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.runner = None
+
+    def _text(self) -> str:
+        return " ".join(self.rng.choices(WORDS, k=self.words)).capitalize() + "."
+
+    async def _delay(self, share: float = 1.0):
+        delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)) * share
+        if delay:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _body(text: str) -> dict:
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+    async def generate(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await request.read()
+        await self._delay()
+        return web.json_response(self._body(self._text()))
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        await request.read()
+        words = self._text().split(" ")
+        size = max(1, -(-len(words) // self.chunks))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # Time to first token is about half the latency, the rest is spread over the chunks
+        await self._delay(0.5)
+        for index in range(0, len(words), size):
+            text = " ".join(words[index:index + size]) + (" " if index + size < len(words) else "")
+            await response.write(b"data: " + json.dumps(self._body(text)).encode() + b"\r\n\r\n")
+            await self._delay(0.5 / self.chunks)
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/generate", self.generate)
+        app.router.add_post("/stream", self.stream)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.SockSite(self.runner, self.socket).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+def configure(args, database_path: str, port: int):
+    """Point the configuration at the stub and the scratch database before main is imported."""
+    os.environ["DATABASE_PATH"] = database_path
+    os.environ["GOOGLE_API_URL"] = f"http://127.0.0.1:{port}/generate"
+    os.environ["GOOGLE_STREAM_URL"] = f"http://127.0.0.1:{port}/stream"
+    os.environ.pop("OPENROUTER_API_KEY", None)
+
+    from config import config
+    config.STREAMING_SETTINGS["enabled"] = args.stream
+    config.NLP_EXECUTOR_SETTINGS["kind"] = args.nlp
+    config.RESPONSE_CACHE_SETTINGS["enabled"] = args.cache
+    # Keep the metrics endpoint, and its overhead, but on a free port
+    config.METRICS_SETTINGS["port"] = 0
+    unlimited = {"rate": 1e9, "burst": 1e9}
+    config.RATE_LIMIT_SETTINGS["providers"] = {"google": unlimited}
+    config.RATE_LIMIT_SETTINGS["user_rate"] = unlimited["rate"]
+    config.RATE_LIMIT_SETTINGS["user_burst"] = unlimited["burst"]
+
+
+def instrument(main, recorder: Recorder):
+    """Time the handlers and the services they call."""
+    # Handlers are looked up when the application is built, so wrap them first
+    for name in HANDLERS:
+        recorder.wrap(main, name, "handler." + name)
+    recorder.wrap(main, "process_message", "llm")
+    recorder.wrap(main, "process_message_stream", "llm")
+
+    recorder.wrap(main.nlp_executor, "analyze", "analyze")
+    recorder.wrap(main.learning_service, "load_user", "learning.load")
+    recorder.wrap(main.learning_service, "process_message", "learning.process")
+    recorder.wrap(main.learning_service, "adapt_response", "learning.adapt")
+    recorder.wrap(main.personality_service, "load_user", "personality.load")
+    recorder.wrap(main.personality_service, "adapt_to_user", "personality.adapt")
+    recorder.wrap(main.personality_service, "modulate_response", "personality.modulate")
+    recorder.wrap(main.history_store, "get", "history")
+    recorder.wrap(main.memory_service, "store_interaction", "memory.store")
+    recorder.wrap(main.memory_service, "flush", "memory.flush")
+
+
+async def drive(main, application, args, recorder: Recorder) -> dict:
+    """Run the virtual users and return the measured wall time and update count."""
+    update_ids = itertools.count(1)
+
+    async def answered(user_id: int):
+        # Handlers run on the user's dispatcher worker, so wait for it to go idle
+        worker = main.dispatcher._workers.get(user_id)
+        if worker is not None:
+            await worker
+
+    async def user(index: int, count: int):
+        rng = random.Random(args.seed * 100003 + index)
+        user_id = 10000 + index
+        for sent in range(count):
+            if args.command_every and sent % args.command_every == args.command_every - 1:
+                text = make_command(rng, sent // args.command_every + index)
+            else:
+                text = make_text(rng, args.min_words, args.max_words)
+            await application.process_update(make_update(application.bot, next(update_ids), user_id, text))
+            await answered(user_id)
+
+    # Warm up caches, connections and worker processes without recording
+    await asyncio.gather(*(user(index, args.warmup) for index in range(args.users)))
+    await main.memory_service.flush()
+
+    recorder.enabled = True
+    started = time.perf_counter()
+    await asyncio.gather(*(user(index, args.updates) for index in range(args.users)))
+    await main.memory_service.flush()
+    elapsed = time.perf_counter() - started
+    recorder.enabled = False
+    return {"elapsed": elapsed, "updates": args.users * args.updates}
+
+
+async def run(args) -> dict:
+    stub = StubLLM(args.llm_latency / 1000, args.llm_jitter / 1000, args.response_words, args.chunks, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(args, os.path.join(tmp, "bench_memory.db"), stub.port)
+        import main
+        main.build_services()
+
+        recorder = Recorder()
+        instrument(main, recorder)
+        telegram = FakeTelegram(recorder, args.telegram_latency / 1000)
+        application = main.build_application(telegram)
+
+        await stub.start()
+        try:
+            # Only run_polling calls the lifecycle hooks, so call them here
+            await application.initialize()
+            await main.post_init(application)
+            try:
+                totals = await drive(main, application, args, recorder)
+            finally:
+                await main.post_shutdown(application)
+                await application.shutdown()
+        finally:
+            await stub.stop()
+
+    return {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "baseline", "metric", "tolerance", "min_delta")},
+        "throughput": totals["updates"] / totals["elapsed"],
+        "elapsed": totals["elapsed"],
+        "updates": totals["updates"],
+        "llm_requests": stub.requests,
+        "telegram_calls": telegram.calls,
+        "stages": {stage: summarize(samples) for stage, samples in sorted(recorder.samples.items())},
+        "services": {
+            "dispatcher": main.dispatcher.metrics(),
+            "router": main.provider_router.metrics(),
+            "cache": main.response_cache.metrics(),
+            "prompt": main.prompt_builder.metrics(),
+            "history": main.history_store.metrics(),
+        },
+    }
+
+
+def report_run(results: dict):
+    report(results["stages"])
+    print(f"\n{results['updates']} updates in {results['elapsed']:.2f}s: "
+          f"{results['throughput']:.1f} updates/s, {results['llm_requests']} LLM requests, "
+          f"{results['telegram_calls']} telegram calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users (default: 20)")
+    parser.add_argument("--updates", type=int, default=25, help="measured updates per user (default: 25)")
+    parser.add_argument("--warmup", type=int, default=3, help="unmeasured updates per user first (default: 3)")
+    parser.add_argument("--command-every", type=int, default=5,
+                        help="every Nth update is a command, 0 for none (default: 5)")
+    parser.add_argument("--min-words", type=int, default=3, help="shortest message in words (default: 3)")
+    parser.add_argument("--max-words", type=int, default=40, help="longest message in words (default: 40)")
+    parser.add_argument("--llm-latency", type=float, default=50.0, help="stub LLM latency in ms (default: 50)")
+    parser.add_argument("--llm-jitter", type=float, default=10.0, help="+/- jitter of that latency in ms (default: 10)")
+    parser.add_argument("--response-words", type=int, default=60, help="words per stub response (default: 60)")
+    parser.add_argument("--chunks", type=int, default=5, help="chunks per streamed response (default: 5)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="fake bot latency per call in ms (default: 0)")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="stream responses by editing the reply (default: on)")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="use the response cache (default: on)")
+    parser.add_argument("--nlp", choices=["process", "thread", "inline"], default="process",
+                        help="NLP executor kind (default: process)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the workload (default: 1)")
+    add_baseline_arguments(parser, metric="p95", tolerance=0.25, min_delta=1.0)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report_run(results)
+
+    if args.output:
+        save_json(args.output, results)
+
+    if args.baseline:
+        baseline = load_json(args.baseline)
+        regressions = compare(results["stages"], baseline.get("stages", {}),
+                              args.metric, args.tolerance, args.min_delta / 1000)
+        if "throughput" in baseline and results["throughput"] < baseline["throughput"] * (1 - args.tolerance):
+            regressions.append(f"throughput: {baseline['throughput']:.1f} -> "
+                               f"{results['throughput']:.1f} updates/s")
+        check_regressions(regressions, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Microbenchmarks of the services' hot functions.
+
+CPU-bound functions run over a corpus of short, medium and long messages
+(see common.MESSAGE_LENGTHS). Calls are timed in batches sized so that one
+sample takes about --sample-time, and each sample is reported per call:
+
+- analyzer.analyze, the tokenizing and scoring shared by the services
+- patterns.update, a message's bigrams folded into a full Space-Saving sketch
+- learning.process_message, learning.adapt_response
+- personality.adapt_to_user, personality.modulate_response
+
+MemoryService queries are awaited one at a time against a database of each
+--db-rows size. The interaction history has that many rows, spread over
+one user per 200 interactions, with a tenth as many memories and cached
+responses. Populating 10M rows takes a while, so --db-dir keeps the
+databases for later runs.
+
+Results are named <function>[<variant>], e.g. learning.process_message[long]
+or memory.search_relevant[100000]. With --baseline the median (or --metric)
+of every result is compared with an earlier --output file. The run fails if
+any result is slower by more than --tolerance and by at least --min-delta.
+
+Usage: python benchmarks/bench_services.py [--db-rows 1000,100000,10000000]
+       [--only NAME] [--output results.json] [--baseline results.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+from common import (MESSAGE_LENGTHS, add_baseline_arguments, check_regressions, compare, load_json,
+                    make_corpus, report, save_json, summarize)
+from config.config import DATABASE_SETTINGS, LEARNING_SETTINGS, NLTK_DATA_DIR, PERSONALITY_SETTINGS
+from services.heavy_hitters import SpaceSaving
+from services.learning_service import LearningService
+from services.memory_service import MemoryService
+from services.message_analysis import MessageAnalyzer
+from services.personality_service import PersonalityService
+
+INTERACTIONS_PER_USER = 200
+BATCH_ROWS = 10000
+# Distinct texts the populated rows are drawn from
+TEXT_POOL = 5000
+# Buffered interactions written by each timed flush
+FLUSH_ROWS = 64
+
+BENCH_USER = 1
+
+
+def time_calls(fn: Callable, inputs: list, sample_time: float, samples: int) -> List[float]:
+    """Per-call time of fn over inputs, in samples batches of about sample_time each."""
+    def batch(number: int) -> float:
+        items = list(itertools.islice(itertools.cycle(inputs), number))
+        started = time.perf_counter()
+        for item in items:
+            fn(item)
+        return time.perf_counter() - started
+
+    number = 1
+    while batch(number) < sample_time:
+        number *= 2
+    return [batch(number) / number for _ in range(samples)]
+
+
+def bench_cpu(args, wanted: Callable[[str], bool]) -> Dict[str, dict]:
+    rng = random.Random(args.seed)
+    analyzer = MessageAnalyzer(LEARNING_SETTINGS, NLTK_DATA_DIR)
+    analyzer.warm_up()
+    learning = LearningService(None, LEARNING_SETTINGS, analyzer)
+    personality = PersonalityService(analyzer, None, PERSONALITY_SETTINGS)
+
+    # A user whose preferences make adapt_response rewrite and shorten
+    adapting_user = BENCH_USER + 1
+    learning._initialize_user(adapting_user)
+    learning.user_data[adapting_user]["preferences"].update(formality=0.9, technicality=0.9, verbosity=0.1)
+
+    results = {}
+    for length in args.lengths:
+        messages = make_corpus(rng, length, args.corpus)
+        responses = make_corpus(rng, length, args.corpus)
+        analyses = [analyzer.analyze(message) for message in messages]
+        # A long-lived user's sketch is full, so new bigrams evict the minimum
+        patterns = SpaceSaving(learning.pattern_capacity)
+        for analysis in analyses:
+            patterns.update(analysis.bigrams)
+
+        cases = {
+            "analyzer.analyze": (analyzer.analyze, messages),
+            "learning.process_message": (lambda a: learning.process_message(BENCH_USER, a.text, a), analyses),
+            "patterns.update": (lambda a: patterns.update(a.bigrams), analyses),
+            "learning.adapt_response": (lambda r: learning.adapt_response(adapting_user, r), responses),
+            "personality.adapt_to_user": (lambda a: personality.adapt_to_user(BENCH_USER, a.text, a), analyses),
+            "personality.modulate_response": (lambda r: personality.modulate_response(BENCH_USER, r), responses),
+        }
+        for function, (fn, inputs) in cases.items():
+            name = f"{function}[{length}]"
+            if wanted(name):
+                results[name] = summarize(time_calls(fn, inputs, args.sample_time, args.samples))
+                print(f"  {name}: {results[name]['p50'] * 1e6:.2f} us")
+    return results
+
+
+def populate(path: str, rows: int, rng: random.Random):
+    """Fill a migrated database with rows interactions and the data that goes with them."""
+    users = max(10, rows // INTERACTIONS_PER_USER)
+    messages = make_corpus(rng, "medium", TEXT_POOL // 2) + make_corpus(rng, "short", TEXT_POOL // 2)
+    responses = make_corpus(rng, "long", TEXT_POOL // 10) + make_corpus(rng, "medium", TEXT_POOL // 2)
+    start = datetime.now(timezone.utc) - timedelta(days=90)
+    step = timedelta(days=90) / max(1, rows)
+
+    def timestamp(index: int) -> str:
+        return (start + step * index).strftime("%Y-%m-%d %H:%M:%S")
+
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA synchronous = OFF")
+    # The last percent has not been learned from yet, as after a restart
+    unlearned_from = rows - rows // 100
+    for first in range(0, rows, BATCH_ROWS):
+        db.executemany(
+            "INSERT INTO interaction_history (user_id, message, response, created_at, learned) VALUES (?, ?, ?, ?, ?)",
+            [(rng.randrange(users) + 1, rng.choice(messages), rng.choice(responses), timestamp(index),
+              int(index < unlearned_from)) for index in range(first, min(rows, first + BATCH_ROWS))]
+        )
+        db.commit()
+
+    for first in range(0, rows // 10, BATCH_ROWS):
+        db.executemany(
+            "INSERT INTO memories (user_id, content, type, importance, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(rng.randrange(users) + 1, rng.choice(messages), "user_note", rng.choice([0.5, 1.0, 1.5]),
+              timestamp(index * 10)) for index in range(first, min(rows // 10, first + BATCH_ROWS))]
+        )
+        db.commit()
+
+    learning = LearningService(None, LEARNING_SETTINGS, MessageAnalyzer())
+    preferences = json.dumps(learning._serialize(learning._default_user_data()))
+    personality = PersonalityService(MessageAnalyzer(), None, PERSONALITY_SETTINGS)
+    record = personality._default_state().pack()
+    db.executemany("INSERT INTO user_preferences (user_id, preferences) VALUES (?, ?)",
+                   [(user_id, preferences) for user_id in range(1, users + 1)])
+    db.executemany("INSERT INTO user_personality (user_id, state) VALUES (?, ?)",
+                   [(user_id, record) for user_id in range(1, users + 1)])
+    db.executemany("INSERT INTO sync_state (user_id, last_interaction_id) VALUES (?, ?)",
+                   [(user_id, unlearned_from) for user_id in range(1, users + 1)])
+
+    # Half of the cached responses have expired
+    now = time.time()
+    db.executemany("INSERT INTO response_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                   [(f"key{index}", rng.choice(responses), now + (3600 if index % 2 else -3600))
+                    for index in range(max(1, rows // 10))])
+    # Merge the search index segments left by the batches, as the retention job does
+    for table in ("memories_fts", "interaction_fts"):
+        db.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+    db.commit()
+    db.close()
+
+
+async def time_awaits(make_call: Callable[[int], object], count: int, warmup: int) -> List[float]:
+    """Latency of count awaited calls; make_call(i) builds the i-th one."""
+    for index in range(warmup):
+        await make_call(index)
+    samples = []
+    for index in range(count):
+        call = make_call(index)
+        started = time.perf_counter()
+        await call
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def bench_database(args, rows: int, path: str, wanted: Callable[[str], bool]) -> Dict[str, dict]:
+    rng = random.Random(args.seed)
+    # Keep the background flusher out of the way; flushes are timed explicitly
+    memory = MemoryService(path, DATABASE_SETTINGS, {"batch_size": 10 ** 9, "flush_interval": 3600})
+    if not os.path.exists(path):
+        await memory.initialize()
+        await memory.close()
+        memory = MemoryService(path, DATABASE_SETTINGS, {"batch_size": 10 ** 9, "flush_interval": 3600})
+        started = time.perf_counter()
+        populate(path, rows, rng)
+        print(f"  populated {rows} rows in {time.perf_counter() - started:.1f}s")
+    await memory.initialize()
+
+    users = max(10, rows // INTERACTIONS_PER_USER)
+    user_ids = [rng.randrange(users) + 1 for _ in range(args.queries)]
+    texts = make_corpus(rng, "medium", args.queries)
+    recent_id = rows - rows // 50
+    unlearned_from = rows - rows // 100
+    cached = max(1, rows // 10)
+
+    def user(index: int) -> int:
+        return user_ids[index % len(user_ids)]
+
+    cases = {
+        "memory.get_memories": lambda i: memory.get_memories(user(i), limit=3),
+        "memory.get_memories_by_type": lambda i: memory.get_memories(user(i), "user_note", limit=5),
+        "memory.search_relevant": lambda i: memory.search_relevant(user(i), texts[i % len(texts)], k=3),
+        "memory.get_recent_interactions": lambda i: memory.get_recent_interactions(user(i), limit=10),
+        "memory.get_interactions_after": lambda i: memory.get_interactions_after(user(i), recent_id, 200),
+        "memory.get_unlearned_users": lambda i: memory.get_unlearned_users(unlearned_from - i, 100),
+        "memory.get_sync_watermark": lambda i: memory.get_sync_watermark(user(i)),
+        "memory.get_user_preferences": lambda i: memory.get_user_preferences(user(i)),
+        "memory.get_personality": lambda i: memory.get_personality(user(i)),
+        "memory.get_cached_response": lambda i: memory.get_cached_response(f"key{i % cached}", time.time()),
+    }
+
+    results = {}
+    try:
+        for function, make_call in cases.items():
+            name = f"{function}[{rows}]"
+            if wanted(name):
+                results[name] = summarize(await time_awaits(make_call, args.queries, args.warmup))
+                print(f"  {name}: {results[name]['p50'] * 1e6:.1f} us")
+
+        name = f"memory.flush[{rows}]"
+        if wanted(name):
+            def buffered_flush(index: int):
+                # Buffer a batch of interactions outside the timed part
+                for offset in range(FLUSH_ROWS):
+                    memory._pending_interactions.append(
+                        (user(index + offset), texts[(index + offset) % len(texts)], texts[index % len(texts)],
+                         datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), 1))
+                return memory.flush()
+
+            results[name] = summarize(await time_awaits(buffered_flush, max(1, args.queries // 10), 1))
+            print(f"  {name}: {results[name]['p50'] * 1e6:.1f} us per {FLUSH_ROWS} rows")
+    finally:
+        await memory.close()
+    return results
+
+
+async def bench_databases(args, wanted: Callable[[str], bool]) -> Dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.db_dir or tmp
+        os.makedirs(directory, exist_ok=True)
+        for rows in args.db_rows:
+            print(f"database with {rows} rows")
+            path = os.path.join(directory, f"bench_services_{rows}.db")
+            results.update(await bench_database(args, rows, path, wanted))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", default=",".join(MESSAGE_LENGTHS),
+                        help=f"message length classes (default: {','.join(MESSAGE_LENGTHS)})")
+    parser.add_argument("--corpus", type=int, default=200, help="messages per length class (default: 200)")
+    parser.add_argument("--sample-time", type=float, default=0.01,
+                        help="seconds per timed batch of CPU-bound calls (default: 0.01)")
+    parser.add_argument("--samples", type=int, default=30, help="timed batches per function (default: 30)")
+    parser.add_argument("--db-rows", default="1000,100000",
+                        help="interaction rows of each database, e.g. 1000,100000,10000000 (default: 1000,100000)")
+    parser.add_argument("--db-dir", help="keep the populated databases here and reuse them in later runs")
+    parser.add_argument("--queries", type=int, default=200, help="timed calls per query (default: 200)")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed calls per query first (default: 20)")
+    parser.add_argument("--only", help="run only the benchmarks whose name matches this regular expression")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the corpus (default: 1)")
+    add_baseline_arguments(parser, metric="p50", tolerance=0.2, min_delta=0.005)
+    args = parser.parse_args()
+    args.lengths = [length for length in args.lengths.split(",") if length]
+    args.db_rows = [int(rows) for rows in args.db_rows.split(",") if rows]
+    only = re.compile(args.only) if args.only else None
+
+    def wanted(name: str) -> bool:
+        return only is None or only.search(name) is not None
+
+    print("CPU-bound functions")
+    results = bench_cpu(args, wanted)
+    results.update(asyncio.run(bench_databases(args, wanted)))
+    print()
+    report(results, unit="us")
+
+    if args.output:
+        config = {key: value for key, value in vars(args).items()
+                  if key not in ("output", "baseline", "metric", "tolerance", "min_delta")}
+        save_json(args.output, {"config": config, "results": results})
+
+    if args.baseline:
+        baseline = load_json(args.baseline)
+        check_regressions(compare(results, baseline.get("results", {}), args.metric,
+                                  args.tolerance, args.min_delta / 1000), args)
+
+if __name__ == "__main__":
+    main()
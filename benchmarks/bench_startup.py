@@ -0,0 +1,89 @@
+"""Measure how long the bot takes to import and to become ready to poll.
+
+Each run starts a fresh interpreter so module caches do not hide import
+costs. A run reports:
+
+- import: ``import main`` (service construction included)
+- build: ``main.build_application()``
+- post_init: the Application startup hook (database, workers, jobs)
+- ready_to_poll: the sum of the three above
+- first_analysis: analyzing the first message, including any lazy loading
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--output results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+application = main.build_application()
+built = time.perf_counter()
+
+async def run():
+    before = time.perf_counter()
+    await main.post_init(application)
+    ready = time.perf_counter()
+    await main.nlp_executor.analyze("How long does the first message take?")
+    analyzed = time.perf_counter()
+    await main.post_shutdown(application)
+    return ready - before, analyzed - ready
+
+post_init, first_analysis = asyncio.run(run())
+print(json.dumps({
+    "import": imported - started,
+    "build": built - imported,
+    "post_init": post_init,
+    "ready_to_poll": (imported - started) + (built - imported) + post_init,
+    "first_analysis": first_analysis,
+}))
+"""
+
+def run_once(database_path: str) -> dict:
+    env = dict(os.environ, DATABASE_PATH=database_path)
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="measured runs (default: 5)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_path = os.path.join(tmp, "bench_memory.db")
+        # The first run creates and migrates the database; production
+        # restarts start from an existing one, so it is not measured
+        run_once(database_path)
+        runs = [run_once(database_path) for _ in range(args.runs)]
+
+    summary = {
+        stage: {
+            "median": statistics.median(run[stage] for run in runs),
+            "min": min(run[stage] for run in runs),
+            "max": max(run[stage] for run in runs),
+        }
+        for stage in runs[0]
+    }
+    for stage, stats in summary.items():
+        print(f"{stage:>15}: median {stats['median'] * 1000:8.1f} ms  "
+              f"(min {stats['min'] * 1000:.1f}, max {stats['max'] * 1000:.1f})")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"runs": runs, "summary": summary}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
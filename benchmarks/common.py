@@ -0,0 +1,124 @@
+"""Helpers shared by the benchmarks.
+
+- a synthetic message corpus of chat-like text in a few length classes
+- latency summaries (count, mean, p50, p95, p99) of a list of samples
+- a result table, and the comparison against a stored baseline that fails
+  a run when something got slower than allowed
+"""
+import json
+import os
+import random
+import sys
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+WORDS = """
+time year people way day man thing woman life child world school state family student group
+country problem hand part place case week company system program question work government
+number night point home water room mother area money story fact month lot right study book
+eye job word business issue side kind head house service friend father power hour game line
+end member law car city community name president team minute idea kid body information back
+parent face others level office door health person art war history party result change
+morning reason research girl guy moment air teacher force education music movie travel food
+love great happy sad worried excited curious wonderful terrible amazing interesting difficult
+please kindly would could regarding hey yeah cool awesome gonna api function code data process
+""".split()
+OPENERS = ["", "", "", "what", "how", "why", "can you", "do you think", "I love", "I hate", "tell me about"]
+
+# Words per message of each length class
+MESSAGE_LENGTHS = {"short": (3, 8), "medium": (20, 40), "long": (150, 300)}
+
+
+def make_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    """A chat message of min_words to max_words words, split into sentences."""
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    for index in range(rng.randint(8, 16), len(words), rng.randint(8, 16)):
+        words[index - 1] += "."
+    text = " ".join(filter(None, [rng.choice(OPENERS)] + words))
+    return text + rng.choice([".", "!", "?", ""])
+
+
+def make_corpus(rng: random.Random, length: str, count: int) -> List[str]:
+    """count messages of one of the MESSAGE_LENGTHS classes."""
+    return [make_text(rng, *MESSAGE_LENGTHS[length]) for _ in range(count)]
+
+
+def percentile(ordered: list, q: float) -> float:
+    """Nearest-rank quantile q of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+
+def summarize(samples: list) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+    }
+
+
+def report(results: Dict[str, Dict[str, float]], unit: str = "ms"):
+    """Print one row per result, with times in ms or us."""
+    scale = {"ms": 1e3, "us": 1e6}[unit]
+    width = max([28] + [len(name) for name in results])
+    print(f"{'name':>{width}} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}  ({unit})")
+    for name, stats in results.items():
+        print(f"{name:>{width}} {stats['count']:>7} " + " ".join(
+            f"{stats[key] * scale:9.2f}" for key in ("mean", "p50", "p95", "p99")))
+
+
+def add_baseline_arguments(parser, metric: str, tolerance: float, min_delta: float):
+    """--output, --baseline, --metric, --tolerance and --min-delta (in ms)."""
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the results JSON of an earlier run")
+    parser.add_argument("--metric", choices=["mean", "p50", "p95", "p99"], default=metric,
+                        help=f"statistic compared with the baseline (default: {metric})")
+    parser.add_argument("--tolerance", type=float, default=tolerance,
+                        help=f"allowed slowdown against the baseline (default: {tolerance})")
+    parser.add_argument("--min-delta", type=float, default=min_delta,
+                        help=f"smallest slowdown in ms that counts as a regression (default: {min_delta})")
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            metric: str, tolerance: float, min_delta: float) -> List[str]:
+    """Results whose metric got worse than the baseline by more than tolerance.
+
+    A result must also be slower by at least min_delta seconds, so noise in
+    things that take microseconds does not count as a regression. Results
+    missing from either side are not compared.
+    """
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before or metric not in before:
+            continue
+        if stats[metric] > before[metric] * (1 + tolerance) and stats[metric] - before[metric] >= min_delta:
+            change = f" ({stats[metric] / before[metric] - 1:+.0%})" if before[metric] else ""
+            regressions.append(f"{name}: {metric} {before[metric] * 1000:.3f} -> "
+                               f"{stats[metric] * 1000:.3f} ms{change}")
+    return regressions
+
+
+def save_json(path: str, data: dict):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_regressions(regressions: List[str], args):
+    """Print the comparison outcome and exit non-zero if anything regressed."""
+    if regressions:
+        print(f"\nRegressed by more than {args.tolerance:.0%} against {args.baseline}:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+    print(f"\nNothing regressed by more than {args.tolerance:.0%} against {args.baseline}")
@@ -3,6 +3,7 @@ from typing import Dict, Any, List
 
 # API Configuration
 GOOGLE_API_URL = os.getenv("GOOGLE_API_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent")
+GOOGLE_STREAM_URL = os.getenv("GOOGLE_STREAM_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:streamGenerateContent")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "your-api-key-here")
 API_KEY_PARAM = f"?key={GOOGLE_API_KEY}"
 
@@ -10,6 +11,83 @@ GOOGLE_HEADERS = {
     "Content-Type": "application/json"
 }
 
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "your-api-key-here")
+MODEL_NAME = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct")
+
+OPENROUTER_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}"
+}
+
+# Shared keep-alive HTTP client used by both providers
+HTTP_SETTINGS: Dict[str, Any] = {
+    "limit": 100,             # Open connections across all hosts
+    "limit_per_host": 10,     # Open connections to a single API host
+    "keepalive_timeout": 60,  # Seconds an idle connection stays pooled
+    "ttl_dns_cache": 300,     # Seconds DNS lookups are cached
+    "connect_timeout": 10,    # Seconds to establish a connection
+    "read_timeout": 30,       # Seconds to wait between response chunks
+    "total_timeout": 60       # Seconds for a whole request
+}
+
+# Prompt assembly; token counts are estimated at about four characters each
+PROMPT_SETTINGS: Dict[str, Any] = {
+    "max_prompt_tokens": 3000,  # Whole prompt: context, memories, history and message
+    "memory_tokens": 600,       # Share of the budget relevant memories may use
+    "max_memories": 3,          # Memories looked up per message
+    "static_ttl": 60,           # Seconds a user's fallback memories stay cached
+    "max_cached_users": 10000
+}
+
+# Routing between the LLM providers. OpenRouter only joins when it has a key.
+PROVIDER_SETTINGS: Dict[str, Any] = {
+    "providers": ["google", "openrouter"] if os.getenv("OPENROUTER_API_KEY") else ["google"],
+    "window": 50,                    # Recent requests kept per provider
+    "min_samples": 5,                # Requests needed before stats are trusted
+    "max_error_rate": 0.5,           # Above this a provider is only a last resort
+    "max_consecutive_failures": 3,   # Failures in a row before a cooldown
+    "cooldown": 30.0,                # Seconds a failing provider is skipped
+    "hedge": True,                   # Race slow requests (streams: first chunk) against the next provider
+    "hedge_percentile": 0.95,        # Latency percentile that counts as slow
+    "hedge_default_delay": 3.0,      # Hedge delay until enough samples exist
+    "hedge_min_delay": 0.5,
+    "hedge_max_delay": 10.0
+}
+
+# Outbound rate limits and retries for the LLM providers
+RATE_LIMIT_SETTINGS: Dict[str, Any] = {
+    "providers": {
+        "google": {"rate": 1.0, "burst": 10},     # Requests per second, burst size
+        "openrouter": {"rate": 1.0, "burst": 10}
+    },
+    "user_rate": 0.2,         # Requests per second a single user may cause
+    "user_burst": 5,
+    "max_users": 10000,       # Users whose buckets are kept
+    "max_retries": 3,         # Retries after a 429 or 5xx answer
+    "base_delay": 0.5,        # First backoff ceiling in seconds, doubled per retry
+    "max_delay": 20.0,
+    "request_deadline": 45.0  # Seconds a request may spend waiting and retrying
+}
+
+# Cache of LLM responses keyed on the normalized prompt and generation config
+RESPONSE_CACHE_SETTINGS: Dict[str, Any] = {
+    "enabled": True,
+    "max_entries": 1024,   # Responses kept in memory
+    "ttl": 3600,           # Seconds a response stays in memory
+    "use_store": True,     # Also keep responses in the SQLite memory store
+    "store_ttl": 86400,    # Seconds a response stays in the store
+    "ignore_case": False   # Treat prompts differing only in case as equal
+}
+
+# Streamed replies, shown by editing one Telegram message as chunks arrive
+STREAMING_SETTINGS: Dict[str, Any] = {
+    "enabled": True,
+    "edit_interval": 1.0,   # Minimum seconds between edits of the same message
+    "min_edit_chars": 20,   # New characters needed before an edit is worth sending
+    "max_message_length": 4096  # Telegram's limit; longer replies continue in new messages
+}
+
 # Safety Settings for the AI model
 SAFETY_SETTINGS = [
     {
@@ -30,10 +108,36 @@ SAFETY_SETTINGS = [
     }
 ]
 
+# Local NLTK data bundle, filled by setup_nltk.py; nothing is downloaded at runtime
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nltk_data"))
+
 # Memory Service Configuration
-DATABASE_PATH = "bot_memory.db"
+DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_memory.db")
 MAX_CONVERSATION_LENGTH = 10
 
+# Per-user conversation buffers kept in memory
+HISTORY_SETTINGS: Dict[str, Any] = {
+    "max_messages": MAX_CONVERSATION_LENGTH * 2,  # Turns kept per user
+    "max_users": 50000,      # Users kept in memory at once
+    "idle_timeout": 3600,    # Seconds of inactivity before a user is dropped
+    "reload": True           # Rebuild dropped users' history from the database
+}
+
+# SQLite connection pool used by the memory service
+DATABASE_SETTINGS: Dict[str, Any] = {
+    "readers": 4,                   # Read-only connections served concurrently
+    "busy_timeout_ms": 5000,        # How long a connection waits on a lock
+    "cache_size_kib": 8192,         # Page cache per connection
+    "mmap_size": 64 * 1024 * 1024,  # Memory-mapped I/O window
+    "cached_statements": 128        # Prepared statements kept per connection
+}
+
+# Write-behind buffering of memory and interaction inserts
+WRITE_BEHIND_SETTINGS: Dict[str, Any] = {
+    "batch_size": 64,       # Flush as soon as this many rows are buffered
+    "flush_interval": 1.0   # Otherwise flush every this many seconds
+}
+
 # Personality Service Configuration
 PERSONALITY_SETTINGS: Dict[str, Any] = {
     "initial_traits": {
@@ -51,13 +155,16 @@ PERSONALITY_SETTINGS: Dict[str, Any] = {
         "small": 0.02,
         "medium": 0.05,
         "large": 0.1
-    }
+    },
+    "max_cached_users": 100000  # Packed 31-byte states kept in memory
 }
 
 # Learning Service Configuration
 LEARNING_SETTINGS: Dict[str, Any] = {
     "max_topics": 10,
-    "max_patterns": 5,
+    "max_patterns": 5,  # Patterns reported per user
+    "pattern_capacity": 50,  # Word pairs tracked per user by the top-k sketch
+    "max_cached_users": 10000,  # Users whose learned data stays in memory
     "preference_adjustment_rate": 0.05,
     "technical_keywords": [
         "api", "function", "code", "data", "system",
@@ -77,6 +184,49 @@ LEARNING_SETTINGS: Dict[str, Any] = {
     ]
 }
 
+# Per-user ordered dispatch of updates
+DISPATCH_SETTINGS: Dict[str, Any] = {
+    "concurrent_updates": 256,  # Updates telegram may hand over at once
+    "max_concurrent": 32,       # Handlers running at once across all users
+    "max_queue_per_user": 5,    # Updates waiting per user before overflow
+    "max_users": 10000,         # Users with waiting updates at once
+    "overflow": "merge",        # "merge", "drop_oldest" or "drop_newest"
+    "shutdown_timeout": 10.0    # Seconds queued updates get at shutdown
+}
+
+# Prometheus-style metrics endpoint; keep it on a local or private interface
+METRICS_SETTINGS: Dict[str, Any] = {
+    "enabled": os.getenv("METRICS_ENABLED", "1") != "0",
+    "host": os.getenv("METRICS_HOST", "127.0.0.1"),
+    "port": int(os.getenv("METRICS_PORT", "9464")),
+    "path": "/metrics"
+}
+
+# On-demand sampling profiler, started by /profile (admins only) or a signal
+PROFILER_SETTINGS: Dict[str, Any] = {
+    "admin_ids": [int(i) for i in os.getenv("ADMIN_USER_IDS", "").split(",") if i.strip()],
+    "signal": "SIGUSR2",         # Toggles profiling; None to disable
+    "interval": 0.005,           # Seconds between stack samples
+    "block_threshold": 0.1,      # Loop stalls longer than this are logged with their stack
+    "max_duration": 300,         # Seconds before a forgotten profile stops itself
+    "max_blocks": 100,           # Stalls kept for the report
+    "output_dir": os.getenv("PROFILE_DIR", "profiles")
+}
+
+# Off-loop message analysis (tokenization, indicators, sentiment)
+NLP_EXECUTOR_SETTINGS: Dict[str, Any] = {
+    "kind": "process",   # "process", "thread" or "inline" (on the event loop)
+    "max_workers": None,  # Defaults to min(4, CPU count)
+    "max_queue": 64      # Batches allowed to wait for a worker
+}
+
+# Incremental learning sync of stored interactions
+SYNC_SETTINGS: Dict[str, Any] = {
+    "interval": 300,          # Seconds between background runs
+    "batch_size": 200,        # Interactions analyzed per batch
+    "max_users_per_run": 100  # Users synced per background run
+}
+
 # Memory Settings
 MEMORY_SETTINGS: Dict[str, Any] = {
     "max_memories": 100,
@@ -89,5 +239,9 @@ MEMORY_SETTINGS: Dict[str, Any] = {
         "fact",
         "opinion"
     ],
-    "retention_days": 30  # How long to keep memories before cleanup
+    "retention_days": 30,  # How long to keep memories before cleanup
+    "retention_interval": 3600,  # Seconds between cleanup runs
+    "retention_batch_size": 500,  # Rows deleted per transaction
+    "vacuum_pages_per_step": 1000,  # Free pages released per vacuum step
+    "search_merge_pages_per_step": 500  # FTS index pages merged per transaction
 }
@@ -1,18 +1,42 @@
+import asyncio
 import logging
-import sys
+import signal
 import random
-from typing import Dict
+from pathlib import Path
+from typing import Dict, Optional
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.request import BaseRequest
 from config.secrets import TELEGRAM_BOT_TOKEN
 from config.config import (
-    MAX_CONVERSATION_LENGTH, DATABASE_PATH,
-    PERSONALITY_SETTINGS, LEARNING_SETTINGS, MEMORY_SETTINGS
+    HISTORY_SETTINGS, DATABASE_PATH, NLTK_DATA_DIR, DATABASE_SETTINGS, WRITE_BEHIND_SETTINGS,
+    PERSONALITY_SETTINGS, LEARNING_SETTINGS, MEMORY_SETTINGS, SYNC_SETTINGS,
+    NLP_EXECUTOR_SETTINGS, HTTP_SETTINGS, STREAMING_SETTINGS,
+    RESPONSE_CACHE_SETTINGS, PROVIDER_SETTINGS, PROMPT_SETTINGS, DISPATCH_SETTINGS,
+    RATE_LIMIT_SETTINGS, METRICS_SETTINGS, PROFILER_SETTINGS
 )
-from services.google_ai_service import process_message, init_services
+from services.google_ai_service import process_message, process_message_stream, init_services
 from services.memory_service import MemoryService
-from services.personality_service import PersonalityService, PersonalityTrait, EmotionalState
+from services.retention_service import RetentionService
+from services.personality_service import PersonalityService
 from services.learning_service import LearningService
+from services.message_analysis import MessageAnalyzer
+from services.sync_service import SyncService
+from services.nlp_executor import NLPExecutor
+from services.http_client import HTTPClient
+from services.response_cache import ResponseCache
+from services.streaming_reply import StreamingReply
+from services import google_ai_service, openrouter_service
+from services.provider_router import Provider, ProviderRouter
+from services.prompt_builder import PromptBuilder
+from services.rate_limiter import RateLimiter
+from services.history_store import HistoryStore
+from services.dispatcher import UserDispatcher
+from services.metrics import (
+    Counter, Histogram, MetricsRegistry, MetricsServer, StageTimer, labelled_collector, router_collector,
+    service_collector
+)
+from services.profiler import SamplingProfiler
 
 # Enable logging
 logging.basicConfig(
@@ -21,27 +45,127 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize services
-memory_service = MemoryService(DATABASE_PATH)
-personality_service = PersonalityService()
-learning_service = LearningService()
+# Services, created by build_services(). Nothing is built on import, since
+# NLP worker processes import this module too when they are spawned.
+memory_service: Optional[MemoryService] = None
+message_analyzer: Optional[MessageAnalyzer] = None
+nlp_executor: Optional[NLPExecutor] = None
+personality_service: Optional[PersonalityService] = None
+learning_service: Optional[LearningService] = None
+retention_service: Optional[RetentionService] = None
+sync_service: Optional[SyncService] = None
+http_client: Optional[HTTPClient] = None
+response_cache: Optional[ResponseCache] = None
+prompt_builder: Optional[PromptBuilder] = None
+rate_limiter: Optional[RateLimiter] = None
+providers: Optional[Dict[str, Provider]] = None
+provider_router: Optional[ProviderRouter] = None
+history_store: Optional[HistoryStore] = None
+dispatcher: Optional[UserDispatcher] = None
+profiler: Optional[SamplingProfiler] = None
+metrics_registry: Optional[MetricsRegistry] = None
+stage_seconds: Optional[Histogram] = None
+message_errors: Optional[Counter] = None
+metrics_server: Optional[MetricsServer] = None
+
+# Background tasks started at startup, kept referenced until they finish
+background_tasks = set()
+
+def build_services() -> None:
+    """Create every service and the metrics registry as module globals."""
+    global memory_service, message_analyzer, nlp_executor, personality_service, learning_service
+    global retention_service, sync_service, http_client, response_cache, prompt_builder, rate_limiter
+    global providers, provider_router, history_store, dispatcher, profiler
+    global metrics_registry, stage_seconds, message_errors, metrics_server
+    memory_service = MemoryService(DATABASE_PATH, DATABASE_SETTINGS, WRITE_BEHIND_SETTINGS)
+    message_analyzer = MessageAnalyzer(LEARNING_SETTINGS, NLTK_DATA_DIR)
+    nlp_executor = NLPExecutor(message_analyzer, NLP_EXECUTOR_SETTINGS)
+    personality_service = PersonalityService(message_analyzer, memory_service, PERSONALITY_SETTINGS)
+    learning_service = LearningService(memory_service, LEARNING_SETTINGS, message_analyzer)
+    retention_service = RetentionService(memory_service, MEMORY_SETTINGS)
+    sync_service = SyncService(memory_service, learning_service, personality_service, nlp_executor, SYNC_SETTINGS)
+    http_client = HTTPClient(HTTP_SETTINGS)
+    response_cache = ResponseCache(RESPONSE_CACHE_SETTINGS, memory_service)
+    prompt_builder = PromptBuilder(memory_service, personality_service, learning_service, PROMPT_SETTINGS)
+
+    rate_limiter = RateLimiter(RATE_LIMIT_SETTINGS)
+
+    # LLM providers the router can pick from, each behind its rate limit
+    providers = {
+        "google": Provider(
+            "google",
+            rate_limiter.limit("google", google_ai_service.complete),
+            rate_limiter.limit_stream("google", google_ai_service.stream_text)
+        ),
+        "openrouter": Provider("openrouter", rate_limiter.limit("openrouter", openrouter_service.complete))
+    }
+    provider_router = ProviderRouter(
+        [providers[name] for name in PROVIDER_SETTINGS["providers"]], PROVIDER_SETTINGS
+    )
+
+    # Recent conversation turns of each user
+    history_store = HistoryStore(memory_service, HISTORY_SETTINGS)
 
-# Store conversation histories for each user
-conversation_histories: Dict[int, list] = {}
+    # Runs each user's updates in order, different users concurrently
+    dispatcher = UserDispatcher(DISPATCH_SETTINGS)
+
+    # Samples the event loop on demand, via /profile or PROFILER_SETTINGS["signal"]
+    profiler = SamplingProfiler(PROFILER_SETTINGS)
+
+    # Metrics: handle_message stage timings plus the services' own counters,
+    # which are only read when the endpoint is scraped
+    metrics_registry = MetricsRegistry()
+    stage_seconds = metrics_registry.histogram(
+        "bot_message_stage_seconds", "Seconds handle_message spends in each stage", labels=("stage",)
+    )
+    message_errors = metrics_registry.counter(
+        "bot_message_errors_total", "Messages that failed with an exception, by exception type", labels=("type",)
+    )
+    metrics_registry.collector(service_collector(
+        "bot_dispatcher", dispatcher.metrics,
+        counters=("submitted", "processed", "failed", "dropped", "merged", "rejected")
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_response_cache", response_cache.metrics,
+        counters=("memory_hits", "store_hits", "misses", "coalesced", "stores", "evictions")
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_nlp", nlp_executor.metrics, counters=("submitted", "completed", "failed", "restarts")
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_memory", memory_service.metrics, counters=("flushes", "flushed_rows")
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_history", history_store.metrics, counters=("reloads", "evictions")
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_prompt", prompt_builder.metrics, counters=("builds", "static_hits", "history_dropped")
+    ))
+    metrics_registry.collector(router_collector(provider_router.metrics))
+    metrics_registry.collector(labelled_collector("bot_rate_limit", rate_limiter.metrics, "limit"))
+    metrics_registry.collector(labelled_collector(
+        "bot_response",
+        lambda: {kind: {"errors": count} for kind, count in google_ai_service.response_errors.items()},
+        "kind"
+    ))
+    metrics_registry.collector(service_collector(
+        "bot_profiler", profiler.metrics, counters=("samples", "blocks")
+    ))
+    metrics_server = MetricsServer(metrics_registry, METRICS_SETTINGS)
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    await memory_service.initialize()  # Initialize database tables
+    await personality_service.load_user(user.id)
     
     welcome_message = (
         f"Hello {user.first_name}! 😊 I'm your AI assistant with personality and learning capabilities.\n\n"
         f"I can learn from our conversations and adapt to your preferences. "
-        f"Currently feeling {personality_service.get_current_state().value}!"
+        f"Currently feeling {personality_service.get_current_state(user.id).value}!"
     )
     
     await update.message.reply_text(welcome_message)
-    conversation_histories[user.id] = []
+    history_store.reset(user.id)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
@@ -76,15 +200,21 @@ Just start chatting! 😊
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the conversation history and learned data for the user."""
     user = update.effective_user
-    conversation_histories[user.id] = []
-    await memory_service.clear_user_data(user.id)
+    history_store.reset(user.id)
+    # Drop the cached copies first, so nothing in them is written back or
+    # served while the stored rows are being deleted
     learning_service.clear_user_data(user.id)
+    personality_service.clear_user_data(user.id)
+    prompt_builder.invalidate(user.id)
+    await memory_service.clear_user_data(user.id)
     
     await update.message.reply_text("Memory cleared! Let's start fresh. 🌟")
 
 async def personality_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """View or adjust personality traits."""
-    summary = personality_service.get_personality_summary()
+    user = update.effective_user
+    await personality_service.load_user(user.id)
+    summary = personality_service.get_personality_summary(user.id)
     
     response = (
         f"Current Personality State:\n\n"
@@ -99,8 +229,10 @@ async def personality_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check the current emotional state."""
-    current_state = personality_service.get_current_state()
-    style = personality_service.get_response_style()
+    user = update.effective_user
+    await personality_service.load_user(user.id)
+    current_state = personality_service.get_current_state(user.id)
+    style = personality_service.get_response_style(user.id)
     
     response = (
         f"Current Mood: {current_state.value}\n"
@@ -121,7 +253,10 @@ async def remember_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     content = " ".join(args)
     await memory_service.store_memory(user.id, content, "user_note", importance=1.0)
-    learning_service.process_message(user.id, content)
+    prompt_builder.invalidate(user.id)
+    analysis = await nlp_executor.analyze(content)
+    await learning_service.load_user(user.id)
+    learning_service.process_message(user.id, content, analysis)
     
     await update.message.reply_text(f"I'll remember that! 📝\n\nStored: {content}")
 
@@ -147,6 +282,7 @@ async def forget_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         memory_id = int(args[0])
         success = await memory_service.delete_memory(user.id, memory_id)
         if success:
+            prompt_builder.invalidate(user.id)
             await update.message.reply_text("Memory forgotten! 🗑️")
         else:
             await update.message.reply_text("Memory not found or already forgotten.")
@@ -158,6 +294,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user = update.effective_user
     
     # Get learned information
+    await learning_service.load_user(user.id)
     learning_context = learning_service.get_response_context(user.id)
     recent_interactions = await memory_service.get_recent_interactions(user.id)
     
@@ -181,98 +318,249 @@ async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     """Update learning preferences and synchronize personality."""
     user = update.effective_user
     
-    # Analyze recent interactions
-    recent_interactions = await memory_service.get_recent_interactions(user.id)
-    for interaction in recent_interactions:
-        learning_service.process_message(user.id, interaction['message'])
-        personality_service.adapt_to_user(interaction['message'])
+    # Learn from interactions that have not been analyzed yet
+    processed = await sync_service.sync_user(user.id)
+    await personality_service.load_user(user.id)
     
     response = (
         f"Synchronized! 🔄\n\n"
-        f"I've updated my understanding based on our recent interactions.\n"
-        f"Current mood: {personality_service.get_current_state().value}"
+        f"I've updated my understanding based on {processed} new interactions.\n"
+        f"Current mood: {personality_service.get_current_state(user.id).value}"
     )
     
     await update.message.reply_text(response)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle incoming messages with personality and learning."""
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start, stop or report on the event loop profiler; admins only."""
     user = update.effective_user
-    message = update.message
+    if user.id not in PROFILER_SETTINGS.get("admin_ids", ()):
+        # Not listed in /help; stay silent to everyone else
+        return
 
-    # Initialize conversation history for new users
-    if user.id not in conversation_histories:
-        conversation_histories[user.id] = []
+    action = context.args[0].lower() if context.args else "status"
+    if action == "start":
+        try:
+            duration = float(context.args[1]) if len(context.args) > 1 else None
+        except ValueError:
+            await update.message.reply_text("Usage: /profile start [seconds]")
+            return
+        if profiler.start(duration):
+            await update.message.reply_text(
+                f"Profiling the event loop for up to {duration or profiler.max_duration:.0f} s. "
+                f"Stop it with /profile stop."
+            )
+        else:
+            await update.message.reply_text("Already profiling.\n\n" + profiler.summary())
+    elif action == "stop":
+        path = await profiler.stop()
+        if path is None:
+            await update.message.reply_text("Not profiling.")
+            return
+        await update.message.reply_text(profiler.summary() + f"\n\nCollapsed stacks: {path}")
+        try:
+            await update.message.reply_document(Path(path))
+        except Exception as e:
+            logger.error(f"Error sending profile: {str(e)}")
+    elif action == "status":
+        if profiler.running or profiler.started:
+            await update.message.reply_text(profiler.summary())
+        else:
+            await update.message.reply_text("No profile yet. Start one with /profile start [seconds].")
+    else:
+        await update.message.reply_text("Usage: /profile start [seconds] | stop | status")
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str = None) -> None:
+    """Handle incoming messages with personality and learning.
+
+    text carries several messages joined together when the dispatcher
+    merged a flood of them; it defaults to the message's own text.
+    """
+    user = update.effective_user
+    message = update.message
 
     # Get user's message
-    if message.text:
-        user_message = message.text
+    if text or message.text:
+        user_message = text or message.text
     else:
         await message.reply_text("Sorry, I can only process text messages at the moment.")
         return
 
+    # Time spent in each stage goes to the bot_message_stage_seconds histogram
+    timer = StageTimer(stage_seconds)
+    # Keep the user's learned data and personality cached until the reply is sent
+    learning_service.pin(user.id)
+    personality_service.pin(user.id)
     try:
+        # Analyze the message once for both services, off the event loop
+        analysis = await nlp_executor.analyze(user_message)
+        timer.lap("analysis")
+        
         # Process message through learning service
-        learning_context = learning_service.process_message(user.id, user_message)
+        await learning_service.load_user(user.id)
+        learning_context = learning_service.process_message(user.id, user_message, analysis)
+        timer.lap("learning")
         
         # Update personality based on message
-        personality_service.adapt_to_user(user_message)
+        await personality_service.load_user(user.id)
+        personality_service.adapt_to_user(user.id, user_message, analysis)
+        timer.lap("personality")
         
-        # Store interaction
-        await memory_service.store_interaction(user.id, user_message, "")
-        
-        # Maintain conversation history size
-        if len(conversation_histories[user.id]) >= MAX_CONVERSATION_LENGTH * 2:
-            conversation_histories[user.id] = conversation_histories[user.id][-MAX_CONVERSATION_LENGTH * 2:]
+        # Recent turns, reloaded from the database if the user was dropped
+        history = await history_store.get(user.id)
+        timer.lap("history")
 
         # Let user know we're processing their message
         await message.chat.send_action(action="typing")
+        timer.lap("telegram_send")
         
-        # Process message and get response
-        response = await process_message(user_message, conversation_histories[user.id], user.id)
-        
-        # Modulate response based on personality
-        response = personality_service.modulate_response(response)
-        
-        # Adapt response based on learned preferences
-        response = learning_service.adapt_response(user.id, response)
-        
-        # Store the bot's response in interaction history
-        await memory_service.store_interaction(user.id, user_message, response)
+        if STREAMING_SETTINGS.get("enabled"):
+            # Keep one expression for the whole stream so edits don't flicker
+            expression = personality_service.get_expression(user.id)
+
+            def render(text: str, final: bool) -> str:
+                # Rendering happens inside the reply's edits
+                timer.lap("telegram_send")
+                # Modulate by personality, then adapt to learned preferences
+                text = personality_service.modulate_response(user.id, text, expression)
+                # Only the final text is shortened, so partial edits only ever grow
+                text = learning_service.adapt_response(user.id, text, final)
+                timer.lap("postprocess")
+                return text
+
+            # Show the response as it streams in by editing one message
+            reply = StreamingReply(message, STREAMING_SETTINGS, render)
+            streamed = ""
+            async for chunk in process_message_stream(user_message, history, user.id):
+                streamed += chunk
+                timer.lap("llm")
+                await reply.update(streamed)
+                timer.lap("telegram_send")
+            timer.lap("llm")
+            response = await reply.finish(streamed)
+            timer.lap("telegram_send")
+        else:
+            # Process message and get response
+            response = await process_message(user_message, history, user.id)
+            timer.lap("llm")
+            
+            # Modulate response based on personality
+            response = personality_service.modulate_response(user.id, response)
+            
+            # Adapt response based on learned preferences
+            response = learning_service.adapt_response(user.id, response)
+            timer.lap("postprocess")
+            
+            # Send response back to user
+            await message.reply_text(response)
+            timer.lap("telegram_send")
         
-        # Send response back to user
-        await message.reply_text(response)
+        # Store the exchange as a single interaction row
+        history_store.append_exchange(user.id, user_message, response)
+        await memory_service.store_interaction(user.id, user_message, response, learned=True)
+        timer.lap("db_write")
         
     except Exception as e:
-        logger.error(f"Error processing message: {str(e)}")
+        message_errors.inc(type(e).__name__)
+        logger.error(f"Error processing message: {type(e).__name__}: {str(e)}")
         await message.reply_text(
             "Sorry, I encountered an error. Please try again later. "
-            f"I was feeling {personality_service.get_current_state().value} too! 😅"
+            f"I was feeling {personality_service.get_current_state(user.id).value} too! 😅"
         )
+    finally:
+        learning_service.unpin(user.id)
+        personality_service.unpin(user.id)
+        timer.finish()
 
-def main() -> None:
-    """Start the bot."""
+async def warm_up() -> None:
+    """Load the NLP resources without holding up polling."""
+    try:
+        await nlp_executor.warm_up()
+    except Exception as e:
+        logger.error(f"Error warming up NLP workers: {str(e)}")
+
+async def post_init(application: Application) -> None:
+    """Open long-lived resources before the bot starts polling."""
+    await memory_service.initialize()
+    await http_client.start()
+    nlp_executor.start()
+    task = asyncio.create_task(warm_up())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    retention_service.start()
+    sync_service.start()
+    await metrics_server.start()
+    if PROFILER_SETTINGS.get("signal"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                getattr(signal, PROFILER_SETTINGS["signal"]), profiler.toggle
+            )
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+            # No such signal on this platform, or not on the main thread
+            logger.error(f"Error installing profiler signal handler: {str(e)}")
+
+async def post_shutdown(application: Application) -> None:
+    """Release long-lived resources once the bot has stopped."""
+    # A running profile is written out rather than lost
+    await profiler.stop()
+    await metrics_server.stop()
+    await dispatcher.stop(DISPATCH_SETTINGS.get("shutdown_timeout", 10.0))
+    await retention_service.stop()
+    await sync_service.stop()
+    nlp_executor.shutdown()
+    await http_client.close()
+    learning_service.flush()
+    await memory_service.close()
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """Create the Application with every handler and lifecycle hook registered.
+
+    request replaces the Bot API transport, e.g. with a fake one in benchmarks.
+    """
     # Create the Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Handlers only queue work on the dispatcher, which does the ordering
+        .concurrent_updates(DISPATCH_SETTINGS.get("concurrent_updates", True))
+    )
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
-    # Add handlers for basic commands
-    application.add_handler(CommandHandler("start", start_command))
+    # Add handlers for basic commands; those touching a user's state run
+    # through the dispatcher so they stay ordered with the user's messages
+    application.add_handler(CommandHandler("start", dispatcher.serialized(start_command)))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("clear", clear_command))
+    application.add_handler(CommandHandler("clear", dispatcher.serialized(clear_command)))
     
     # Add handlers for personality and learning commands
     application.add_handler(CommandHandler("personality", personality_command))
     application.add_handler(CommandHandler("mood", mood_command))
-    application.add_handler(CommandHandler("remember", remember_command))
-    application.add_handler(CommandHandler("forget", forget_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("sync", sync_command))
+    application.add_handler(CommandHandler("remember", dispatcher.serialized(remember_command)))
+    application.add_handler(CommandHandler("forget", dispatcher.serialized(forget_command)))
+    application.add_handler(CommandHandler("stats", dispatcher.serialized(stats_command)))
+    application.add_handler(CommandHandler("sync", dispatcher.serialized(sync_command)))
+
+    # Admin-only profiler control; not serialized, so it answers while handlers are busy
+    application.add_handler(CommandHandler("profile", profile_command))
     
     # Message handler
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND,
+                                           dispatcher.serialized(handle_message, mergeable=True)))
 
     # Initialize AI service with our custom services
-    init_services(memory_service, personality_service, learning_service)
+    init_services(memory_service, personality_service, learning_service, http_client, response_cache,
+                  provider_router, prompt_builder, rate_limiter)
+    openrouter_service.init_http_client(http_client)
+
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    build_services()
+    application = build_application()
 
     # Run the bot
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,110 @@
+import asyncio
+import aiosqlite
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+
+class ConnectionPool:
+    """Long-lived SQLite connections: one writer and a fixed set of readers.
+
+    SQLite allows a single writer at a time, so all writes go through one
+    connection guarded by a lock. In WAL mode readers never block the writer,
+    which lets several reader connections serve queries concurrently.
+    """
+
+    def __init__(self, db_path: str, readers: int = 4, busy_timeout_ms: int = 5000,
+                 cache_size_kib: int = 8192, mmap_size: int = 64 * 1024 * 1024,
+                 cached_statements: int = 128):
+        self.db_path = db_path
+        self.reader_count = max(1, readers)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle_readers: Optional[asyncio.Queue] = None
+        self._open_lock = asyncio.Lock()
+        self.closed = True
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        """Open a connection and apply the pragmas shared by the pool."""
+        # sqlite3 keeps a per-connection cache of prepared statements keyed
+        # on the SQL text, so long-lived connections reuse compiled queries.
+        db = await aiosqlite.connect(self.db_path, cached_statements=self.cached_statements)
+        db.row_factory = aiosqlite.Row
+        await db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        await db.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        await db.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        await db.execute("PRAGMA temp_store = MEMORY")
+        if readonly:
+            await db.execute("PRAGMA query_only = ON")
+        else:
+            await db.execute("PRAGMA journal_mode = WAL")
+            # WAL makes NORMAL durable against application crashes; only an
+            # OS crash or power loss can roll back the last commits.
+            await db.execute("PRAGMA synchronous = NORMAL")
+            await db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    async def open(self):
+        """Open the writer and reader connections if they are not open yet."""
+        async with self._open_lock:
+            if not self.closed:
+                return
+
+            # The writer goes first so the database is switched to WAL before
+            # any reader attaches to it.
+            self._writer = await self._connect(readonly=False)
+            self._idle_readers = asyncio.Queue()
+            for _ in range(self.reader_count):
+                reader = await self._connect(readonly=True)
+                self._readers.append(reader)
+                self._idle_readers.put_nowait(reader)
+            self.closed = False
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow the writer connection; the caller owns the transaction."""
+        await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Run a block on the writer connection and commit it as one transaction."""
+        async with self.writer() as db:
+            yield db
+            await db.commit()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow an idle reader connection, waiting if all are busy."""
+        await self.open()
+        db = await self._idle_readers.get()
+        try:
+            yield db
+        finally:
+            self._idle_readers.put_nowait(db)
+
+    async def close(self):
+        """Close every connection in the pool."""
+        async with self._open_lock:
+            if self.closed:
+                return
+            self.closed = True
+
+            async with self._write_lock:
+                await self._writer.close()
+                self._writer = None
+
+            for reader in self._readers:
+                await reader.close()
+            self._readers = []
+            self._idle_readers = None
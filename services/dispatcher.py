@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest", "merge")
+
+
+class Job:
+    """One queued handler call. text is set for messages that may be merged."""
+
+    __slots__ = ("handler", "args", "text", "enqueued_at")
+
+    def __init__(self, handler: Callable[..., Awaitable[Any]], args: tuple, text: Optional[str] = None):
+        self.handler = handler
+        self.args = args
+        self.text = text
+        self.enqueued_at = time.monotonic()
+
+
+class UserDispatcher:
+    """Run handlers in order per user and concurrently across users.
+
+    Each user with pending work gets a bounded queue and a single worker
+    task that drains it, so one user's updates never overlap while
+    different users proceed in parallel. A global semaphore caps how many
+    handlers run at once; queued jobs do not hold a slot. When a user's
+    queue is full the overflow policy decides:
+
+    - "drop_newest" rejects the new job,
+    - "drop_oldest" discards the oldest queued text message,
+    - "merge" folds a new text message into the last queued one, so a
+      flood becomes one combined message, and otherwise drops the oldest.
+
+    Commands are never discarded: with no queued text message to drop, the
+    new job is rejected instead, and its sender is told to try again.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        self.settings = settings or {}
+        self.max_concurrent = self.settings.get("max_concurrent", 32)
+        self.max_queue = self.settings.get("max_queue_per_user", 5)
+        self.max_users = self.settings.get("max_users", 10000)
+        self.overflow = self.settings.get("overflow", "merge")
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {self.overflow}")
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._queues: Dict[Hashable, deque] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self.closed = False
+
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.merged = 0
+        self.rejected = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.running = 0
+        self.wait_time_total = 0.0
+
+    def submit(self, key: Hashable, handler: Callable[..., Awaitable[Any]], *args,
+               text: Optional[str] = None) -> bool:
+        """Queue handler(*args) behind the key's earlier jobs; False if it was turned away."""
+        if self.closed:
+            self.rejected += 1
+            return False
+        self.submitted += 1
+
+        queue = self._queues.get(key)
+        if queue is None:
+            if len(self._queues) >= self.max_users:
+                self.rejected += 1
+                logger.warning(f"Dispatcher is full, rejecting update from {key}")
+                return False
+            queue = self._queues[key] = deque()
+
+        if len(queue) >= self.max_queue:
+            last = queue[-1] if queue else None
+            if (self.overflow == "merge" and text is not None and last is not None
+                    and last.text is not None and last.handler is handler):
+                # Answer the newest message with everything sent meanwhile
+                last.text = f"{last.text}\n{text}"
+                last.args = args
+                self.merged += 1
+                return True
+            if self.overflow == "drop_newest" or not self._drop_oldest_text(queue):
+                self.rejected += 1
+                return False
+            self.queued -= 1
+            self.dropped += 1
+            logger.warning(f"Dropped the oldest queued message from {key}")
+
+        queue.append(Job(handler, args, text))
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(queue))
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+        return True
+
+    @staticmethod
+    def _drop_oldest_text(queue: deque) -> bool:
+        """Remove the oldest queued text message; False if only commands are queued."""
+        for index, job in enumerate(queue):
+            if job.text is not None:
+                del queue[index]
+                return True
+        return False
+
+    async def _drain(self, key: Hashable):
+        """Run the key's jobs one after another until its queue is empty."""
+        queue = self._queues[key]
+        try:
+            while queue:
+                job = queue.popleft()
+                self.queued -= 1
+                async with self._semaphore:
+                    self.wait_time_total += time.monotonic() - job.enqueued_at
+                    self.running += 1
+                    try:
+                        if job.text is not None:
+                            await job.handler(*job.args, text=job.text)
+                        else:
+                            await job.handler(*job.args)
+                        self.processed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error(f"Error in dispatched handler: {str(e)}")
+                    finally:
+                        self.running -= 1
+        finally:
+            self.queued -= len(queue)
+            self._queues.pop(key, None)
+            self._workers.pop(key, None)
+
+    def serialized(self, handler: Callable[..., Awaitable[Any]], mergeable: bool = False):
+        """Wrap a telegram callback so its updates go through the dispatcher.
+
+        Mergeable callbacks are called with a text keyword holding the
+        message text, or several texts joined by newlines after a merge.
+        """
+        async def callback(update, context):
+            user = update.effective_user
+            key = user.id if user else update.effective_chat.id
+            text = update.effective_message.text if mergeable and update.effective_message else None
+            if not self.submit(key, handler, update, context, text=text):
+                if update.effective_message:
+                    await update.effective_message.reply_text(
+                        "I'm still catching up on your earlier messages. Please try again in a moment."
+                    )
+        return callback
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop taking jobs, give queued ones timeout seconds, then cancel the rest."""
+        self.closed = True
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Cancelled {len(pending)} dispatcher workers at shutdown")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth and throughput counters."""
+        started = self.processed + self.failed
+        return {
+            "queued": self.queued,
+            "active_users": len(self._queues),
+            "running": self.running,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "merged": self.merged,
+            "rejected": self.rejected,
+            "mean_wait": self.wait_time_total / started if started else 0.0
+        }
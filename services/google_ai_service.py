@@ -1,63 +1,79 @@
 import json
-import aiohttp
-from typing import List, Dict, Any
+import logging
+from contextlib import nullcontext
+from typing import List, Dict, Any, Optional, AsyncIterator
 from config.config import (
-    GOOGLE_API_URL, GOOGLE_HEADERS, API_KEY_PARAM, SAFETY_SETTINGS,
-    PERSONALITY_SETTINGS
+    GOOGLE_API_URL, GOOGLE_STREAM_URL, GOOGLE_HEADERS, API_KEY_PARAM, SAFETY_SETTINGS,
+    PERSONALITY_SETTINGS, PROMPT_SETTINGS
 )
 from services.memory_service import MemoryService
 from services.personality_service import PersonalityService
 from services.learning_service import LearningService
+from services.http_client import HTTPClient
+from services.response_cache import ResponseCache
+from services.provider_router import ProviderError, ProviderHTTPError, ProviderRouter, DeadlineExceeded, error_kind
+from services.rate_limiter import RateLimiter, parse_retry_after
+from services.prompt_builder import PromptBuilder
+
+logger = logging.getLogger(__name__)
 
 # Initialize global service instances
 memory_service = None
 personality_service = None
 learning_service = None
+http_client: Optional[HTTPClient] = None
+response_cache: Optional[ResponseCache] = None
+provider_router: Optional[ProviderRouter] = None
+prompt_builder = PromptBuilder(settings=PROMPT_SETTINGS)
+rate_limiter: Optional[RateLimiter] = None
+
+# Requests answered with an error message, by error kind
+response_errors: Dict[str, int] = {}
+
+def init_services(mem_service: MemoryService, pers_service: PersonalityService, learn_service: LearningService,
+                  client: Optional[HTTPClient] = None, cache: Optional[ResponseCache] = None,
+                  router: Optional[ProviderRouter] = None, builder: Optional[PromptBuilder] = None,
+                  limiter: Optional[RateLimiter] = None):
+    """Initialize the services for context-aware responses.
 
-def init_services(mem_service: MemoryService, pers_service: PersonalityService, learn_service: LearningService):
-    """Initialize the services for context-aware responses."""
-    global memory_service, personality_service, learning_service
+    With a router, responses come from whichever provider it picks;
+    otherwise they always come from Google AI.
+    """
+    global memory_service, personality_service, learning_service, http_client, response_cache, provider_router
+    global prompt_builder, rate_limiter
     memory_service = mem_service
     personality_service = pers_service
     learning_service = learn_service
+    http_client = client or HTTPClient()
+    response_cache = cache
+    provider_router = router
+    prompt_builder = builder or PromptBuilder(mem_service, pers_service, learn_service, PROMPT_SETTINGS)
+    rate_limiter = limiter
 
-async def generate_response(messages: List[Dict[str, str]], user_context: Dict[str, Any] = None) -> str:
+def build_contents(history: List[Dict[str, str]], enhanced_message: str) -> List[Dict[str, Any]]:
     """
-    Generate a response using the Google AI API with context enhancement.
+    Turn the packed history and prompt into alternating user/model turns.
     """
-    # Get the last message from conversation history
-    last_message = messages[-1]["content"]
-
-    # Build context-enhanced prompt
-    system_context = "You are an AI assistant with personality and learning capabilities. "
-    
-    if user_context and personality_service:
-        emotional_state = personality_service.get_current_state()
-        system_context += f"Your current emotional state is {emotional_state.value}. "
-    
-    if user_context and memory_service:
-        # Get relevant memories
-        memories = await memory_service.get_memories(user_context.get('user_id', 0), limit=3)
-        if memories:
-            system_context += "\nRelevant context from past interactions:\n"
-            for memory in memories:
-                system_context += f"- {memory['content']}\n"
-    
-    if user_context and learning_service:
-        # Get learned preferences
-        learning_context = learning_service.get_response_context(user_context.get('user_id', 0))
-        if learning_context.get('topics'):
-            system_context += "\nUser's topics of interest: " + ", ".join(learning_context['topics'])
-    
-    # Combine system context with user message
-    enhanced_message = f"{system_context}\n\nUser message: {last_message}"
+    contents = []
+    for turn in history[:-1]:
+        role = "model" if turn["role"] == "assistant" else "user"
+        if contents and contents[-1]["role"] == role:
+            # Consecutive turns of one role are merged; Gemini wants them alternating
+            contents[-1]["parts"].append({"text": turn["content"]})
+        else:
+            contents.append({"role": role, "parts": [{"text": turn["content"]}]})
+    if contents and contents[-1]["role"] == "user":
+        contents[-1]["parts"].append({"text": enhanced_message})
+    else:
+        contents.append({"role": "user", "parts": [{"text": enhanced_message}]})
+    return contents
 
+def build_payload(enhanced_message: str, history: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+    """
+    Build the Google AI request body for a prompt and the history before it.
+    """
     payload = {
-        "contents": [{
-            "parts": [{
-                "text": enhanced_message
-            }]
-        }],
+        "contents": build_contents(history or [], enhanced_message),
         "safetySettings": SAFETY_SETTINGS,
         "generationConfig": {
             "temperature": 0.7,
@@ -68,54 +84,184 @@ async def generate_response(messages: List[Dict[str, str]], user_context: Dict[s
         }
     }
     
+    return payload
+
+def extract_text(result: Dict[str, Any]) -> Optional[str]:
+    """Return the text of the first candidate in a response body, if any."""
+    candidates = result.get("candidates") or []
+    if not candidates:
+        return None
+    parts = candidates[0].get("content", {}).get("parts") or []
+    if not parts:
+        return None
+    return "".join(part.get("text", "") for part in parts)
+
+async def request_text(payload: Dict[str, Any]) -> Optional[str]:
+    """Send a request body to the Google AI API and return the generated text, if any."""
+    async with http_client.post(
+        f"{GOOGLE_API_URL}{API_KEY_PARAM}",
+        headers=GOOGLE_HEADERS,
+        json=payload
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise ProviderHTTPError(f"Error from Google AI API: {error_text}", response.status,
+                                    parse_retry_after(response.headers.get("Retry-After")))
+        return extract_text(await response.json())
+
+async def complete(messages: List[Dict[str, str]], prompt: str) -> str:
+    """Provider interface: the full Google AI response to a prompt."""
+    text = await request_text(build_payload(prompt, messages))
+    if not text:
+        raise ProviderError("Google AI API returned no candidates")
+    return text
+
+async def stream_text(messages: List[Dict[str, str]], prompt: str) -> AsyncIterator[str]:
+    """Provider interface: the Google AI response to a prompt, chunk by chunk."""
+    # alt=sse makes the endpoint send one "data: {...}" event per chunk
+    async with http_client.post(
+        f"{GOOGLE_STREAM_URL}{API_KEY_PARAM}&alt=sse",
+        headers=GOOGLE_HEADERS,
+        json=build_payload(prompt, messages)
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise ProviderHTTPError(f"Error from Google AI API: {error_text}", response.status,
+                                    parse_retry_after(response.headers.get("Retry-After")))
+        
+        received = False
+        async for line in response.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            text = extract_text(json.loads(line[5:]))
+            if text:
+                received = True
+                yield text
+        if not received:
+            raise ProviderError("Google AI API returned no candidates")
+
+def request_scope():
+    """Deadline shared by every provider call made for one request."""
+    return rate_limiter.request() if rate_limiter is not None else nullcontext()
+
+async def acquire_user(user_context: Optional[Dict[str, Any]]):
+    """Wait for the user's turn under the per-user rate limit."""
+    if rate_limiter is not None and user_context:
+        await rate_limiter.acquire_user(user_context.get('user_id', 0))
+
+def record_error(error: Exception):
+    """Count a request that failed, for the metrics endpoint."""
+    kind = error_kind(error)
+    response_errors[kind] = response_errors.get(kind, 0) + 1
+
+def error_message(error: Exception) -> str:
+    """The reply shown to the user when no response could be generated."""
+    if isinstance(error, DeadlineExceeded):
+        return "I'm getting a lot of messages right now. Please try again in a moment."
+    if isinstance(error, ProviderError):
+        return "There was an error processing your request. Please try again."
+    return "Sorry, there was an error processing your request. Please try again later."
+
+async def generate_response(messages: List[Dict[str, str]], user_context: Dict[str, Any] = None,
+                            use_cache: bool = True) -> str:
+    """
+    Generate a response with context enhancement.
+
+    Identical prompts are answered from the response cache unless use_cache
+    is False; only calls that reach a provider count against rate limits.
+    """
+    messages, prompt = await prompt_builder.build(messages, user_context)
+    route = provider_router.generate if provider_router is not None else complete
+
+    async def generate() -> str:
+        await acquire_user(user_context)
+        return await route(messages, prompt)
+    
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{GOOGLE_API_URL}{API_KEY_PARAM}",
-                headers=GOOGLE_HEADERS,
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if (
-                        "candidates" in result 
-                        and len(result["candidates"]) > 0 
-                        and "content" in result["candidates"][0]
-                        and "parts" in result["candidates"][0]["content"]
-                        and len(result["candidates"][0]["content"]["parts"]) > 0
-                    ):
-                        return result["candidates"][0]["content"]["parts"][0]["text"]
-                    else:
-                        return "I couldn't generate a response. Please try again."
-                else:
-                    error_text = await response.text()
-                    print(f"Error from Google AI API: {error_text}")
-                    return "There was an error processing your request. Please try again."
-                    
+        with request_scope():
+            if response_cache is not None and use_cache:
+                return await response_cache.get_or_compute(
+                    response_cache.make_key(build_payload(prompt, messages)), generate
+                )
+            return await generate()
+                
     except Exception as e:
-        print(f"Error generating response: {str(e)}")
-        return "Sorry, there was an error processing your request. Please try again later."
+        logger.error(f"Error generating response: {str(e)}")
+        record_error(e)
+        return error_message(e)
 
-async def process_message(user_message: str, conversation_history: List[Dict[str, str]], user_id: int = None) -> str:
+async def stream_response(messages: List[Dict[str, str]], user_context: Dict[str, Any] = None,
+                          use_cache: bool = True) -> AsyncIterator[str]:
     """
-    Process a message with enhanced context and maintain conversation history.
+    Stream a response with context enhancement, yielding text chunks as they arrive.
+
+    A cached response is yielded as a single chunk. Identical requests in
+    flight at the same time share one provider stream, and a completed
+    stream is added to the cache.
     """
-    # Add user message to conversation history
-    conversation_history.append({
+    messages, prompt = await prompt_builder.build(messages, user_context)
+    route = provider_router.stream if provider_router is not None else stream_text
+
+    async def generate() -> AsyncIterator[str]:
+        await acquire_user(user_context)
+        async for chunk in route(messages, prompt):
+            yield chunk
+
+    chunks = []
+    try:
+        with request_scope():
+            if response_cache is not None and use_cache:
+                source = response_cache.stream_or_compute(
+                    response_cache.make_key(build_payload(prompt, messages)), generate
+                )
+            else:
+                source = generate()
+            async for chunk in source:
+                chunks.append(chunk)
+                yield chunk
+            
+    except Exception as e:
+        logger.error(f"Error streaming response: {str(e)}")
+        record_error(e)
+        # Keep whatever was already shown rather than replacing it
+        if not chunks:
+            yield error_message(e)
+
+async def process_message(user_message: str, conversation_history: List[Dict[str, str]], user_id: int = None,
+                          use_cache: bool = True) -> str:
+    """
+    Process a message with enhanced context.
+
+    conversation_history holds the turns before this message and is left
+    unchanged; the caller records the exchange once the response is final.
+    """
+    messages = conversation_history + [{
         "role": "user",
         "content": user_message
-    })
+    }]
     
     # Create user context
     user_context = {"user_id": user_id} if user_id is not None else None
     
     # Generate response with context
-    response = await generate_response(conversation_history, user_context)
+    return await generate_response(messages, user_context, use_cache)
+
+
+async def process_message_stream(user_message: str, conversation_history: List[Dict[str, str]],
+                                 user_id: int = None, use_cache: bool = True) -> AsyncIterator[str]:
+    """
+    Stream a response with enhanced context.
+
+    Like process_message, this leaves conversation_history unchanged.
+    """
+    messages = conversation_history + [{
+        "role": "user",
+        "content": user_message
+    }]
     
-    # Add assistant response to conversation history
-    conversation_history.append({
-        "role": "assistant",
-        "content": response
-    })
+    # Create user context
+    user_context = {"user_id": user_id} if user_id is not None else None
     
-    return response
+    async for chunk in stream_response(messages, user_context, use_cache):
+        yield chunk
@@ -0,0 +1,66 @@
+import heapq
+from operator import itemgetter
+from typing import Dict, Iterable, List, Tuple, Union
+
+class SpaceSaving:
+    """Approximate top-k counter that never holds more than `capacity` items.
+
+    Implements the Space-Saving algorithm: when a new item arrives and the
+    table is full, it takes over the slot of the current minimum and inherits
+    its count, which is remembered as the item's maximum overestimate. Every
+    item seen more than N / capacity times is guaranteed to be tracked.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, item: str, count: int = 1):
+        """Count `count` more occurrences of item."""
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            # Bounded by capacity, so this scan is constant per message
+            victim = min(self.counts, key=self.counts.__getitem__)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[item] = floor + count
+            self.errors[item] = floor
+
+    def update(self, items: Union[Dict[str, int], Iterable[str]]):
+        """Count a batch of items, either an iterable or an item -> count mapping."""
+        if isinstance(items, dict):
+            for item, count in items.items():
+                self.add(item, count)
+        else:
+            for item in items:
+                self.add(item)
+
+    def most_common(self, n: int) -> List[Tuple[str, int]]:
+        """Return the n items with the highest estimated counts."""
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def to_list(self) -> List[list]:
+        """Serialize as [item, count, error] triples."""
+        return [[item, count, self.errors[item]] for item, count in self.counts.items()]
+
+    @classmethod
+    def from_stored(cls, capacity: int, stored: Union[list, Dict[str, int], None]) -> "SpaceSaving":
+        """Rebuild a sketch from to_list() output or from a plain item -> count dict."""
+        sketch = cls(capacity)
+        if not stored:
+            return sketch
+        if isinstance(stored, dict):
+            stored = [[item, count, 0] for item, count in stored.items()]
+        # Keep the heaviest items if the capacity has shrunk since saving
+        for item, count, error in heapq.nlargest(sketch.capacity, stored, key=itemgetter(1)):
+            sketch.counts[item] = count
+            sketch.errors[item] = error
+        return sketch
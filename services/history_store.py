@@ -0,0 +1,111 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+from services.memory_service import MemoryService
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """Recent conversation turns per user, bounded in turns and in users.
+
+    Each user gets a ring buffer of max_messages turns, so appending never
+    needs trimming afterwards. Users are kept in least-recently-active order;
+    those idle for longer than idle_timeout, or beyond max_users, are dropped.
+    Every exchange is already stored in interaction_history, so with reload
+    on a dropped user's recent turns are read back from there on their next
+    message instead of being kept in memory.
+    """
+
+    def __init__(self, memory_service: Optional[MemoryService] = None, settings: Optional[Dict[str, Any]] = None):
+        self.memory_service = memory_service
+        self.settings = settings or {}
+        self.max_messages = self.settings.get("max_messages", 20)
+        self.max_users = self.settings.get("max_users", 50000)
+        self.idle_timeout = self.settings.get("idle_timeout", 3600)
+        self.reload = self.settings.get("reload", True)
+
+        # user_id -> [last_active, deque of (role, content)], least recently active first
+        self._histories: OrderedDict = OrderedDict()
+
+        self.reloads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._histories)
+
+    def _evict(self, now: float):
+        """Drop the users idle for too long and any beyond max_users."""
+        while self._histories:
+            user_id, (last_active, _) = next(iter(self._histories.items()))
+            if len(self._histories) <= self.max_users and now - last_active <= self.idle_timeout:
+                break
+            del self._histories[user_id]
+            self.evictions += 1
+
+    def _entry(self, user_id: int, now: float) -> list:
+        entry = self._histories.get(user_id)
+        if entry is None:
+            entry = [now, deque(maxlen=self.max_messages)]
+            self._histories[user_id] = entry
+        else:
+            entry[0] = now
+            self._histories.move_to_end(user_id)
+        return entry
+
+    async def _load(self, user_id: int) -> deque:
+        """Rebuild a buffer from the user's most recent stored interactions."""
+        turns = deque(maxlen=self.max_messages)
+        try:
+            rows = await self.memory_service.get_recent_interactions(user_id, limit=(self.max_messages + 1) // 2)
+        except Exception as e:
+            logger.error(f"Error reloading conversation history: {str(e)}")
+            return turns
+        for row in reversed(rows):
+            turns.append(("user", row["message"]))
+            if row["response"]:
+                turns.append(("assistant", row["response"]))
+        self.reloads += 1
+        return turns
+
+    async def get(self, user_id: int) -> List[Dict[str, str]]:
+        """A copy of the user's recent turns, oldest first."""
+        now = time.monotonic()
+        self._evict(now)
+        if user_id not in self._histories and self.reload and self.memory_service:
+            turns = await self._load(user_id)
+            # Another message of the same user may have created it meanwhile
+            if user_id not in self._histories:
+                self._histories[user_id] = [now, turns]
+        entry = self._entry(user_id, now)
+        return [{"role": role, "content": content} for role, content in entry[1]]
+
+    def append(self, user_id: int, role: str, content: str):
+        """Add one turn, dropping the oldest once the buffer is full."""
+        now = time.monotonic()
+        self._entry(user_id, now)[1].append((role, content))
+        self._evict(now)
+
+    def append_exchange(self, user_id: int, message: str, response: str):
+        """Add a user message and the response to it."""
+        self.append(user_id, "user", message)
+        self.append(user_id, "assistant", response)
+
+    def reset(self, user_id: int):
+        """Start the user on an empty conversation."""
+        now = time.monotonic()
+        self._entry(user_id, now)[1].clear()
+        self._evict(now)
+
+    def discard(self, user_id: int):
+        """Forget the user's buffer entirely."""
+        self._histories.pop(user_id, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Counters and the number of users held in memory."""
+        return {
+            "users": len(self._histories),
+            "reloads": self.reloads,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,62 @@
+import aiohttp
+from typing import Any, Dict, Optional
+
+
+class HTTPClient:
+    """Process-wide aiohttp session shared by the LLM providers.
+
+    One session owns one connection pool, so consecutive requests to the same
+    API reuse a kept-alive TLS connection instead of paying DNS, TCP and TLS
+    setup on every message. The client is created once, opened on
+    Application startup and closed on shutdown; pass a different instance
+    (or a custom connector) to the services to point them somewhere else.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None,
+                 connector: Optional[aiohttp.BaseConnector] = None):
+        self.settings = settings or {}
+        self._connector = connector
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        """Build the session with the configured pool limits and timeouts."""
+        connector = self._connector or aiohttp.TCPConnector(
+            limit=self.settings.get("limit", 100),
+            limit_per_host=self.settings.get("limit_per_host", 10),
+            keepalive_timeout=self.settings.get("keepalive_timeout", 60),
+            ttl_dns_cache=self.settings.get("ttl_dns_cache", 300)
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.settings.get("total_timeout", 60),
+            connect=self.settings.get("connect_timeout", 10),
+            sock_read=self.settings.get("read_timeout", 30)
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def start(self):
+        """Open the session if it is not open yet."""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, opened on first use if start() was not called."""
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    def post(self, url: str, **kwargs):
+        """Issue a POST on the shared session; use as an async context manager."""
+        return self.session.post(url, **kwargs)
+
+    async def close(self):
+        """Close the session and every pooled connection."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        # A custom connector is owned by the session and closed with it
+        self._connector = None
@@ -1,30 +1,35 @@
-from typing import Dict, List, Any
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from collections import Counter, defaultdict
-import json
-import re
+from typing import Dict, List, Any, Optional, Set
+from collections import Counter, OrderedDict
+from itertools import islice
+from services.memory_service import MemoryService
+from services.heavy_hitters import SpaceSaving
+from services.message_analysis import MessageAnalysis, MessageAnalyzer
+from services.response_rewriter import ResponseRewriter
 
 class LearningService:
-    def __init__(self):
-        # Initialize NLTK resources
-        try:
-            nltk.data.find('tokenizers/punkt')
-            nltk.data.find('corpora/stopwords')
-        except LookupError:
-            nltk.download('punkt')
-            nltk.download('stopwords')
-        
-        self.stop_words = set(stopwords.words('english'))
-        
-        # User-specific data storage
-        self.user_data: Dict[int, Dict[str, Any]] = {}
-        
-        # Initialize default user data structure
-        self.default_user_data = {
+    def __init__(self, memory_service: Optional[MemoryService] = None, settings: Optional[Dict[str, Any]] = None,
+                 analyzer: Optional[MessageAnalyzer] = None):
+        # Shared tokenizer and scorer; pass the same analyzer to every service
+        self.analyzer = analyzer or MessageAnalyzer(settings)
+        self.rewriter = ResponseRewriter((settings or {}).get("rewrite_rules"))
+        
+        # Hot users' data, least recently used first. Everything else lives
+        # in the memory service and is loaded on first access.
+        settings = settings or {}
+        self.memory_service = memory_service
+        self.max_cached_users = settings.get("max_cached_users", 10000)
+        self.max_patterns = settings.get("max_patterns", 5)
+        self.pattern_capacity = settings.get("pattern_capacity", 50)
+        self.user_data: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._dirty_users: Set[int] = set()
+        # Users with a request in flight, never evicted until unpinned
+        self._pinned: Counter = Counter()
+
+    def _default_user_data(self) -> Dict[str, Any]:
+        """Build the data structure for a user we know nothing about."""
+        return {
             "topics": [],           # List of topics the user frequently discusses
-            "patterns": Counter(),  # Common word patterns in user messages
+            "patterns": SpaceSaving(self.pattern_capacity),  # Most frequent word pairs
             "preferences": {        # User preferences learned from interactions
                 "formality": 0.5,   # 0 = casual, 1 = formal
                 "verbosity": 0.5,   # 0 = concise, 1 = detailed
@@ -33,73 +38,155 @@ class LearningService:
             "message_count": 0
         }
 
+    def _serialize(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert user data to a JSON-compatible dict."""
+        return {
+            "topics": user_data["topics"],
+            "patterns": user_data["patterns"].to_list(),
+            "preferences": user_data["preferences"],
+            "message_count": user_data["message_count"]
+        }
+
+    def _deserialize(self, stored: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Rebuild user data from its stored form, filling in missing fields."""
+        user_data = self._default_user_data()
+        if not stored:
+            return user_data
+        user_data["topics"] = list(stored.get("topics", []))
+        user_data["patterns"] = SpaceSaving.from_stored(self.pattern_capacity, stored.get("patterns"))
+        user_data["preferences"].update(stored.get("preferences", {}))
+        user_data["message_count"] = stored.get("message_count", 0)
+        return user_data
+
+    def _cache_user(self, user_id: int, user_data: Dict[str, Any]):
+        """Add a user to the hot cache, evicting the least recently used ones."""
+        self.user_data[user_id] = user_data
+        self.user_data.move_to_end(user_id)
+        excess = len(self.user_data) - self.max_cached_users
+        if excess > 0:
+            # The cache may run over while every other user is pinned, but
+            # never by evicting the user just added, whom the caller reads next
+            evictable = (uid for uid in self.user_data if uid not in self._pinned and uid != user_id)
+            for evicted_id in list(islice(evictable, excess)):
+                self._persist(evicted_id, self.user_data.pop(evicted_id))
+
+    def pin(self, user_id: int):
+        """Keep a user cached across awaits until the matching unpin.
+
+        A user evicted mid-request would be recreated from the defaults by
+        the next synchronous call, and that copy would later overwrite the
+        stored one.
+        """
+        self._pinned[user_id] += 1
+
+    def unpin(self, user_id: int):
+        """Release a pin; the user becomes evictable again once none remain."""
+        self._pinned[user_id] -= 1
+        if self._pinned[user_id] <= 0:
+            del self._pinned[user_id]
+
+    def _persist(self, user_id: int, user_data: Dict[str, Any]):
+        """Hand a dirty user's data to the memory service write buffer."""
+        if user_id in self._dirty_users:
+            self._dirty_users.discard(user_id)
+            if self.memory_service:
+                self.memory_service.queue_user_preferences(user_id, self._serialize(user_data))
+
+    async def load_user(self, user_id: int):
+        """Make sure a user's learned data is cached, loading it on first access."""
+        if user_id in self.user_data:
+            self.user_data.move_to_end(user_id)
+            return
+
+        stored = None
+        if self.memory_service:
+            stored = await self.memory_service.get_user_preferences(user_id)
+        # Another handler may have loaded the user while we were waiting
+        if user_id not in self.user_data:
+            self._cache_user(user_id, self._deserialize(stored))
+
+    def flush(self):
+        """Hand every dirty user to the memory service write buffer."""
+        for user_id in list(self._dirty_users):
+            self._persist(user_id, self.user_data[user_id])
+
     def _initialize_user(self, user_id: int):
         """Initialize data structure for a new user."""
-        if user_id not in self.user_data:
-            self.user_data[user_id] = json.loads(json.dumps(self.default_user_data))
-
-    def _extract_topics(self, text: str) -> List[str]:
-        """Extract potential topics from text."""
-        # Tokenize and remove stopwords
-        tokens = word_tokenize(text.lower())
-        tokens = [token for token in tokens if token not in self.stop_words 
-                 and token.isalnum() and len(token) > 2]
-        
-        # Count word frequencies
-        word_freq = Counter(tokens)
+        if user_id in self.user_data:
+            self.user_data.move_to_end(user_id)
+        else:
+            self._cache_user(user_id, self._default_user_data())
+
+    def _extract_topics(self, analysis: MessageAnalysis) -> List[str]:
+        """Extract potential topics from a message."""
+        # Count content word frequencies
+        word_freq = Counter(analysis.content_tokens)
         
         # Return most common words as topics
         return [word for word, count in word_freq.most_common(3) if count > 1]
 
-    def _analyze_patterns(self, text: str) -> Counter:
-        """Analyze text for common patterns."""
-        # Extract word pairs (bigrams)
-        tokens = word_tokenize(text.lower())
-        pairs = [f"{tokens[i]} {tokens[i+1]}" for i in range(len(tokens)-1)]
-        
-        return Counter(pairs)
+    def _analyze_patterns(self, analysis: MessageAnalysis) -> Counter:
+        """Analyze a message for common patterns."""
+        # Word pairs (bigrams) are counted by the analyzer
+        return analysis.bigrams
 
-    def _update_preferences(self, text: str, user_data: Dict[str, Any]):
+    def _update_preferences(self, analysis: MessageAnalysis, user_data: Dict[str, Any]):
         """Update user preferences based on message content."""
         # Update formality preference
-        formal_indicators = len(re.findall(r'\b(please|kindly|would|could|may|regarding)\b', text.lower()))
-        casual_indicators = len(re.findall(r'\b(hey|hi|yeah|cool|awesome|gonna|wanna)\b', text.lower()))
-        
-        if formal_indicators > casual_indicators:
+        if analysis.formal_count > analysis.casual_count:
             user_data["preferences"]["formality"] = min(1.0, user_data["preferences"]["formality"] + 0.05)
-        elif casual_indicators > formal_indicators:
+        elif analysis.casual_count > analysis.formal_count:
             user_data["preferences"]["formality"] = max(0.0, user_data["preferences"]["formality"] - 0.05)
         
         # Update verbosity preference
-        words_per_sentence = len(text.split()) / max(1, len(text.split('.')))
-        if words_per_sentence > 15:
+        if analysis.words_per_sentence > 15:
             user_data["preferences"]["verbosity"] = min(1.0, user_data["preferences"]["verbosity"] + 0.05)
-        elif words_per_sentence < 8:
+        elif analysis.words_per_sentence < 8:
             user_data["preferences"]["verbosity"] = max(0.0, user_data["preferences"]["verbosity"] - 0.05)
         
         # Update technicality preference
-        technical_words = len(re.findall(r'\b(api|function|code|data|system|process|technical)\b', text.lower()))
-        if technical_words > 0:
+        if analysis.technical_count > 0:
             user_data["preferences"]["technicality"] = min(1.0, user_data["preferences"]["technicality"] + 0.05)
 
-    def process_message(self, user_id: int, message: str) -> Dict[str, Any]:
-        """Process a user message and update learning data."""
-        self._initialize_user(user_id)
-        user_data = self.user_data[user_id]
-        
+    def _learn(self, analysis: MessageAnalysis, user_data: Dict[str, Any]):
+        """Fold one analyzed message into a user's learning data."""
         # Extract and update topics
-        new_topics = self._extract_topics(message)
+        new_topics = self._extract_topics(analysis)
         user_data["topics"].extend(new_topics)
         user_data["topics"] = list(set(user_data["topics"]))[-10:]  # Keep last 10 unique topics
         
         # Update pattern frequencies
-        user_data["patterns"].update(self._analyze_patterns(message))
+        user_data["patterns"].update(self._analyze_patterns(analysis))
         
         # Update preferences
-        self._update_preferences(message, user_data)
+        self._update_preferences(analysis, user_data)
         
         # Increment message count
         user_data["message_count"] += 1
+
+    def process_message(self, user_id: int, message: str, analysis: Optional[MessageAnalysis] = None) -> Dict[str, Any]:
+        """Process a user message and update learning data.
+
+        Pass the message's analysis when it has already been computed to
+        avoid analyzing the text again.
+        """
+        self._initialize_user(user_id)
+        if analysis is None:
+            analysis = self.analyzer.analyze(message)
+        
+        self._learn(analysis, self.user_data[user_id])
+        self._dirty_users.add(user_id)
+        
+        return self.get_response_context(user_id)
+
+    def process_batch(self, user_id: int, analyses: List[MessageAnalysis]) -> Dict[str, Any]:
+        """Fold several analyzed messages into a user's data in one pass."""
+        self._initialize_user(user_id)
+        user_data = self.user_data[user_id]
+        for analysis in analyses:
+            self._learn(analysis, user_data)
+        if analyses:
+            self._dirty_users.add(user_id)
         
         return self.get_response_context(user_id)
 
@@ -110,49 +197,48 @@ class LearningService:
         
         return {
             "topics": user_data["topics"],
-            "patterns": dict(user_data["patterns"].most_common(5)),
+            "patterns": dict(user_data["patterns"].most_common(self.max_patterns)),
             "preferences": user_data["preferences"],
             "message_count": user_data["message_count"]
         }
 
-    def adapt_response(self, user_id: int, response: str) -> str:
-        """Adapt a response based on learned user preferences."""
+    def adapt_response(self, user_id: int, response: str, final: bool = True) -> str:
+        """Adapt a response based on learned user preferences.
+
+        Pass final=False for a streamed response that is still growing.
+        Shortening keeps every other sentence, so it is not stable as text
+        is appended; it is left for the final text.
+        """
         self._initialize_user(user_id)
         prefs = self.user_data[user_id]["preferences"]
         
-        # Adjust response based on formality preference
+        # Pick the word substitution buckets for this user
+        buckets = []
         if prefs["formality"] > 0.7:
-            response = response.replace("yeah", "yes")
-            response = response.replace("nope", "no")
-            response = response.replace("gonna", "going to")
-            response = response.replace("wanna", "want to")
+            buckets.append("formal")
         elif prefs["formality"] < 0.3:
-            response = response.replace("certainly", "sure")
-            response = response.replace("additionally", "also")
-            response = response.replace("however", "but")
+            buckets.append("casual")
+        if prefs["technicality"] > 0.7:
+            # Add more technical details or terminology
+            buckets.append("technical")
+        elif prefs["technicality"] < 0.3:
+            # Simplify technical terms
+            buckets.append("simple")
+        
+        # Apply all substitutions in a single pass over the response
+        if buckets:
+            response = self.rewriter.rewrite(response, tuple(buckets))
         
         # Adjust response based on verbosity preference
-        if prefs["verbosity"] < 0.3 and len(response) > 100:
+        if final and prefs["verbosity"] < 0.3 and len(response) > 100:
             # Attempt to make response more concise
             sentences = response.split('. ')
             if len(sentences) > 1:
                 response = '. '.join(sentences[::2]) + '.'
         
-        # Adjust response based on technicality preference
-        if prefs["technicality"] > 0.7:
-            # Add more technical details or terminology
-            response = response.replace("use", "utilize")
-            response = response.replace("make", "implement")
-            response = response.replace("fix", "resolve")
-        elif prefs["technicality"] < 0.3:
-            # Simplify technical terms
-            response = response.replace("utilize", "use")
-            response = response.replace("implement", "make")
-            response = response.replace("resolve", "fix")
-        
         return response
 
     def clear_user_data(self, user_id: int):
         """Clear all learned data for a user."""
-        if user_id in self.user_data:
-            self.user_data[user_id] = json.loads(json.dumps(self.default_user_data))
+        self.user_data.pop(user_id, None)
+        self._dirty_users.discard(user_id)
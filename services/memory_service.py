@@ -1,154 +1,433 @@
-import aiosqlite
-from datetime import datetime
+import ast
+import asyncio
+import json
+import logging
+import re
+from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
+from services.connection_pool import ConnectionPool
+from services.migrations import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+# Statements are kept as constants so every call hands sqlite3 the exact same
+# SQL text and hits the per-connection prepared statement cache.
+INSERT_MEMORY = "INSERT INTO memories (user_id, content, type, importance, created_at) VALUES (?, ?, ?, ?, ?)"
+SELECT_MEMORIES = "SELECT * FROM memories WHERE user_id = ? ORDER BY importance DESC, created_at DESC LIMIT ?"
+SELECT_MEMORIES_BY_TYPE = "SELECT * FROM memories WHERE user_id = ? AND type = ? ORDER BY importance DESC, created_at DESC LIMIT ?"
+DELETE_MEMORY = "DELETE FROM memories WHERE id = ? AND user_id = ?"
+INSERT_INTERACTION = "INSERT INTO interaction_history (user_id, message, response, created_at, learned) VALUES (?, ?, ?, ?, ?)"
+SELECT_RECENT_INTERACTIONS = "SELECT * FROM interaction_history WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?"
+UPSERT_USER_PREFERENCES = """INSERT INTO user_preferences (user_id, preferences) 
+                   VALUES (?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET 
+                   preferences = excluded.preferences,
+                   updated_at = CURRENT_TIMESTAMP"""
+SELECT_USER_PREFERENCES = "SELECT preferences FROM user_preferences WHERE user_id = ?"
+SELECT_INTERACTIONS_AFTER = "SELECT id, message, response, learned FROM interaction_history WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?"
+SELECT_UNLEARNED_USERS = """SELECT h.user_id, MAX(h.id) FROM interaction_history h
+                   LEFT JOIN sync_state s ON s.user_id = h.user_id
+                   WHERE h.id > ? AND h.learned = 0 AND h.id > COALESCE(s.last_interaction_id, 0)
+                   GROUP BY h.user_id LIMIT ?"""
+SELECT_SYNC_WATERMARK = "SELECT last_interaction_id FROM sync_state WHERE user_id = ?"
+UPSERT_SYNC_WATERMARK = """INSERT INTO sync_state (user_id, last_interaction_id)
+                   VALUES (?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                   last_interaction_id = max(last_interaction_id, excluded.last_interaction_id),
+                   updated_at = CURRENT_TIMESTAMP"""
+SELECT_CACHED_RESPONSE = "SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?"
+UPSERT_CACHED_RESPONSE = """INSERT INTO response_cache (key, response, expires_at)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                   response = excluded.response,
+                   expires_at = excluded.expires_at"""
+DELETE_EXPIRED_RESPONSES = """DELETE FROM response_cache WHERE rowid IN
+                   (SELECT rowid FROM response_cache WHERE expires_at <= ? LIMIT ?)"""
+UPSERT_PERSONALITY = """INSERT INTO user_personality (user_id, state)
+                   VALUES (?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                   state = excluded.state,
+                   updated_at = CURRENT_TIMESTAMP"""
+SELECT_PERSONALITY = "SELECT state FROM user_personality WHERE user_id = ?"
+# Best matches from both FTS indexes in one round trip. Terms are scoped to
+# the user ("u42_word"), so only the user's posting lists are read; bm25()
+# ranks just the ?3 newest matching rows of each index, which the rowid
+# bound taken from a cheap rowid-ordered scan of the matches selects.
+SEARCH_RELEVANT = """SELECT * FROM (
+                         SELECT 'memory' AS source, m.id, m.content, NULL AS response,
+                                m.type, m.importance, m.created_at, bm25(memories_fts) AS score
+                         FROM memories_fts JOIN memories m ON m.id = memories_fts.rowid
+                         WHERE memories_fts MATCH ?1 AND memories_fts.rowid >= COALESCE(
+                             (SELECT rowid FROM memories_fts WHERE memories_fts MATCH ?1
+                              ORDER BY rowid DESC LIMIT 1 OFFSET ?3), 0)
+                         ORDER BY score LIMIT ?2)
+                     UNION ALL
+                     SELECT * FROM (
+                         SELECT 'interaction' AS source, h.id, h.message AS content, h.response,
+                                'interaction' AS type, NULL AS importance, h.created_at,
+                                bm25(interaction_fts) AS score
+                         FROM interaction_fts JOIN interaction_history h ON h.id = interaction_fts.rowid
+                         WHERE interaction_fts MATCH ?1 AND interaction_fts.rowid >= COALESCE(
+                             (SELECT rowid FROM interaction_fts WHERE interaction_fts MATCH ?1
+                              ORDER BY rowid DESC LIMIT 1 OFFSET ?3), 0)
+                         ORDER BY score LIMIT ?2)
+                     ORDER BY score LIMIT ?2"""
+
+# Words as the search index sees them: only a word at the start of the text
+# or after one of SEARCH_WORD_BREAKS in migrations carries the owner prefix
+SEARCH_TERM_PATTERN = re.compile(r"""(?:^|(?<=[ \t\r\n"(\['*,./:;!?)\]-]))\w{3,}""")
+# Longer words are rarer and cheaper to match; a few of them find the rows
+MAX_SEARCH_TERMS = 4
+# Matching rows of each index ranked by BM25, newest first
+SEARCH_WINDOW = 32
+# Words so common that matching on them only makes ranking slower
+SEARCH_STOP_WORDS = frozenset("""
+    the and you your for are was were that this with have has had not but all any can
+    her his him she they them their what when where which who why how will would could
+    should there here from into about just like been being some than then also very
+    more most much our out one get got its it's did does don't i'm let me my
+""".split())
+
+def _timestamp() -> str:
+    """Current UTC time in the format SQLite uses for CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
 class MemoryService:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, pool_settings: Optional[Dict[str, Any]] = None,
+                 write_settings: Optional[Dict[str, Any]] = None):
         self.db_path = db_path
         self.initialized = False
+        self.schema_version = 0
+        self._init_lock = asyncio.Lock()
+        self.pool = ConnectionPool(db_path, **(pool_settings or {}))
+
+        # Write-behind buffers, flushed together in a single transaction
+        write_settings = write_settings or {}
+        self.batch_size = write_settings.get("batch_size", 64)
+        self.flush_interval = write_settings.get("flush_interval", 1.0)
+        self._pending_memories: List[tuple] = []
+        self._pending_interactions: List[tuple] = []
+        self._pending_preferences: Dict[int, str] = {}
+        self._pending_personalities: Dict[int, bytes] = {}
+        # Preferences and personalities of the batch being written, still
+        # served until it commits
+        self._flushing_preferences: Dict[int, str] = {}
+        self._flushing_personalities: Dict[int, bytes] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_requested = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flush_count = 0
+        self.flushed_rows = 0
 
     async def initialize(self):
-        """Initialize the database and create tables if they don't exist."""
+        """Bring the database schema up to date and start the write-behind flusher."""
         if self.initialized:
             return
 
-        async with aiosqlite.connect(self.db_path) as db:
-            # Create memories table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    content TEXT NOT NULL,
-                    type TEXT NOT NULL,
-                    importance REAL DEFAULT 1.0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # Create interaction_history table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS interaction_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    message TEXT NOT NULL,
-                    response TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # Create user_preferences table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS user_preferences (
-                    user_id INTEGER PRIMARY KEY,
-                    preferences TEXT NOT NULL,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            await db.commit()
+        async with self._init_lock:
+            if self.initialized:
+                return
+
+            async with self.pool.writer() as db:
+                self.schema_version = await apply_migrations(db)
+
             self.initialized = True
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Flush buffered writes and close the pooled database connections."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self.pool.close()
+        self.initialized = False
+
+    def pending_writes(self) -> int:
+        """Number of buffered rows that have not been committed yet."""
+        return (len(self._pending_memories) + len(self._pending_interactions)
+                + len(self._pending_preferences) + len(self._pending_personalities))
+
+    def metrics(self) -> Dict[str, Any]:
+        """Write-behind buffer depth and flush counters."""
+        return {
+            "pending_writes": self.pending_writes(),
+            "flushes": self.flush_count,
+            "flushed_rows": self.flushed_rows
+        }
+
+    async def _flush_for(self, pending: List[tuple], user_id: int):
+        """Flush before a read only if user_id has rows in the pending list.
+
+        Other users' buffered rows cannot change the result, so they are left
+        for the flusher instead of turning every read into a commit.
+        """
+        if any(row[0] == user_id for row in pending):
+            await self.flush()
+
+    def _request_flush(self):
+        """Wake the flusher early once a full batch has been buffered."""
+        if self.pending_writes() >= self.batch_size:
+            self._flush_requested.set()
+
+    async def _flush_loop(self):
+        """Flush buffered writes every interval or as soon as a batch fills up."""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing buffered writes: {str(e)}")
+
+    async def flush(self) -> int:
+        """Commit every buffered insert in one transaction and return the row count."""
+        async with self._flush_lock:
+            memories, self._pending_memories = self._pending_memories, []
+            interactions, self._pending_interactions = self._pending_interactions, []
+            preferences, self._pending_preferences = self._pending_preferences, {}
+            personalities, self._pending_personalities = self._pending_personalities, {}
+            if not memories and not interactions and not preferences and not personalities:
+                return 0
+
+            self._flushing_preferences = preferences
+            self._flushing_personalities = personalities
+            try:
+                async with self.pool.transaction() as db:
+                    if memories:
+                        await db.executemany(INSERT_MEMORY, memories)
+                    if interactions:
+                        await db.executemany(INSERT_INTERACTION, interactions)
+                    if preferences:
+                        await db.executemany(UPSERT_USER_PREFERENCES, list(preferences.items()))
+                    if personalities:
+                        await db.executemany(UPSERT_PERSONALITY, list(personalities.items()))
+            except BaseException:
+                # Put the rows back in front of anything buffered meanwhile
+                self._pending_memories[:0] = memories
+                self._pending_interactions[:0] = interactions
+                self._pending_preferences = {**preferences, **self._pending_preferences}
+                self._pending_personalities = {**personalities, **self._pending_personalities}
+                raise
+            finally:
+                self._flushing_preferences = {}
+                self._flushing_personalities = {}
+
+            rows = len(memories) + len(interactions) + len(preferences) + len(personalities)
+            self.flush_count += 1
+            self.flushed_rows += rows
+            return rows
 
     async def store_memory(self, user_id: int, content: str, memory_type: str, importance: float = 1.0) -> bool:
-        """Store a new memory."""
-        await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT INTO memories (user_id, content, type, importance) VALUES (?, ?, ?, ?)",
-                (user_id, content, memory_type, importance)
-            )
-            await db.commit()
-            return True
+        """Buffer a new memory for the next flush."""
+        await self.initialize()
+        self._pending_memories.append((user_id, content, memory_type, importance, _timestamp()))
+        self._request_flush()
+        return True
 
     async def get_memories(self, user_id: int, memory_type: str = None, limit: int = 10) -> List[Dict[str, Any]]:
         """Retrieve memories for a user."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        await self._flush_for(self._pending_memories, user_id)
+        async with self.pool.reader() as db:
             if memory_type:
-                cursor = await db.execute(
-                    "SELECT * FROM memories WHERE user_id = ? AND type = ? ORDER BY importance DESC, created_at DESC LIMIT ?",
-                    (user_id, memory_type, limit)
-                )
+                cursor = await db.execute(SELECT_MEMORIES_BY_TYPE, (user_id, memory_type, limit))
             else:
-                cursor = await db.execute(
-                    "SELECT * FROM memories WHERE user_id = ? ORDER BY importance DESC, created_at DESC LIMIT ?",
-                    (user_id, limit)
-                )
+                cursor = await db.execute(SELECT_MEMORIES, (user_id, limit))
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+    def _search_query(self, user_id: int, text: str) -> Optional[str]:
+        """Build an FTS5 query matching the longest words of text among the user's rows."""
+        words = (word.lower() for word in SEARCH_TERM_PATTERN.findall(text))
+        terms = list(dict.fromkeys(word for word in words if word not in SEARCH_STOP_WORDS))
+        if not terms:
+            return None
+        terms = sorted(terms, key=len, reverse=True)[:MAX_SEARCH_TERMS]
+        return " OR ".join(f'"u{int(user_id)}_{term}"' for term in terms)
+
+    async def search_relevant(self, user_id: int, text: str, k: int = 3) -> List[Dict[str, Any]]:
+        """Return the k memories and past interactions that best match text by BM25.
+
+        Results carry a "source" of "memory" or "interaction"; for interactions
+        "content" is the user's message. Lower scores are better matches. Only
+        the SEARCH_WINDOW newest matches of each kind are ranked. Rows still in
+        the write-behind buffer become searchable at the next flush.
+        """
+        await self.initialize()
+        query = self._search_query(user_id, text)
+        if query is None:
+            return []
+
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SEARCH_RELEVANT, (query, k, SEARCH_WINDOW))
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
 
     async def delete_memory(self, user_id: int, memory_id: int) -> bool:
         """Delete a specific memory."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "DELETE FROM memories WHERE id = ? AND user_id = ?",
-                (memory_id, user_id)
-            )
-            await db.commit()
+        await self._flush_for(self._pending_memories, user_id)
+        async with self.pool.transaction() as db:
+            cursor = await db.execute(DELETE_MEMORY, (memory_id, user_id))
             return cursor.rowcount > 0
 
-    async def store_interaction(self, user_id: int, message: str, response: str) -> bool:
-        """Store an interaction in the history."""
+    async def store_interaction(self, user_id: int, message: str, response: str, learned: bool = False) -> bool:
+        """Buffer an interaction for the next flush.
+
+        Set learned when the message has already been through the learning
+        services, so an incremental sync does not count it twice.
+        """
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT INTO interaction_history (user_id, message, response) VALUES (?, ?, ?)",
-                (user_id, message, response)
-            )
-            await db.commit()
-            return True
+        self._pending_interactions.append((user_id, message, response, _timestamp(), int(learned)))
+        self._request_flush()
+        return True
 
     async def get_recent_interactions(self, user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
         """Get recent interactions for a user."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                "SELECT * FROM interaction_history WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-                (user_id, limit)
-            )
+        await self._flush_for(self._pending_interactions, user_id)
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_RECENT_INTERACTIONS, (user_id, limit))
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
 
-    async def store_user_preferences(self, user_id: int, preferences: dict) -> bool:
-        """Store user preferences."""
+    async def get_interactions_after(self, user_id: int, after_id: int, limit: int = 200) -> List[Dict[str, Any]]:
+        """Get a user's interactions with an id above after_id, oldest first."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT INTO user_preferences (user_id, preferences) 
-                   VALUES (?, ?)
-                   ON CONFLICT(user_id) DO UPDATE SET 
-                   preferences = excluded.preferences,
-                   updated_at = CURRENT_TIMESTAMP""",
-                (user_id, str(preferences))
-            )
-            await db.commit()
+        await self._flush_for(self._pending_interactions, user_id)
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_INTERACTIONS_AFTER, (user_id, after_id, limit))
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+    async def get_unlearned_users(self, after_id: int, limit: int = 100) -> List[tuple]:
+        """List (user_id, newest id) for users with unlearned interactions above after_id
+        and above their own sync watermark."""
+        await self.initialize()
+        # Only unlearned rows can add users; handle_message stores learned ones
+        if any(not row[4] for row in self._pending_interactions):
+            await self.flush()
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_UNLEARNED_USERS, (after_id, limit))
+            return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_sync_watermark(self, user_id: int) -> int:
+        """Get the id of the last interaction the sync has scanned for a user."""
+        await self.initialize()
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_SYNC_WATERMARK, (user_id,))
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+    async def set_sync_watermark(self, user_id: int, interaction_id: int) -> bool:
+        """Advance a user's sync watermark; it never moves backwards."""
+        await self.initialize()
+        async with self.pool.transaction() as db:
+            await db.execute(UPSERT_SYNC_WATERMARK, (user_id, interaction_id))
+            return True
+
+    async def get_cached_response(self, key: str, now: float) -> Optional[tuple]:
+        """Get (response, expires_at) for an unexpired response cache entry."""
+        await self.initialize()
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_CACHED_RESPONSE, (key, now))
+            row = await cursor.fetchone()
+            return tuple(row) if row else None
+
+    async def store_cached_response(self, key: str, response: str, expires_at: float) -> bool:
+        """Store or replace a response cache entry."""
+        await self.initialize()
+        async with self.pool.transaction() as db:
+            await db.execute(UPSERT_CACHED_RESPONSE, (key, response, expires_at))
             return True
 
+    async def delete_expired_responses(self, now: float, limit: int = 500) -> int:
+        """Delete up to limit expired response cache entries, return the count."""
+        await self.initialize()
+        async with self.pool.transaction() as db:
+            cursor = await db.execute(DELETE_EXPIRED_RESPONSES, (now, limit))
+            return cursor.rowcount
+
+    def queue_user_preferences(self, user_id: int, preferences: dict):
+        """Buffer user preferences for the next flush without awaiting.
+
+        Safe to call from synchronous code; a newer value for the same user
+        replaces the buffered one.
+        """
+        self._pending_preferences[user_id] = json.dumps(preferences)
+        self._request_flush()
+
+    async def store_user_preferences(self, user_id: int, preferences: dict) -> bool:
+        """Buffer user preferences for the next flush."""
+        await self.initialize()
+        self.queue_user_preferences(user_id, preferences)
+        return True
+
     async def get_user_preferences(self, user_id: int) -> Optional[dict]:
         """Retrieve user preferences."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                "SELECT preferences FROM user_preferences WHERE user_id = ?",
-                (user_id,)
-            )
+        if user_id in self._pending_preferences:
+            return json.loads(self._pending_preferences[user_id])
+        # A flush in progress has taken the value out of the buffer but not
+        # committed it yet; the stored row would be stale
+        if user_id in self._flushing_preferences:
+            return json.loads(self._flushing_preferences[user_id])
+
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_USER_PREFERENCES, (user_id,))
             row = await cursor.fetchone()
             if row:
                 try:
-                    return eval(row['preferences'])  # Convert string back to dict
-                except:
+                    return json.loads(row['preferences'])
+                except ValueError:
+                    pass
+                # Rows written before preferences were stored as JSON hold a
+                # Python dict repr; read them without evaluating code.
+                try:
+                    return ast.literal_eval(row['preferences'])
+                except (ValueError, SyntaxError):
                     return {}
             return None
 
+    def queue_personality(self, user_id: int, record: bytes):
+        """Buffer a packed personality record for the next flush without awaiting."""
+        self._pending_personalities[user_id] = record
+        self._request_flush()
+
+    async def get_personality(self, user_id: int) -> Optional[bytes]:
+        """Retrieve a user's packed personality record."""
+        await self.initialize()
+        if user_id in self._pending_personalities:
+            return self._pending_personalities[user_id]
+        if user_id in self._flushing_personalities:
+            return self._flushing_personalities[user_id]
+
+        async with self.pool.reader() as db:
+            cursor = await db.execute(SELECT_PERSONALITY, (user_id,))
+            row = await cursor.fetchone()
+            return bytes(row['state']) if row else None
+
     async def clear_user_data(self, user_id: int) -> bool:
         """Clear all data for a specific user."""
         await self.initialize()
-        async with aiosqlite.connect(self.db_path) as db:
+        # Drop buffered rows so a later flush cannot resurrect them
+        async with self._flush_lock:
+            self._pending_memories = [row for row in self._pending_memories if row[0] != user_id]
+            self._pending_interactions = [row for row in self._pending_interactions if row[0] != user_id]
+            self._pending_preferences.pop(user_id, None)
+            self._pending_personalities.pop(user_id, None)
+        async with self.pool.transaction() as db:
             await db.execute("DELETE FROM memories WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM interaction_history WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
-            await db.commit()
+            await db.execute("DELETE FROM sync_state WHERE user_id = ?", (user_id,))
+            await db.execute("DELETE FROM user_personality WHERE user_id = ?", (user_id,))
             return True
@@ -0,0 +1,144 @@
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUESTION_WORDS = frozenset(["why", "how", "what", "when", "where"])
+NEUTRAL_SENTIMENT = {"neg": 0.0, "neu": 1.0, "pos": 0.0, "compound": 0.0}
+
+class MessageAnalysis:
+    """Everything the services need to know about one message, computed once."""
+
+    def __init__(self, text: str, tokens: List[str], content_tokens: List[str],
+                 bigrams: Counter, indicator_counts: Dict[str, int],
+                 words_per_sentence: float, sentiment: Dict[str, float]):
+        self.text = text
+        self.tokens = tokens                  # Lowercased word_tokenize output
+        self.content_tokens = content_tokens  # Tokens without stopwords or punctuation
+        self.bigrams = bigrams                # Adjacent token pairs and their counts
+        self.indicator_counts = indicator_counts
+        self.words_per_sentence = words_per_sentence
+        self.sentiment = sentiment            # VADER polarity scores
+
+    @property
+    def formal_count(self) -> int:
+        return self.indicator_counts["formal"]
+
+    @property
+    def casual_count(self) -> int:
+        return self.indicator_counts["casual"]
+
+    @property
+    def technical_count(self) -> int:
+        return self.indicator_counts["technical"]
+
+    @property
+    def has_question_word(self) -> bool:
+        return not QUESTION_WORDS.isdisjoint(self.tokens)
+
+class MessageAnalyzer:
+    """Tokenizes, normalizes and scores a message in a single pass.
+
+    The result is shared by LearningService and PersonalityService so the
+    NLTK tokenizer, the indicator scan and VADER run once per message.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None, data_dir: Optional[str] = None):
+        settings = settings or {}
+        self.settings = settings
+
+        # NLTK and its resources are loaded on first use (or by warm_up) from
+        # the local data directory; they are never downloaded at runtime
+        self.data_dir = data_dir
+        self._resources_lock = threading.Lock()
+        self._tokenize = None
+        self.stop_words = set()
+        self.sentiment_analyzer = None
+
+        # One alternation with a named group per category, so a single scan
+        # of the text counts formal, casual and technical words together
+        categories = {
+            "formal": settings.get("formal_indicators", ["please", "kindly", "would", "could", "may", "regarding"]),
+            "casual": settings.get("casual_indicators", ["hey", "hi", "yeah", "cool", "awesome", "gonna", "wanna"]),
+            "technical": settings.get("technical_keywords", ["api", "function", "code", "data", "system", "process", "technical"])
+        }
+        alternatives = "|".join(
+            f"(?P<{name}>{'|'.join(map(re.escape, words))})" for name, words in categories.items()
+        )
+        self.indicator_pattern = re.compile(rf"\b(?:{alternatives})\b")
+        self.indicator_names = list(categories)
+
+    def _load_resources(self):
+        """Import NLTK and load the tokenizer, stopwords and VADER lexicon."""
+        import nltk
+        from nltk.tokenize import word_tokenize
+
+        if self.data_dir and self.data_dir not in nltk.data.path:
+            nltk.data.path.insert(0, self.data_dir)
+
+        try:
+            word_tokenize("warm up")
+            tokenize = word_tokenize
+        except LookupError:
+            # Without the punkt models, skip sentence splitting; the word
+            # tokenizer itself needs no data files
+            logger.warning("NLTK punkt models not found; run setup_nltk.py. Tokenizing without sentence splitting.")
+            tokenize = lambda text: word_tokenize(text, preserve_line=True)
+
+        try:
+            from nltk.corpus import stopwords
+            self.stop_words = set(stopwords.words('english'))
+        except LookupError:
+            logger.warning("NLTK stopwords not found; run setup_nltk.py. Topics will include stopwords.")
+
+        try:
+            from nltk.sentiment import SentimentIntensityAnalyzer
+            self.sentiment_analyzer = SentimentIntensityAnalyzer()
+        except LookupError:
+            logger.warning("NLTK VADER lexicon not found; run setup_nltk.py. Sentiment will be neutral.")
+
+        self._tokenize = tokenize
+
+    def warm_up(self):
+        """Load the NLTK resources now instead of on the first message."""
+        if self._tokenize is None:
+            with self._resources_lock:
+                if self._tokenize is None:
+                    self._load_resources()
+
+    def analyze(self, text: str) -> MessageAnalysis:
+        """Analyze a message once for every consumer."""
+        self.warm_up()
+        lowered = text.lower()
+        tokens = self._tokenize(lowered)
+        content_tokens = [
+            token for token in tokens
+            if token not in self.stop_words and token.isalnum() and len(token) > 2
+        ]
+        bigrams = Counter(f"{tokens[i]} {tokens[i+1]}" for i in range(len(tokens) - 1))
+
+        indicator_counts = dict.fromkeys(self.indicator_names, 0)
+        for match in self.indicator_pattern.finditer(lowered):
+            indicator_counts[match.lastgroup] += 1
+
+        words_per_sentence = len(text.split()) / max(1, len(text.split('.')))
+
+        return MessageAnalysis(
+            text=text,
+            tokens=tokens,
+            content_tokens=content_tokens,
+            bigrams=bigrams,
+            indicator_counts=indicator_counts,
+            words_per_sentence=words_per_sentence,
+            sentiment=(
+                self.sentiment_analyzer.polarity_scores(text)
+                if self.sentiment_analyzer else dict(NEUTRAL_SENTIMENT)
+            )
+        )
+
+    def analyze_many(self, texts: List[str]) -> List[MessageAnalysis]:
+        """Analyze a batch of messages, e.g. a backlog of stored interactions."""
+        return [self.analyze(text) for text in texts]
@@ -0,0 +1,280 @@
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from fast in-process steps up to slow LLM calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class HistogramChild:
+    """Bucket counts of one label combination."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Counts are kept per bucket and made cumulative when rendered
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.bounds = tuple(sorted(buckets))
+        self.children: Dict[Tuple, HistogramChild] = {}
+
+    def labels(self, *values) -> HistogramChild:
+        """The child for these label values; keep it to skip the lookup on hot paths."""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = HistogramChild(self.bounds)
+        return child
+
+    def observe(self, value: float, *labels):
+        self.labels(*labels).observe(value)
+
+    def samples(self) -> Iterable[str]:
+        for labels, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(child.sum)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {child.count}"
+
+
+class Family:
+    """Samples of one metric produced by a collector when metrics are scraped."""
+
+    def __init__(self, name: str, kind: str, help: str):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.values: List[Tuple[Dict[str, Any], float]] = []
+
+    def add(self, value: float, **labels):
+        self.values.append((labels, value))
+        return self
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values:
+            yield f"{self.name}{_labels(list(labels), list(labels.values()))} {_number(value)}"
+
+
+class MetricsRegistry:
+    """Metrics of the bot, rendered in the Prometheus text format.
+
+    Counters and histograms are updated in place by the code they measure;
+    everything runs on the event loop, so updates need no locking and cost
+    a dict lookup and a few additions. Collectors turn the counters the
+    services already keep into samples only when metrics are scraped.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+        self.collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def collector(self, collect: Callable[[], Iterable[Family]]):
+        """Register a function returning Families, called on every scrape."""
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        families = list(self.metrics.values())
+        for collect in self.collectors:
+            try:
+                families.extend(collect())
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {str(e)}")
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            lines.extend(family.samples())
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Time the stages of one request into a histogram labelled by stage.
+
+    lap(stage) charges the time since the previous lap to stage; a stage
+    may be charged several times, e.g. while a response streams in, and is
+    observed once by finish(), together with the total.
+    """
+
+    __slots__ = ("histogram", "started", "last", "totals")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.started = self.last = time.perf_counter()
+        self.totals: Dict[str, float] = {}
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self, total: str = "total"):
+        for stage, elapsed in self.totals.items():
+            self.histogram.labels(stage).observe(elapsed)
+        self.histogram.labels(total).observe(self.last - self.started)
+
+
+def service_collector(prefix: str, metrics: Callable[[], Dict[str, Any]],
+                      counters: Sequence[str] = ()) -> Callable[[], List[Family]]:
+    """Expose the numbers in a service's metrics() as <prefix>_<key>.
+
+    Keys listed in counters become counters named <prefix>_<key>_total;
+    the other numeric values become gauges. Nested values are skipped.
+    """
+    def collect() -> List[Family]:
+        families = []
+        for key, value in metrics().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            help = key.replace("_", " ").capitalize()
+            if key in counters:
+                families.append(Family(f"{prefix}_{key}_total", "counter", help).add(value))
+            else:
+                families.append(Family(f"{prefix}_{key}", "gauge", help).add(value))
+        return families
+    return collect
+
+
+def router_collector(metrics: Callable[[], Dict[str, Any]], prefix: str = "bot_provider") -> Callable[[], List[Family]]:
+    """Expose ProviderRouter.metrics(): per-provider requests, errors by kind and latency."""
+    def collect() -> List[Family]:
+        snapshot = metrics()
+        requests = Family(f"{prefix}_requests_total", "counter", "Calls made to each provider")
+        errors = Family(f"{prefix}_errors_total", "counter", "Failed provider calls by error kind")
+        latency = Family(f"{prefix}_latency_seconds", "gauge", "Rolling latency quantiles of successful calls")
+        cooling = Family(f"{prefix}_cooling_down", "gauge", "1 while a provider is benched after failures")
+        for name, stats in snapshot["providers"].items():
+            requests.add(stats["requests"], provider=name)
+            for kind, count in stats.get("errors", {}).items():
+                errors.add(count, provider=name, kind=kind)
+            for key, quantile in (("p50", "0.5"), ("p95", "0.95")):
+                if stats[key] is not None:
+                    latency.add(stats[key], provider=name, quantile=quantile)
+            cooling.add(int(stats["cooling_down"]), provider=name)
+        events = Family(f"{prefix}_router_events_total", "counter", "Router failovers and hedged requests")
+        for event in ("failovers", "hedges", "hedge_wins"):
+            events.add(snapshot[event], event=event)
+        return [requests, errors, latency, cooling, events]
+    return collect
+
+
+def labelled_collector(prefix: str, metrics: Callable[[], Dict[str, Dict[str, float]]],
+                       label: str) -> Callable[[], List[Family]]:
+    """Expose {label value: {key: count}} as counters <prefix>_<key>_total{<label>=...}."""
+    def collect() -> List[Family]:
+        families: Dict[str, Family] = {}
+        for value, counts in metrics().items():
+            for key, count in counts.items():
+                family = families.get(key)
+                if family is None:
+                    family = families[key] = Family(f"{prefix}_{key}_total", "counter",
+                                                    key.replace("_", " ").capitalize())
+                family.add(count, **{label: value})
+        return list(families.values())
+    return collect
+
+
+class MetricsServer:
+    """Serve a registry on GET /metrics over HTTP, for Prometheus to scrape."""
+
+    def __init__(self, registry: MetricsRegistry, settings: Optional[Dict[str, Any]] = None):
+        self.registry = registry
+        self.settings = settings or {}
+        self.enabled = self.settings.get("enabled", True)
+        self.host = self.settings.get("host", "127.0.0.1")
+        self.port = self.settings.get("port", 9464)
+        self.path = self.settings.get("path", "/metrics")
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self):
+        if not self.enabled or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            # Metrics are optional; the bot keeps running without them
+            logger.error(f"Error starting metrics endpoint on {self.host}:{self.port}: {str(e)}")
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,322 @@
+import aiosqlite
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+class Migration:
+    def __init__(self, version: int, name: str, statements: List[str], transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        # Some statements (VACUUM, changing auto_vacuum) cannot run inside a
+        # transaction; those migrations only bump the version atomically.
+        self.transactional = transactional
+
+# Word breaks of the search index built by migration 9, which has shipped
+SEARCH_WORD_BREAKS_V9 = ["char(9)", "char(10)", "char(13)", "'\"'", "'('", "'['", "''''", "'*'"]
+# Characters that start a new word in indexed text: whitespace and the
+# punctuation found around words. Keep in step with SEARCH_TERM_PATTERN in
+# memory_service.
+SEARCH_WORD_BREAKS = SEARCH_WORD_BREAKS_V9 + [
+    "','", "'.'", "'-'", "'/'", "':'", "';'", "'!'", "'?'", "')'", "']'"
+]
+
+def _search_text(column: str, row: str = "", breaks: List[str] = SEARCH_WORD_BREAKS_V9) -> str:
+    """SQL expression prefixing every word of column with its owner, e.g. "u42_word".
+
+    row is "new." or "old." inside triggers; breaks are the characters
+    turned into spaces first.
+    """
+    text = f"{row}{column}"
+    for char in breaks:
+        text = f"replace({text}, {char}, ' ')"
+    owner = f"{row}user_id"
+    return f"'u' || {owner} || '_' || replace({text}, ' ', ' u' || {owner} || '_')"
+
+def _search_index_sources(breaks: List[str]) -> List[str]:
+    """Recreate the views and triggers feeding both search indexes, then rebuild them."""
+    statements = []
+    for table, column, view, fts in (("memories", "content", "memories_search", "memories_fts"),
+                                     ("interaction_history", "message", "interaction_search", "interaction_fts")):
+        old, new = _search_text(column, "old.", breaks), _search_text(column, "new.", breaks)
+        statements += [
+            f"DROP TRIGGER IF EXISTS {fts}_insert",
+            f"DROP TRIGGER IF EXISTS {fts}_delete",
+            f"DROP TRIGGER IF EXISTS {fts}_update",
+            f"DROP VIEW IF EXISTS {view}",
+            f"CREATE VIEW {view} AS SELECT id, {_search_text(column, '', breaks)} AS {column} FROM {table}",
+            f"""
+            CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, {new});
+            END
+            """,
+            f"""
+            CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, {old});
+            END
+            """,
+            f"""
+            CREATE TRIGGER {fts}_update AFTER UPDATE OF {column}, user_id ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, {old});
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, {new});
+            END
+            """,
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+    return statements
+
+# Numbered schema migrations for the Python memory store. Append new entries
+# with the next version number; never edit one that has already shipped.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial_schema", [
+        """
+        CREATE TABLE IF NOT EXISTS memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            type TEXT NOT NULL,
+            importance REAL DEFAULT 1.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS interaction_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            response TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id INTEGER PRIMARY KEY,
+            preferences TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # Composite indexes matching the WHERE and ORDER BY of the hot queries, so
+    # get_memories and get_recent_interactions walk the index in order and
+    # stop after LIMIT rows instead of scanning and sorting the table.
+    Migration(2, "hot_path_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_importance ON memories(user_id, importance DESC, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_type_importance ON memories(user_id, type, importance DESC, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_interaction_user_created ON interaction_history(user_id, created_at DESC)",
+        "ANALYZE",
+    ]),
+    # Age-based retention filters on created_at alone
+    Migration(3, "retention_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_memories_created_at ON memories(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_interaction_created_at ON interaction_history(created_at)",
+    ]),
+    # Let the retention job hand free pages back to the filesystem with
+    # PRAGMA incremental_vacuum instead of a blocking full VACUUM.
+    Migration(4, "incremental_auto_vacuum", [
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        "VACUUM",
+    ], transactional=False),
+    # Full-text indexes for relevance-ranked retrieval. The FTS tables read
+    # their rows through views that add an owner token ("u<user_id>"), so a
+    # per-user search intersects posting lists instead of filtering every
+    # match. Triggers keep both indexes in step with the base tables.
+    Migration(5, "relevance_search", [
+        "CREATE VIEW IF NOT EXISTS memories_search AS SELECT id, content, 'u' || user_id AS owner FROM memories",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(content, owner, content='memories_search', content_rowid='id')",
+        """
+        CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+            INSERT INTO memories_fts(rowid, content, owner) VALUES (new.id, new.content, 'u' || new.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+            INSERT INTO memories_fts(memories_fts, rowid, content, owner) VALUES ('delete', old.id, old.content, 'u' || old.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS memories_fts_update AFTER UPDATE OF content, user_id ON memories BEGIN
+            INSERT INTO memories_fts(memories_fts, rowid, content, owner) VALUES ('delete', old.id, old.content, 'u' || old.user_id);
+            INSERT INTO memories_fts(rowid, content, owner) VALUES (new.id, new.content, 'u' || new.user_id);
+        END
+        """,
+        "CREATE VIEW IF NOT EXISTS interaction_search AS SELECT id, message, response, 'u' || user_id AS owner FROM interaction_history",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS interaction_fts USING fts5(message, response, owner, content='interaction_search', content_rowid='id')",
+        """
+        CREATE TRIGGER IF NOT EXISTS interaction_fts_insert AFTER INSERT ON interaction_history BEGIN
+            INSERT INTO interaction_fts(rowid, message, response, owner) VALUES (new.id, new.message, new.response, 'u' || new.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS interaction_fts_delete AFTER DELETE ON interaction_history BEGIN
+            INSERT INTO interaction_fts(interaction_fts, rowid, message, response, owner) VALUES ('delete', old.id, old.message, old.response, 'u' || old.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS interaction_fts_update AFTER UPDATE OF message, response, user_id ON interaction_history BEGIN
+            INSERT INTO interaction_fts(interaction_fts, rowid, message, response, owner) VALUES ('delete', old.id, old.message, old.response, 'u' || old.user_id);
+            INSERT INTO interaction_fts(rowid, message, response, owner) VALUES (new.id, new.message, new.response, 'u' || new.user_id);
+        END
+        """,
+        "INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')",
+        "INSERT INTO interaction_fts(interaction_fts) VALUES ('rebuild')",
+    ]),
+    # Incremental sync: interactions that already went through the learning
+    # services are flagged, and each user's sync watermark records the last
+    # interaction id the sync has scanned.
+    Migration(6, "sync_watermarks", [
+        "ALTER TABLE interaction_history ADD COLUMN learned INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_interaction_user_id ON interaction_history(user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            user_id INTEGER PRIMARY KEY,
+            last_interaction_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # Second tier of the LLM response cache, keyed on a hash of the final
+    # prompt and generation config; expires_at is a Unix timestamp.
+    Migration(7, "response_cache", [
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache(expires_at)",
+    ]),
+    Migration(8, "user_personality", [
+        """
+        CREATE TABLE IF NOT EXISTS user_personality (
+            user_id INTEGER PRIMARY KEY,
+            state BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    # Replace the shared owner token of migration 5 with per-user words
+    # ("u42_word", kept whole by tokenchars '_'). A search then reads only
+    # the user's own posting lists, and bm25() computes IDF over the user's
+    # rows instead of the whole corpus, so its cost no longer grows with
+    # the number of users. Interactions are indexed on the user's message
+    # only; long responses made every common word match most of them.
+    Migration(9, "user_scoped_search", [
+        "DROP TRIGGER IF EXISTS memories_fts_insert",
+        "DROP TRIGGER IF EXISTS memories_fts_delete",
+        "DROP TRIGGER IF EXISTS memories_fts_update",
+        "DROP TRIGGER IF EXISTS interaction_fts_insert",
+        "DROP TRIGGER IF EXISTS interaction_fts_delete",
+        "DROP TRIGGER IF EXISTS interaction_fts_update",
+        "DROP TABLE IF EXISTS memories_fts",
+        "DROP TABLE IF EXISTS interaction_fts",
+        "DROP VIEW IF EXISTS memories_search",
+        "DROP VIEW IF EXISTS interaction_search",
+        f"CREATE VIEW memories_search AS SELECT id, {_search_text('content')} AS content FROM memories",
+        """
+        CREATE VIRTUAL TABLE memories_fts USING fts5(
+            content, content='memories_search', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        f"""
+        CREATE TRIGGER memories_fts_insert AFTER INSERT ON memories BEGIN
+            INSERT INTO memories_fts(rowid, content) VALUES (new.id, {_search_text('content', 'new.')});
+        END
+        """,
+        f"""
+        CREATE TRIGGER memories_fts_delete AFTER DELETE ON memories BEGIN
+            INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.id, {_search_text('content', 'old.')});
+        END
+        """,
+        f"""
+        CREATE TRIGGER memories_fts_update AFTER UPDATE OF content, user_id ON memories BEGIN
+            INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.id, {_search_text('content', 'old.')});
+            INSERT INTO memories_fts(rowid, content) VALUES (new.id, {_search_text('content', 'new.')});
+        END
+        """,
+        f"CREATE VIEW interaction_search AS SELECT id, {_search_text('message')} AS message FROM interaction_history",
+        """
+        CREATE VIRTUAL TABLE interaction_fts USING fts5(
+            message, content='interaction_search', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        f"""
+        CREATE TRIGGER interaction_fts_insert AFTER INSERT ON interaction_history BEGIN
+            INSERT INTO interaction_fts(rowid, message) VALUES (new.id, {_search_text('message', 'new.')});
+        END
+        """,
+        f"""
+        CREATE TRIGGER interaction_fts_delete AFTER DELETE ON interaction_history BEGIN
+            INSERT INTO interaction_fts(interaction_fts, rowid, message) VALUES ('delete', old.id, {_search_text('message', 'old.')});
+        END
+        """,
+        f"""
+        CREATE TRIGGER interaction_fts_update AFTER UPDATE OF message, user_id ON interaction_history BEGIN
+            INSERT INTO interaction_fts(interaction_fts, rowid, message) VALUES ('delete', old.id, {_search_text('message', 'old.')});
+            INSERT INTO interaction_fts(rowid, message) VALUES (new.id, {_search_text('message', 'new.')});
+        END
+        """,
+        "INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')",
+        "INSERT INTO interaction_fts(interaction_fts) VALUES ('rebuild')",
+    ]),
+    # Migration 6 added idx_interaction_user_id after migration 2 had run
+    # ANALYZE. On a database that had rows then, the new index had no
+    # statistics, and the planner preferred it for get_recent_interactions
+    # and sorted the user's whole history. Index-adding migrations must
+    # refresh the statistics like this one. idx_interaction_user_id itself
+    # stays: get_interactions_after seeks it on (user_id, rowid > ?).
+    Migration(10, "refresh_index_statistics", [
+        "ANALYZE",
+    ]),
+    # get_recent_interactions breaks created_at ties by id so turns stored
+    # in the same second keep their order; extend the composite index with
+    # id so the tie-break is read from the index instead of sorted again.
+    # The new index also covers every query the old one served.
+    Migration(11, "recent_interactions_tiebreak_index", [
+        "CREATE INDEX IF NOT EXISTS idx_interaction_user_created_id ON interaction_history(user_id, created_at DESC, id DESC)",
+        "DROP INDEX IF EXISTS idx_interaction_user_created",
+        "ANALYZE",
+    ]),
+    # Migration 9 only started a new word after whitespace, quotes and
+    # opening brackets, so in "pizza,pasta" or "rock-climbing" the second
+    # word had no owner prefix and could never be found. Break words at the
+    # rest of the common punctuation too, and reindex.
+    Migration(12, "search_punctuation_breaks", _search_index_sources(SEARCH_WORD_BREAKS)),
+]
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    """Read the schema version recorded in the database header."""
+    cursor = await db.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return row[0]
+
+async def apply_migrations(db: aiosqlite.Connection, migrations: List[Migration] = MIGRATIONS) -> int:
+    """Apply every migration newer than the recorded version and return the new version."""
+    version = await get_schema_version(db)
+
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= version:
+            continue
+
+        logger.info(f"Applying schema migration {migration.version}: {migration.name}")
+        if not migration.transactional:
+            await db.commit()
+            for statement in migration.statements:
+                await db.execute(statement)
+
+        # sqlite3 does not open transactions for DDL on its own, so begin one
+        # explicitly to make each migration and its version bump atomic.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if migration.transactional:
+                for statement in migration.statements:
+                    await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {int(migration.version)}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        version = migration.version
+
+    return version
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import time
+from multiprocessing import get_context
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional
+from services import nlp_worker
+from services.message_analysis import MessageAnalysis, MessageAnalyzer
+
+logger = logging.getLogger(__name__)
+
+class NLPExecutor:
+    """Runs message analysis off the event loop on a thread or process pool.
+
+    At most max_workers + max_queue batches are submitted at once; callers
+    beyond that wait for a slot, which applies backpressure to the handlers
+    instead of letting the pool queue grow without bound.
+    """
+
+    def __init__(self, analyzer: MessageAnalyzer, settings: Optional[Dict[str, Any]] = None):
+        settings = settings or {}
+        self.analyzer = analyzer
+        self.kind = settings.get("kind", "process")
+        self.max_workers = settings.get("max_workers") or min(4, os.cpu_count() or 1)
+        self.max_queue = settings.get("max_queue", 64)
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def start(self):
+        """Create the worker pool; "inline" runs analysis on the event loop."""
+        if self._executor is not None or self.kind == "inline":
+            return
+        if self.kind == "process":
+            # spawn rather than fork: the parent already runs database threads.
+            # Workers only run nlp_worker; a spawned process also imports the
+            # parent's main module, which is why main.py builds nothing on import
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=get_context("spawn"),
+                initializer=nlp_worker.init,
+                initargs=(self.analyzer.settings, self.analyzer.data_dir)
+            )
+        else:
+            # Threads share the parent's analyzer
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="nlp",
+                initializer=self.analyzer.warm_up
+            )
+
+    async def warm_up(self):
+        """Start every worker and load its NLTK resources ahead of the first message."""
+        loop = asyncio.get_running_loop()
+        if self.kind == "inline":
+            await loop.run_in_executor(None, self.analyzer.warm_up)
+            return
+        self.start()
+        if self.kind == "process":
+            # Processes are spawned on demand; one task per worker starts them all
+            warm_ups = [loop.run_in_executor(self._executor, nlp_worker.warm_up) for _ in range(self.max_workers)]
+            await asyncio.gather(*warm_ups)
+        else:
+            await loop.run_in_executor(self._executor, self.analyzer.warm_up)
+
+    def _restart(self, broken: Executor):
+        """Replace a broken process pool, once however many callers saw it break."""
+        if self._executor is broken:
+            self.restarts += 1
+            logger.warning("NLP worker process died; restarting the pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.start()
+
+    def _submit(self, executor: Executor, texts: List[str]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self.kind == "process":
+            return loop.run_in_executor(executor, nlp_worker.analyze_many, texts)
+        return loop.run_in_executor(executor, self.analyzer.analyze_many, texts)
+
+    def shutdown(self):
+        """Stop the worker pool, cancelling analysis that has not started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def analyze(self, text: str) -> MessageAnalysis:
+        """Analyze one message off the event loop."""
+        return (await self.analyze_many([text]))[0]
+
+    async def analyze_many(self, texts: List[str]) -> List[MessageAnalysis]:
+        """Analyze a batch of messages off the event loop as one work item."""
+        if self.kind == "inline":
+            return self.analyzer.analyze_many(texts)
+        self.start()
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.submitted += 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        executor = self._executor
+        try:
+            try:
+                result = await self._submit(executor, texts)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed) and broke the pool; every
+                # batch in it failed, so start a new pool and retry once
+                self._restart(executor)
+                result = await self._submit(self._executor, texts)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.in_flight -= 1
+            self._slots.release()
+            self.busy_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+        self.completed += 1
+        return result
+
+    def metrics(self) -> Dict[str, Any]:
+        """Snapshot of the executor's counters and queue depth."""
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "restarts": self.restarts,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "avg_seconds": self.busy_seconds / self.completed if self.completed else 0.0,
+            "max_seconds": self.max_seconds
+        }
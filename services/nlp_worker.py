@@ -0,0 +1,22 @@
+import os
+from typing import Dict, Any, List, Optional
+from services.message_analysis import MessageAnalysis, MessageAnalyzer
+
+# Entry points of the NLP worker processes. They live apart from the
+# executor so that what a worker imports stays down to the analyzer.
+
+# Analyzer owned by this worker process, built once by the pool initializer
+analyzer: Optional[MessageAnalyzer] = None
+
+def init(settings: Optional[Dict[str, Any]], data_dir: Optional[str]):
+    """Load the NLTK resources of a worker process before it takes work."""
+    global analyzer
+    analyzer = MessageAnalyzer(settings, data_dir)
+    analyzer.warm_up()
+
+def warm_up() -> int:
+    """Return the worker's pid; running it at all has started the worker."""
+    return os.getpid()
+
+def analyze_many(texts: List[str]) -> List[MessageAnalysis]:
+    return analyzer.analyze_many(texts)
@@ -1,37 +1,65 @@
 import json
-import aiohttp
-from typing import List, Dict, Any
+import logging
+from typing import List, Dict, Any, Optional
 from config.config import OPENROUTER_API_URL, OPENROUTER_HEADERS, MODEL_NAME
+from services.http_client import HTTPClient
+from services.provider_router import ProviderError, ProviderHTTPError
+from services.rate_limiter import parse_retry_after
 
-async def generate_response(messages: List[Dict[str, str]]) -> str:
-    """
-    Generate a response using the OpenRouter API.
-    """
+logger = logging.getLogger(__name__)
+
+# Shared HTTP client, set on startup
+http_client: Optional[HTTPClient] = None
+
+def init_http_client(client: Optional[HTTPClient] = None):
+    """Set the HTTP client used for OpenRouter requests."""
+    global http_client
+    http_client = client or HTTPClient()
+
+async def request_text(messages: List[Dict[str, str]]) -> Optional[str]:
+    """Send a conversation to the OpenRouter API and return the generated text, if any."""
     payload = {
         "model": MODEL_NAME,
         "messages": messages
     }
     
+    async with http_client.post(
+        OPENROUTER_API_URL,
+        headers=OPENROUTER_HEADERS,
+        json=payload
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise ProviderHTTPError(f"Error from OpenRouter API: {error_text}", response.status,
+                                    parse_retry_after(response.headers.get("Retry-After")))
+        result = await response.json()
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        return None
+
+async def complete(messages: List[Dict[str, str]], prompt: str) -> str:
+    """Provider interface: the full OpenRouter response, with the last message replaced by prompt."""
+    text = await request_text(messages[:-1] + [{"role": "user", "content": prompt}])
+    if not text:
+        raise ProviderError("OpenRouter API returned no choices")
+    return text
+
+async def generate_response(messages: List[Dict[str, str]]) -> str:
+    """
+    Generate a response using the OpenRouter API.
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                OPENROUTER_API_URL,
-                headers=OPENROUTER_HEADERS,
-                json=payload
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if "choices" in result and len(result["choices"]) > 0:
-                        return result["choices"][0]["message"]["content"]
-                    else:
-                        return "I couldn't generate a response. Please try again."
-                else:
-                    error_text = await response.text()
-                    print(f"Error from OpenRouter API: {error_text}")
-                    return "There was an error processing your request. Please try again."
-                    
+        text = await request_text(messages)
+        if text is not None:
+            return text
+        else:
+            return "I couldn't generate a response. Please try again."
+    
+    except ProviderError as e:
+        logger.error(f"Error from OpenRouter: {str(e)}")
+        return "There was an error processing your request. Please try again."
     except Exception as e:
-        print(f"Error generating response: {str(e)}")
+        logger.error(f"Error generating response: {str(e)}")
         return "Sorry, there was an error processing your request. Please try again later."
 
 async def process_message(user_message: str, conversation_history: List[Dict[str, str]]) -> str:
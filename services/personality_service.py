@@ -1,9 +1,13 @@
 from enum import Enum
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 import random
-from datetime import datetime, timedelta
-import nltk
-from nltk.sentiment import SentimentIntensityAnalyzer
+import struct
+import time
+from array import array
+from collections import Counter, OrderedDict
+from itertools import islice
+from services.message_analysis import MessageAnalysis, MessageAnalyzer
+from services.memory_service import MemoryService
 
 class EmotionalState(Enum):
     HAPPY = "happy"
@@ -14,93 +18,211 @@ class EmotionalState(Enum):
     SYMPATHETIC = "sympathetic"
     NEUTRAL = "neutral"
 
-class PersonalityTrait:
-    def __init__(self, name: str, initial_value: float = 0.5):
-        self.name = name
-        self.value = max(0.0, min(1.0, initial_value))  # Ensure value is between 0 and 1
+# Fixed order of the trait values in a state record
+TRAIT_NAMES = ("openness", "conscientiousness", "extraversion", "agreeableness", "empathy")
+TRAIT_INDEX = {name: index for index, name in enumerate(TRAIT_NAMES)}
+STATES = list(EmotionalState)
+STATE_INDEX = {state: index for index, state in enumerate(STATES)}
 
-    def adjust(self, amount: float):
+DEFAULT_TRAITS = {
+    "openness": 0.7,
+    "conscientiousness": 0.8,
+    "extraversion": 0.6,
+    "agreeableness": 0.75,
+    "empathy": 0.7
+}
+
+# Packed personality of one user: five float32 traits, the emotional state
+# index, when it last changed (Unix time) and how long it lasts in seconds.
+# The LRU cache and the user_personality table both hold these 31 bytes.
+STATE_RECORD = struct.Struct("<5fBdH")
+# Longest duration the record's unsigned short can hold (about 18 hours)
+MAX_STATE_DURATION = 2 ** 16 - 1
+
+# Response styles for different emotional states
+RESPONSE_STYLES = {
+    EmotionalState.HAPPY: {
+        "expressions": ["😊", "🌟", "✨", "😄"],
+        "modifiers": ["enthusiastically", "cheerfully", "gladly"]
+    },
+    EmotionalState.EXCITED: {
+        "expressions": ["🎉", "⚡", "🚀", "✨"],
+        "modifiers": ["excitedly", "energetically", "passionately"]
+    },
+    EmotionalState.CALM: {
+        "expressions": ["😌", "🌸", "🍃", "💫"],
+        "modifiers": ["calmly", "peacefully", "serenely"]
+    },
+    EmotionalState.THOUGHTFUL: {
+        "expressions": ["🤔", "💭", "📚", "🎯"],
+        "modifiers": ["thoughtfully", "carefully", "considerately"]
+    },
+    EmotionalState.CURIOUS: {
+        "expressions": ["🧐", "🔍", "💡", "❓"],
+        "modifiers": ["curiously", "inquisitively", "with interest"]
+    },
+    EmotionalState.SYMPATHETIC: {
+        "expressions": ["💝", "🤗", "💞", "💫"],
+        "modifiers": ["sympathetically", "caringly", "warmly"]
+    },
+    EmotionalState.NEUTRAL: {
+        "expressions": ["👍", "✨", "💫", "📝"],
+        "modifiers": ["clearly", "precisely", "effectively"]
+    }
+}
+
+class PersonalityState:
+    """Working copy of one user's personality, unpacked from its record."""
+
+    __slots__ = ("traits", "state", "changed_at", "duration")
+
+    def __init__(self, traits: array, state: EmotionalState, changed_at: float, duration: int):
+        self.traits = traits
+        self.state = state
+        self.changed_at = changed_at
+        self.duration = duration
+
+    @classmethod
+    def unpack(cls, record: bytes) -> "PersonalityState":
+        *traits, state, changed_at, duration = STATE_RECORD.unpack(record)
+        return cls(array("f", traits), STATES[state], changed_at, duration)
+
+    def pack(self) -> bytes:
+        return STATE_RECORD.pack(*self.traits, STATE_INDEX[self.state], self.changed_at, self.duration)
+
+    def trait(self, name: str) -> float:
+        return self.traits[TRAIT_INDEX[name]]
+
+    def adjust(self, name: str, amount: float):
         """Adjust trait value, keeping it between 0 and 1"""
-        self.value = max(0.0, min(1.0, self.value + amount))
+        index = TRAIT_INDEX[name]
+        self.traits[index] = max(0.0, min(1.0, self.traits[index] + amount))
 
 class PersonalityService:
-    def __init__(self):
-        self.current_state = EmotionalState.NEUTRAL
-        self.last_state_change = datetime.now()
-        self.state_duration = timedelta(minutes=random.randint(5, 15))
-        
-        # Initialize personality traits
-        self.traits = {
-            "openness": PersonalityTrait("Openness", 0.7),
-            "conscientiousness": PersonalityTrait("Conscientiousness", 0.8),
-            "extraversion": PersonalityTrait("Extraversion", 0.6),
-            "agreeableness": PersonalityTrait("Agreeableness", 0.75),
-            "empathy": PersonalityTrait("Empathy", 0.7)
-        }
+    """Personality and emotional state of the bot towards each user.
+
+    Every user has their own traits and emotional state, so one user's
+    messages never change how the bot treats anyone else. States are cached
+    as packed records in an LRU, loaded from the memory store on first
+    access and queued for its write-behind buffer whenever they change.
+    """
+
+    def __init__(self, analyzer: Optional[MessageAnalyzer] = None,
+                 memory_service: Optional[MemoryService] = None,
+                 settings: Optional[Dict[str, Any]] = None):
+        self.memory_service = memory_service
+        self.settings = settings or {}
+        initial_traits = {**DEFAULT_TRAITS, **self.settings.get("initial_traits", {})}
+        self.initial_traits = [initial_traits[name] for name in TRAIT_NAMES]
+        durations = self.settings.get("emotional_state_duration", {})
+        self.max_duration = min(int(durations.get("max_minutes", 15) * 60), MAX_STATE_DURATION)
+        self.min_duration = min(int(durations.get("min_minutes", 5) * 60), self.max_duration)
+        self.max_cached_users = self.settings.get("max_cached_users", 100000)
+
+        # user_id -> packed state record, least recently used first
+        self.records: OrderedDict = OrderedDict()
+        # Users with a request in flight, never evicted until unpinned
+        self._pinned: Counter = Counter()
         
         # Response styles for different emotional states
-        self.response_styles = {
-            EmotionalState.HAPPY: {
-                "expressions": ["😊", "🌟", "✨", "😄"],
-                "modifiers": ["enthusiastically", "cheerfully", "gladly"]
-            },
-            EmotionalState.EXCITED: {
-                "expressions": ["🎉", "⚡", "🚀", "✨"],
-                "modifiers": ["excitedly", "energetically", "passionately"]
-            },
-            EmotionalState.CALM: {
-                "expressions": ["😌", "🌸", "🍃", "💫"],
-                "modifiers": ["calmly", "peacefully", "serenely"]
-            },
-            EmotionalState.THOUGHTFUL: {
-                "expressions": ["🤔", "💭", "📚", "🎯"],
-                "modifiers": ["thoughtfully", "carefully", "considerately"]
-            },
-            EmotionalState.CURIOUS: {
-                "expressions": ["🧐", "🔍", "💡", "❓"],
-                "modifiers": ["curiously", "inquisitively", "with interest"]
-            },
-            EmotionalState.SYMPATHETIC: {
-                "expressions": ["💝", "🤗", "💞", "💫"],
-                "modifiers": ["sympathetically", "caringly", "warmly"]
-            },
-            EmotionalState.NEUTRAL: {
-                "expressions": ["👍", "✨", "💫", "📝"],
-                "modifiers": ["clearly", "precisely", "effectively"]
-            }
-        }
+        self.response_styles = RESPONSE_STYLES
         
-        try:
-            nltk.data.find('vader_lexicon')
-        except LookupError:
-            nltk.download('vader_lexicon')
-        
-        self.sentiment_analyzer = SentimentIntensityAnalyzer()
+        # Shared tokenizer and scorer; pass the same analyzer to every service
+        self.analyzer = analyzer or MessageAnalyzer()
+
+    def _default_state(self) -> PersonalityState:
+        return PersonalityState(
+            array("f", self.initial_traits), EmotionalState.NEUTRAL,
+            time.time(), random.randint(self.min_duration, self.max_duration)
+        )
 
-    def get_current_state(self) -> EmotionalState:
+    def _cache_record(self, user_id: int, record: bytes):
+        self.records[user_id] = record
+        self.records.move_to_end(user_id)
+        excess = len(self.records) - self.max_cached_users
+        if excess > 0:
+            # Every change is already queued for the store, so evicting is
+            # free. The user just added stays even if all others are pinned.
+            evictable = (uid for uid in self.records if uid not in self._pinned and uid != user_id)
+            for evicted_id in list(islice(evictable, excess)):
+                del self.records[evicted_id]
+
+    def pin(self, user_id: int):
+        """Keep a user cached across awaits until the matching unpin.
+
+        Only load_user reads the store, so a user evicted mid-request would
+        start again from the defaults and could then be saved over the
+        stored record.
+        """
+        self._pinned[user_id] += 1
+
+    def unpin(self, user_id: int):
+        """Release a pin; the user becomes evictable again once none remain."""
+        self._pinned[user_id] -= 1
+        if self._pinned[user_id] <= 0:
+            del self._pinned[user_id]
+
+    async def load_user(self, user_id: int):
+        """Make sure a user's personality is cached, loading it on first access."""
+        if user_id in self.records:
+            self.records.move_to_end(user_id)
+            return
+
+        stored = None
+        if self.memory_service:
+            stored = await self.memory_service.get_personality(user_id)
+        # Another handler may have loaded the user while we were waiting
+        if user_id not in self.records:
+            self._cache_record(user_id, stored if stored is not None else self._default_state().pack())
+
+    def _load(self, user_id: int) -> PersonalityState:
+        """Unpack a user's cached state, starting from the defaults for new users."""
+        record = self.records.get(user_id)
+        if record is None:
+            return self._default_state()
+        self.records.move_to_end(user_id)
+        return PersonalityState.unpack(record)
+
+    def _save(self, user_id: int, state: PersonalityState):
+        """Cache a changed state and queue it for the memory store."""
+        record = state.pack()
+        if self.records.get(user_id) == record:
+            return
+        self._cache_record(user_id, record)
+        if self.memory_service:
+            self.memory_service.queue_personality(user_id, record)
+
+    def _refresh(self, state: PersonalityState) -> bool:
+        """Move on from an emotional state that has lasted long enough."""
+        if time.time() - state.changed_at > state.duration:
+            self._transition_state(state)
+            return True
+        return False
+
+    def get_current_state(self, user_id: int) -> EmotionalState:
         """Get current emotional state, potentially transitioning to a new one."""
-        now = datetime.now()
-        if now - self.last_state_change > self.state_duration:
-            self._transition_state()
-        return self.current_state
+        state = self._load(user_id)
+        if self._refresh(state):
+            self._save(user_id, state)
+        return state.state
 
-    def _transition_state(self):
+    def _transition_state(self, state: PersonalityState):
         """Transition to a new emotional state."""
         # Exclude current state from possibilities
-        possible_states = [state for state in EmotionalState if state != self.current_state]
+        possible_states = [candidate for candidate in EmotionalState if candidate != state.state]
         
         # Weight transitions based on personality traits
         weights = []
-        for state in possible_states:
+        for candidate in possible_states:
             weight = 1.0
-            if state == EmotionalState.HAPPY:
-                weight *= self.traits["extraversion"].value
-            elif state == EmotionalState.THOUGHTFUL:
-                weight *= self.traits["conscientiousness"].value
-            elif state == EmotionalState.CURIOUS:
-                weight *= self.traits["openness"].value
-            elif state == EmotionalState.SYMPATHETIC:
-                weight *= self.traits["empathy"].value
+            if candidate == EmotionalState.HAPPY:
+                weight *= state.trait("extraversion")
+            elif candidate == EmotionalState.THOUGHTFUL:
+                weight *= state.trait("conscientiousness")
+            elif candidate == EmotionalState.CURIOUS:
+                weight *= state.trait("openness")
+            elif candidate == EmotionalState.SYMPATHETIC:
+                weight *= state.trait("empathy")
             weights.append(weight)
         
         # Normalize weights
@@ -108,40 +230,65 @@ class PersonalityService:
         weights = [w/total for w in weights]
         
         # Choose new state
-        self.current_state = random.choices(possible_states, weights=weights, k=1)[0]
-        self.last_state_change = datetime.now()
-        self.state_duration = timedelta(minutes=random.randint(5, 15))
+        state.state = random.choices(possible_states, weights=weights, k=1)[0]
+        state.changed_at = time.time()
+        state.duration = random.randint(self.min_duration, self.max_duration)
 
-    def adapt_to_user(self, message: str):
-        """Adapt personality based on user interaction."""
-        # Analyze sentiment
-        sentiment = self.sentiment_analyzer.polarity_scores(message)
+    def _adjust_traits(self, state: PersonalityState, analysis: MessageAnalysis) -> bool:
+        """Adjust traits for one analyzed message; return True if its sentiment is strong."""
+        sentiment = analysis.sentiment
         
         # Adjust traits based on sentiment and message content
         if sentiment['compound'] > 0.3:
-            self.traits["extraversion"].adjust(0.05)
-            self.traits["agreeableness"].adjust(0.03)
+            state.adjust("extraversion", 0.05)
+            state.adjust("agreeableness", 0.03)
         elif sentiment['compound'] < -0.3:
-            self.traits["empathy"].adjust(0.05)
+            state.adjust("empathy", 0.05)
             
         # Adjust based on message content
-        if any(word in message.lower() for word in ["why", "how", "what", "when", "where"]):
-            self.traits["openness"].adjust(0.02)
-            self.traits["conscientiousness"].adjust(0.02)
+        if analysis.has_question_word:
+            state.adjust("openness", 0.02)
+            state.adjust("conscientiousness", 0.02)
             
+        return abs(sentiment['compound']) > 0.5
+
+    def adapt_to_user(self, user_id: int, message: str, analysis: Optional[MessageAnalysis] = None):
+        """Adapt personality based on user interaction."""
+        if analysis is None:
+            analysis = self.analyzer.analyze(message)
+        
+        state = self._load(user_id)
         # Force state transition if sentiment is strong
-        if abs(sentiment['compound']) > 0.5:
-            self._transition_state()
+        if self._adjust_traits(state, analysis):
+            self._transition_state(state)
+        self._save(user_id, state)
 
-    def get_response_style(self) -> Dict[str, Any]:
+    def adapt_to_batch(self, user_id: int, analyses: List[MessageAnalysis]):
+        """Adapt personality to several past messages, transitioning state at most once."""
+        state = self._load(user_id)
+        strong = False
+        for analysis in analyses:
+            strong = self._adjust_traits(state, analysis) or strong
+        if strong:
+            self._transition_state(state)
+        self._save(user_id, state)
+
+    def get_response_style(self, user_id: int) -> Dict[str, Any]:
         """Get current response style based on emotional state."""
-        return self.response_styles[self.current_state]
+        return self.response_styles[self.get_current_state(user_id)]
+
+    def get_expression(self, user_id: int) -> str:
+        """Pick an expression matching the current emotional state."""
+        return random.choice(self.get_response_style(user_id)["expressions"])
 
-    def modulate_response(self, response: str) -> str:
-        """Modulate response based on current emotional state."""
-        style = self.get_response_style()
-        modifier = random.choice(style["modifiers"])
-        expression = random.choice(style["expressions"])
+    def modulate_response(self, user_id: int, response: str, expression: Optional[str] = None) -> str:
+        """Modulate response based on current emotional state.
+
+        Pass an expression picked earlier with get_expression to keep it
+        stable while a streamed response is still growing.
+        """
+        if expression is None:
+            expression = self.get_expression(user_id)
         
         # Add expression to response
         if not any(expr in response for expr in ["😊", "🌟", "✨", "😄", "🎉", "⚡", "🚀"]):
@@ -149,9 +296,16 @@ class PersonalityService:
         
         return response
 
-    def get_personality_summary(self) -> Dict[str, Any]:
+    def get_personality_summary(self, user_id: int) -> Dict[str, Any]:
         """Get current personality state summary."""
+        state = self._load(user_id)
+        if self._refresh(state):
+            self._save(user_id, state)
         return {
-            "emotional_state": self.current_state.value,
-            "traits": {name: trait.value for name, trait in self.traits.items()}
+            "emotional_state": state.state.value,
+            "traits": {name: round(state.trait(name), 4) for name in TRAIT_NAMES}
         }
+
+    def clear_user_data(self, user_id: int):
+        """Forget a user's personality; the memory service deletes the stored copy."""
+        self.records.pop(user_id, None)
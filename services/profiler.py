@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SamplingProfiler:
+    """Sample the event loop thread's stack while the bot keeps running.
+
+    A daemon thread reads the loop thread's current frame every interval
+    and counts each distinct stack, written out as collapsed stacks
+    ("outer;...;inner count") that flamegraph.pl or speedscope can draw.
+    Each busy sample is also charged to its innermost frame in main.py or
+    services/, so time is attributed to handlers and services directly;
+    samples without such a frame are charged to the innermost library.
+    Samples of the loop waiting in select() are counted as idle.
+
+    A heartbeat task on the loop notices when it wakes up late; a stall
+    longer than block_threshold is logged with the stack sampled while the
+    loop was stuck. Nothing runs, and nothing is paid, until start().
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = settings or {}
+        self.interval = settings.get("interval", 0.005)
+        self.block_threshold = settings.get("block_threshold", 0.1)
+        self.heartbeat = min(0.05, self.block_threshold / 2)
+        self.max_duration = settings.get("max_duration", 300)
+        self.output_dir = settings.get("output_dir", "profiles")
+        self.blocks = deque(maxlen=settings.get("max_blocks", 100))
+        self.stacks: Counter = Counter()
+        self.owners: Counter = Counter()
+        self.idle = 0
+        self.started = 0.0
+        self.started_at = 0.0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._labels: Dict[Any, Tuple[str, bool]] = {}
+        self._blocking: Counter = Counter()
+        self._last_beat = 0.0
+        self._duration = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._stop_task: Optional[asyncio.Task] = None
+        # Lifetime totals for the metrics endpoint
+        self.total_samples = 0
+        self.total_blocks = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, duration: Optional[float] = None) -> bool:
+        """Start sampling the running loop; False if already profiling.
+
+        The profile stops itself after duration seconds, max_duration by default.
+        """
+        if self.running:
+            return False
+        self.stacks.clear()
+        self.owners.clear()
+        self.blocks.clear()
+        self._blocking = Counter()
+        self.idle = 0
+        self._duration = duration or self.max_duration
+        self.started = self._last_beat = time.perf_counter()
+        self.started_at = time.time()
+        self._loop_thread = threading.get_ident()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        self._watch_task = asyncio.create_task(self._watch())
+        logger.info(f"Profiling the event loop every {self.interval * 1000:.1f} ms")
+        return True
+
+    async def stop(self) -> Optional[str]:
+        """Stop sampling and write the profile; returns the collapsed-stack file."""
+        if not self.running:
+            return None
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        if self._watch_task is not None and self._watch_task is not asyncio.current_task():
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+        self._watch_task = None
+        self.elapsed = time.perf_counter() - self.started
+        try:
+            path = await asyncio.to_thread(self._write)
+        except OSError as e:
+            logger.error(f"Error writing profile: {str(e)}")
+            return None
+        logger.info(f"Wrote profile of {self.elapsed:.1f} s to {path}")
+        return path
+
+    def toggle(self):
+        """Start or stop profiling, e.g. from a signal handler on the loop."""
+        if self.running:
+            self._stop_task = asyncio.create_task(self.stop())
+        else:
+            self.start()
+
+    def _label(self, code) -> Tuple[str, bool]:
+        """module:qualname of a code object, and whether it is in main.py or services/."""
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(ROOT + os.sep):
+                module = os.path.relpath(filename, ROOT)
+            else:
+                # Shortest path relative to an import root gives the module name
+                module = min(
+                    (os.path.relpath(filename, entry) for entry in sys.path
+                     if entry and filename.startswith(entry + os.sep)),
+                    key=len, default=os.path.basename(filename)
+                )
+            own = module == "main.py" or module.startswith("services" + os.sep)
+            module = module[:-3] if module.endswith(".py") else module
+            # co_qualname is new in Python 3.11
+            name = getattr(code, "co_qualname", code.co_name)
+            label = self._labels[code] = (f"{module.replace(os.sep, '.')}:{name}", own)
+        return label
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._sample(frame)
+            del frame
+
+    def _sample(self, frame):
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        with self._lock:
+            self.total_samples += 1
+            innermost = codes[0]
+            if innermost.co_name == "select" and innermost.co_filename.endswith("selectors.py"):
+                self.idle += 1
+                return
+            labels = [self._label(code) for code in reversed(codes)]
+            stack = ";".join(label for label, _ in labels)
+            self.stacks[stack] += 1
+            owner = next((label for label, own in reversed(labels) if own), None)
+            if owner is None:
+                # Library work run straight from the loop, e.g. socket callbacks
+                owner = "(" + labels[-1][0].split(":")[0].split(".")[0] + ")"
+            self.owners[owner] += 1
+            if time.perf_counter() - self._last_beat > self.heartbeat + self.block_threshold:
+                self._blocking[stack, owner] += 1
+
+    async def _watch(self):
+        """Wake up every heartbeat and report the loop stalls that delayed it."""
+        while True:
+            self._last_beat = time.perf_counter()
+            await asyncio.sleep(self.heartbeat)
+            now = time.perf_counter()
+            late = now - self._last_beat - self.heartbeat
+            with self._lock:
+                stacks, self._blocking = self._blocking, Counter()
+            if late >= self.block_threshold:
+                self._record_block(late, stacks)
+            if now - self.started >= self._duration:
+                self._stop_task = asyncio.create_task(self.stop())
+                return
+
+    def _record_block(self, seconds: float, stacks: Counter):
+        # The stack seen most often while the loop was stuck is the likely culprit
+        (stack, owner), samples = stacks.most_common(1)[0] if stacks else (("", "(not sampled)"), 0)
+        block = {"at": time.time(), "seconds": seconds, "samples": samples, "stack": stack, "owner": owner}
+        self.blocks.append(block)
+        self.total_blocks += 1
+        logger.warning(
+            f"Event loop blocked for {seconds * 1000:.0f} ms in {owner}\n" + self._format_stack(stack)
+        )
+
+    @staticmethod
+    def _format_stack(stack: str, indent: str = "  ") -> str:
+        """A collapsed stack as one frame per line, innermost first."""
+        if not stack:
+            return f"{indent}(no sample was taken during the block)"
+        return "\n".join(indent + label for label in reversed(stack.split(";")))
+
+    def top_owners(self, count: int = 10) -> List[Tuple[str, float]]:
+        """Handlers and services with the largest share of busy loop time."""
+        with self._lock:
+            busy = sum(self.owners.values())
+            top = self.owners.most_common(count)
+        return [(owner, samples / busy) for owner, samples in top] if busy else []
+
+    def summary(self) -> str:
+        """Short text report of the current or last profile."""
+        with self._lock:
+            samples = sum(self.stacks.values()) + self.idle
+            idle = self.idle
+        elapsed = time.perf_counter() - self.started if self.running else self.elapsed
+        lines = [
+            f"{'Profiling' if self.running else 'Profiled'} for {elapsed:.1f} s: "
+            f"{samples} samples, {idle / samples if samples else 0:.0%} idle"
+        ]
+        lines.append("Busy loop time by handler or service:")
+        lines.extend(f"  {share:6.1%}  {owner}" for owner, share in self.top_owners())
+        lines.append(f"Event loop blocks over {self.block_threshold * 1000:.0f} ms: {len(self.blocks)}")
+        for block in list(self.blocks)[-10:]:
+            lines.append(f"  {block['seconds'] * 1000:.0f} ms in {block['owner']}")
+        return "\n".join(lines)
+
+    def _write(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        path = os.path.join(self.output_dir, name + ".folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(self.output_dir, name + ".txt"), "w") as f:
+            f.write(self.summary() + "\n")
+            for block in self.blocks:
+                at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(block["at"]))
+                f.write(f"\n{at} blocked {block['seconds'] * 1000:.0f} ms:\n{self._format_stack(block['stack'])}\n")
+        return path
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "running": int(self.running),
+            "samples": self.total_samples,
+            "blocks": self.total_blocks,
+        }
@@ -0,0 +1,168 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from services.memory_service import MemoryService
+from services.personality_service import PersonalityService
+from services.learning_service import LearningService
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_INTRO = "You are an AI assistant with personality and learning capabilities. "
+MEMORY_HEADER = "\nRelevant context from past interactions:\n"
+# Role markers and separators every chat message costs on top of its text
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: about four characters per token for English text."""
+    return (len(text) + 3) // 4
+
+
+class PromptBuilder:
+    """Pack context and history into a prompt of bounded size.
+
+    The system context (persona and emotional state), relevant memories,
+    learned topics and the current message are packed first; the remaining
+    budget is filled with as much recent history as fits, newest first.
+    Token counts are estimated from character counts, so a prompt never
+    grows past max_prompt_tokens however long a conversation gets.
+
+    Parts that rarely change are cached per user: the rendered topics line
+    and the user's most important memories, which back up the relevance
+    search when it finds nothing.
+    """
+
+    def __init__(self, memory_service: Optional[MemoryService] = None,
+                 personality_service: Optional[PersonalityService] = None,
+                 learning_service: Optional[LearningService] = None,
+                 settings: Optional[Dict[str, Any]] = None):
+        self.memory_service = memory_service
+        self.personality_service = personality_service
+        self.learning_service = learning_service
+        self.settings = settings or {}
+        self.max_prompt_tokens = self.settings.get("max_prompt_tokens", 3000)
+        self.memory_tokens = self.settings.get("memory_tokens", 600)
+        self.max_memories = self.settings.get("max_memories", 3)
+        self.static_ttl = self.settings.get("static_ttl", 60)
+        self.max_cached_users = self.settings.get("max_cached_users", 10000)
+
+        # user_id -> [expires_at, fallback memory lines, topics, topics line]
+        self._static: OrderedDict = OrderedDict()
+
+        self.builds = 0
+        self.static_hits = 0
+        self.history_dropped = 0
+        self.last_prompt_tokens = 0
+
+    def invalidate(self, user_id: int):
+        """Forget a user's cached parts, e.g. after their memories changed."""
+        self._static.pop(user_id, None)
+
+    async def _static_parts(self, user_id: int) -> list:
+        """Cached fallback memories and topics line of a user, refreshed after static_ttl."""
+        now = time.monotonic()
+        entry = self._static.get(user_id)
+        if entry is not None and entry[0] > now:
+            self._static.move_to_end(user_id)
+            self.static_hits += 1
+            return entry
+
+        fallback = []
+        if self.memory_service:
+            memories = await self.memory_service.get_memories(user_id, limit=self.max_memories)
+            fallback = [f"- {memory['content']}\n" for memory in memories]
+        entry = [now + self.static_ttl, fallback, None, ""]
+        self._static[user_id] = entry
+        self._static.move_to_end(user_id)
+        while len(self._static) > self.max_cached_users:
+            self._static.popitem(last=False)
+        return entry
+
+    def _topics_line(self, entry: list, user_id: int) -> str:
+        """The topics line, rendered again only when the learned topics change."""
+        topics = tuple(self.learning_service.get_response_context(user_id).get("topics") or ())
+        if topics != entry[2]:
+            entry[2] = topics
+            entry[3] = "\nUser's topics of interest: " + ", ".join(topics) if topics else ""
+        return entry[3]
+
+    async def build(self, messages: List[Dict[str, str]],
+                    user_context: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, str]], str]:
+        """Return (history, prompt): the packed conversation ending with the
+        current message, and the context-enhanced text of that message."""
+        self.builds += 1
+        last_message = messages[-1]["content"]
+        budget = self.max_prompt_tokens
+
+        # Build context-enhanced prompt
+        system_context = SYSTEM_INTRO
+        if user_context and self.personality_service:
+            emotional_state = self.personality_service.get_current_state(user_context.get("user_id", 0))
+            system_context += f"Your current emotional state is {emotional_state.value}. "
+
+        # The current message always goes in, shortened if it alone is over budget
+        message_part = f"\n\nUser message: {last_message}"
+        budget -= estimate_tokens(system_context) + estimate_tokens(message_part) + MESSAGE_OVERHEAD_TOKENS
+        if budget < 0:
+            last_message = last_message[:max(0, len(last_message) + budget * 4)]
+            message_part = f"\n\nUser message: {last_message}"
+            budget = 0
+
+        if user_context and (self.memory_service or self.learning_service):
+            user_id = user_context.get('user_id', 0)
+            entry = await self._static_parts(user_id)
+
+            if self.memory_service:
+                # Get the memories and past messages most relevant to this message,
+                # falling back to the most important memories when nothing matches
+                memories = await self.memory_service.search_relevant(user_id, last_message, k=self.max_memories)
+                lines = [f"- {memory['content']}\n" for memory in memories] or entry[1]
+                memory_budget = min(self.memory_tokens, budget) - estimate_tokens(MEMORY_HEADER)
+                packed = []
+                for line in lines:
+                    cost = estimate_tokens(line)
+                    if cost > memory_budget:
+                        break
+                    packed.append(line)
+                    memory_budget -= cost
+                if packed:
+                    section = MEMORY_HEADER + "".join(packed)
+                    system_context += section
+                    budget -= estimate_tokens(section)
+
+            if self.learning_service:
+                # Get learned preferences
+                topics_line = self._topics_line(entry, user_id)
+                cost = estimate_tokens(topics_line)
+                if topics_line and cost <= budget:
+                    system_context += topics_line
+                    budget -= cost
+
+        # Fill what is left with the most recent turns
+        history: List[Dict[str, str]] = []
+        for turn in reversed(messages[:-1]):
+            cost = estimate_tokens(turn["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if cost > budget:
+                break
+            history.append(turn)
+            budget -= cost
+        self.history_dropped += len(messages) - 1 - len(history)
+        history.reverse()
+        # Conversations have to open with a user turn
+        while history and history[0]["role"] != "user":
+            history.pop(0)
+        history.append({"role": "user", "content": last_message})
+
+        self.last_prompt_tokens = self.max_prompt_tokens - budget
+        return history, system_context + message_part
+
+    def metrics(self) -> Dict[str, Any]:
+        """Counters of the builder and the size of the last prompt."""
+        return {
+            "builds": self.builds,
+            "static_hits": self.static_hits,
+            "history_dropped": self.history_dropped,
+            "last_prompt_tokens": self.last_prompt_tokens,
+            "cached_users": len(self._static)
+        }
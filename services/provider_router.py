@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """An LLM provider failed to produce a usable response."""
+
+
+class ProviderHTTPError(ProviderError):
+    """A provider answered with an HTTP error status."""
+
+    def __init__(self, message: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+
+class DeadlineExceeded(ProviderError):
+    """The request could not be served before its deadline."""
+
+
+def error_kind(error: BaseException) -> str:
+    """Short label for what went wrong in a provider call, e.g. http_429 or timeout."""
+    if isinstance(error, ProviderHTTPError):
+        return f"http_{error.status}"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    return type(error).__name__
+
+
+class Provider:
+    """One LLM backend behind the common interface.
+
+    generate(messages, prompt) returns the full response text; the optional
+    stream(messages, prompt) yields it in chunks. Both raise ProviderError
+    when the backend fails. prompt is the context-enhanced last message and
+    messages the conversation it belongs to.
+    """
+
+    def __init__(self, name: str,
+                 generate: Callable[[List[Dict[str, str]], str], Awaitable[str]],
+                 stream: Optional[Callable[[List[Dict[str, str]], str], AsyncIterator[str]]] = None):
+        self.name = name
+        self.generate = generate
+        self.stream = stream
+
+
+class ProviderStats:
+    """Rolling latency and error record of one provider."""
+
+    def __init__(self, window: int = 50):
+        self.latencies: deque = deque(maxlen=window)
+        self.first_chunks: deque = deque(maxlen=window)
+        self.outcomes: deque = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.errors: Dict[str, int] = {}
+
+    def record(self, latency: float, ok: bool, error: Optional[BaseException] = None):
+        self.requests += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            kind = error_kind(error) if error is not None else "unknown"
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_first_chunk(self, latency: float):
+        self.first_chunks.append(latency)
+
+    def percentile(self, q: float, first_chunk: bool = False) -> Optional[float]:
+        """Latency at quantile q of the recent successes, or of their time to
+        first chunk when streamed; None without samples."""
+        samples = self.first_chunks if first_chunk else self.latencies
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "errors": dict(self.errors),
+            "error_rate": self.error_rate(),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "cooling_down": self.cooldown_until > time.monotonic()
+        }
+
+
+class ProviderRouter:
+    """Send each request to the fastest healthy provider.
+
+    Providers are ranked by their rolling median latency; a provider that
+    fails several times in a row is benched for a cooldown, and one whose
+    recent error rate is too high only serves as a last resort. A request
+    that errors fails over to the next provider. With hedging on, a request
+    still running after the primary's hedge_percentile latency is also sent
+    to the runner-up and the first good answer wins; streams race on the
+    time to their first chunk instead.
+    """
+
+    def __init__(self, providers: List[Provider], settings: Optional[Dict[str, Any]] = None):
+        if not providers:
+            raise ValueError("ProviderRouter needs at least one provider")
+        self.providers = providers
+        self.settings = settings or {}
+        window = self.settings.get("window", 50)
+        self.stats: Dict[str, ProviderStats] = {provider.name: ProviderStats(window) for provider in providers}
+
+        self.max_error_rate = self.settings.get("max_error_rate", 0.5)
+        self.min_samples = self.settings.get("min_samples", 5)
+        self.max_consecutive_failures = self.settings.get("max_consecutive_failures", 3)
+        self.cooldown = self.settings.get("cooldown", 30.0)
+        self.hedge = self.settings.get("hedge", True)
+        self.hedge_percentile = self.settings.get("hedge_percentile", 0.95)
+        self.hedge_default_delay = self.settings.get("hedge_default_delay", 3.0)
+        self.hedge_min_delay = self.settings.get("hedge_min_delay", 0.5)
+        self.hedge_max_delay = self.settings.get("hedge_max_delay", 10.0)
+
+        self.requests = 0
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _healthy(self, stats: ProviderStats, now: float) -> bool:
+        if stats.cooldown_until > now:
+            return False
+        return len(stats.outcomes) < self.min_samples or stats.error_rate() <= self.max_error_rate
+
+    def ranked(self) -> List[Provider]:
+        """Providers in the order they should be tried."""
+        now = time.monotonic()
+
+        def rank(indexed):
+            index, provider = indexed
+            stats = self.stats[provider.name]
+            # Providers without samples rank first so they get measured
+            latency = stats.percentile(0.5)
+            return (not self._healthy(stats, now), latency if latency is not None else 0.0, index)
+
+        return [provider for _, provider in sorted(enumerate(self.providers), key=rank)]
+
+    def _record(self, provider: Provider, started: float, ok: bool, error: Optional[BaseException] = None):
+        stats = self.stats[provider.name]
+        stats.record(time.monotonic() - started, ok, error)
+        if not ok and stats.consecutive_failures >= self.max_consecutive_failures:
+            stats.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f"Provider {provider.name} failed {stats.consecutive_failures} times in a row, "
+                           f"cooling down for {self.cooldown}s")
+
+    async def _call(self, provider: Provider, messages: List[Dict[str, str]], prompt: str) -> str:
+        """Call one provider and record how it went; cancelled calls are not recorded."""
+        started = time.monotonic()
+        try:
+            response = await provider.generate(messages, prompt)
+        except (asyncio.CancelledError, DeadlineExceeded):
+            # Running out of our own time says nothing about the provider
+            raise
+        except Exception as e:
+            self._record(provider, started, False, e)
+            raise
+        self._record(provider, started, True)
+        return response
+
+    def _hedge_delay(self, provider: Provider, first_chunk: bool = False) -> float:
+        stats = self.stats[provider.name]
+        delay = None
+        samples = stats.first_chunks if first_chunk else stats.latencies
+        if len(samples) >= self.min_samples:
+            delay = stats.percentile(self.hedge_percentile, first_chunk)
+        if delay is None:
+            delay = self.hedge_default_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, delay))
+
+    async def generate(self, messages: List[Dict[str, str]], prompt: str) -> str:
+        """Get a response from the best provider, hedging and failing over as configured."""
+        self.requests += 1
+        candidates = self.ranked()
+        pending: Dict[asyncio.Task, Provider] = {}
+        errors: List[tuple] = []
+        next_index = 0
+        hedged = False
+
+        def launch():
+            nonlocal next_index
+            provider = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._call(provider, messages, prompt))] = provider
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if self.hedge and not hedged and next_index < len(candidates) and len(pending) == 1:
+                    timeout = self._hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # The primary is slower than usual; race it against the runner-up
+                    hedged = True
+                    self.hedges += 1
+                    launch()
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged and provider is not candidates[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append((provider.name, task.exception()))
+
+                # Fail over once nothing else is still running
+                if not pending and next_index < len(candidates):
+                    self.failovers += 1
+                    logger.warning(f"Failing over to provider {candidates[next_index].name}")
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise self._failure(errors)
+
+    async def _first_chunk(self, provider: Provider, messages: List[Dict[str, str]], prompt: str) -> tuple:
+        """Open a provider's stream and wait for its first chunk.
+
+        Returns (chunks, first chunk, start time); a provider that cannot
+        stream answers in one piece with chunks None. Failures are recorded,
+        cancellations are not.
+        """
+        started = time.monotonic()
+        if provider.stream is None:
+            return None, await self._call(provider, messages, prompt), started
+
+        chunks = provider.stream(messages, prompt)
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except (asyncio.CancelledError, DeadlineExceeded):
+            await chunks.aclose()
+            raise
+        except Exception as e:
+            await chunks.aclose()
+            self._record(provider, started, False, e)
+            raise
+        self.stats[provider.name].record_first_chunk(time.monotonic() - started)
+        return chunks, first, started
+
+    async def stream(self, messages: List[Dict[str, str]], prompt: str) -> AsyncIterator[str]:
+        """Stream a response from the best provider, hedging and failing over until the first chunk.
+
+        A provider still silent after its hedge delay is raced against the
+        runner-up; whichever sends a chunk first streams the answer and the
+        other is cancelled. Once a chunk is out there is no failover, so
+        two answers are never mixed.
+        """
+        self.requests += 1
+        candidates = self.ranked()
+        pending: Dict[asyncio.Task, Provider] = {}
+        errors: List[tuple] = []
+        next_index = 0
+        hedged = False
+        winner = None
+
+        def launch():
+            nonlocal next_index
+            provider = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._first_chunk(provider, messages, prompt))] = provider
+
+        launch()
+        try:
+            while pending and winner is None:
+                timeout = None
+                if self.hedge and not hedged and next_index < len(candidates) and len(pending) == 1:
+                    timeout = self._hedge_delay(next(iter(pending.values())), first_chunk=True)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # No chunk yet after the usual wait; race the runner-up
+                    hedged = True
+                    self.hedges += 1
+                    launch()
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is not None:
+                        errors.append((provider.name, task.exception()))
+                    elif winner is None:
+                        winner = provider, task.result()
+                    elif task.result()[0] is not None:
+                        # Both answered at once; keep the first one only
+                        await task.result()[0].aclose()
+
+                # Fail over once nothing else is still running
+                if winner is None and not pending and next_index < len(candidates):
+                    self.failovers += 1
+                    logger.warning(f"Failing over to provider {candidates[next_index].name}")
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            # A loser may have opened its stream just before being cancelled
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, tuple) and result[0] is not None:
+                    await result[0].aclose()
+
+        if winner is None:
+            raise self._failure(errors)
+
+        provider, (chunks, first, started) = winner
+        if hedged and provider is not candidates[0]:
+            self.hedge_wins += 1
+        if chunks is None:
+            yield first
+            return
+
+        try:
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded):
+                self._record(provider, started, False, e)
+            raise
+        finally:
+            await chunks.aclose()
+        self._record(provider, started, True)
+
+    def _failure(self, errors: List[tuple]) -> ProviderError:
+        """The error to raise once every provider tried has failed."""
+        summary = "; ".join(f"{name}: {error}" for name, error in errors)
+        if errors and all(isinstance(error, DeadlineExceeded) for _, error in errors):
+            return DeadlineExceeded("No provider could answer before the deadline: " + summary)
+        return ProviderError("All providers failed: " + summary)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Router counters and the rolling stats of every provider."""
+        return {
+            "requests": self.requests,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "providers": {name: stats.snapshot() for name, stats in self.stats.items()}
+        }
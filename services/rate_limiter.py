@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+from services.provider_router import DeadlineExceeded, ProviderHTTPError
+
+logger = logging.getLogger(__name__)
+
+# Monotonic time by which the current request must be answered; set once per
+# request and inherited by the tasks the provider router starts for it.
+request_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket that queues callers instead of failing them.
+
+    Each acquire reserves a token, letting the balance go negative; the
+    deficit tells the caller how long to wait, so waiters are served in
+    arrival order at the configured rate.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, deadline: Optional[float] = None) -> Optional[float]:
+        """Reserve a token and return the wait, or None if it would pass the deadline."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if deadline is not None and now + wait > deadline:
+            return None
+        self.tokens -= 1
+        return wait
+
+
+class RateLimiter:
+    """Outbound limits for the LLM providers.
+
+    Calls to each provider pass a token bucket, and so do the requests of
+    each user, so bursts wait briefly instead of failing. A provider call
+    answered with 429 or a 5xx status is retried with jittered exponential
+    backoff, waiting at least as long as Retry-After asks. Nothing waits
+    past the request deadline.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None,
+                 sleep: Callable[[float], Awaitable[None]] = asyncio.sleep):
+        self.settings = settings or {}
+        # Waits go through here, so tests can record them instead
+        self.sleep = sleep
+        self.provider_limits = self.settings.get("providers", {})
+        self.default_rate = self.settings.get("provider_rate", 5.0)
+        self.default_burst = self.settings.get("provider_burst", 10)
+        self.user_rate = self.settings.get("user_rate", 0.5)
+        self.user_burst = self.settings.get("user_burst", 5)
+        self.max_users = self.settings.get("max_users", 10000)
+        self.max_retries = self.settings.get("max_retries", 3)
+        self.base_delay = self.settings.get("base_delay", 0.5)
+        self.max_delay = self.settings.get("max_delay", 20.0)
+        self.deadline = self.settings.get("request_deadline", 45.0)
+
+        self._providers: Dict[str, TokenBucket] = {}
+        self._users: OrderedDict = OrderedDict()
+        self.counters: Dict[str, Dict[str, float]] = {}
+
+    def _count(self, name: str, counter: str, amount: float = 1):
+        counters = self.counters.setdefault(name, {})
+        counters[counter] = counters.get(counter, 0) + amount
+
+    @contextmanager
+    def request(self):
+        """Give the provider calls made inside the block one shared deadline."""
+        token = request_deadline.set(time.monotonic() + self.deadline)
+        try:
+            yield
+        finally:
+            request_deadline.reset(token)
+
+    async def _wait(self, bucket: TokenBucket, name: str):
+        wait = bucket.reserve(request_deadline.get())
+        if wait is None:
+            self._count(name, "deadline_exceeded")
+            raise DeadlineExceeded(f"Rate limit for {name} cannot be met before the deadline")
+        if wait > 0:
+            self._count(name, "waits")
+            self._count(name, "wait_time", wait)
+            await self.sleep(wait)
+
+    async def acquire_user(self, user_id: Hashable):
+        """Wait for the user's turn; raises DeadlineExceeded if it comes too late."""
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        await self._wait(bucket, "users")
+
+    def _provider_bucket(self, name: str) -> TokenBucket:
+        bucket = self._providers.get(name)
+        if bucket is None:
+            limits = self.provider_limits.get(name, {})
+            bucket = self._providers[name] = TokenBucket(
+                limits.get("rate", self.default_rate), limits.get("burst", self.default_burst)
+            )
+        return bucket
+
+    async def _backoff(self, name: str, attempt: int, error: ProviderHTTPError):
+        """Sleep before the next attempt, or re-raise if it would pass the deadline."""
+        self._count(name, "throttled" if error.status == 429 else "server_errors")
+        if attempt >= self.max_retries:
+            raise error
+        # Full jitter keeps retries from many requests from lining up
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        deadline = request_deadline.get()
+        if deadline is not None and time.monotonic() + delay > deadline:
+            self._count(name, "deadline_exceeded")
+            raise error
+        self._count(name, "retries")
+        logger.warning(f"{name} answered {error.status}, retrying in {delay:.2f}s")
+        await self.sleep(delay)
+
+    def limit(self, name: str, generate: Callable[..., Awaitable[str]]) -> Callable[..., Awaitable[str]]:
+        """Wrap a provider's generate function with its bucket and retries."""
+        async def limited(*args) -> str:
+            attempt = 0
+            while True:
+                await self._wait(self._provider_bucket(name), name)
+                try:
+                    return await generate(*args)
+                except ProviderHTTPError as e:
+                    if not e.retryable:
+                        raise
+                    await self._backoff(name, attempt, e)
+                    attempt += 1
+        return limited
+
+    def limit_stream(self, name: str, stream: Callable[..., AsyncIterator[str]]) -> Callable[..., AsyncIterator[str]]:
+        """Wrap a provider's stream function; retries only happen before the first chunk."""
+        async def limited(*args) -> AsyncIterator[str]:
+            attempt = 0
+            while True:
+                await self._wait(self._provider_bucket(name), name)
+                sent = False
+                try:
+                    async for chunk in stream(*args):
+                        sent = True
+                        yield chunk
+                    return
+                except ProviderHTTPError as e:
+                    if sent or not e.retryable:
+                        raise
+                    await self._backoff(name, attempt, e)
+                    attempt += 1
+        return limited
+
+    def metrics(self) -> Dict[str, Any]:
+        """Throttling counters per provider, plus "users" for the per-user limit."""
+        return {name: dict(counters) for name, counters in self.counters.items()}
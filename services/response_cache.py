@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from services.memory_service import MemoryService
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class SharedStream:
+    """Chunks of one in-flight stream, replayed to every caller following it."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # Wake the current followers; later ones wait on a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def follow(self) -> AsyncIterator[str]:
+        """Yield every chunk from the first, then the rest as they arrive."""
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+class ResponseCache:
+    """Two-tier cache of LLM responses with single-flight coalescing.
+
+    The first tier is an in-process LRU with a TTL; the optional second tier
+    is the response_cache table in the memory store, which survives restarts.
+    Identical requests that arrive while the first is still in flight wait
+    for its result instead of calling the provider again; for streamed
+    requests they replay the chunks received so far and follow the rest.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None, store: Optional[MemoryService] = None):
+        self.settings = settings or {}
+        self.enabled = self.settings.get("enabled", True)
+        self.max_entries = self.settings.get("max_entries", 1024)
+        self.ttl = self.settings.get("ttl", 3600)
+        self.store_ttl = self.settings.get("store_ttl", 86400)
+        self.ignore_case = self.settings.get("ignore_case", False)
+        self.store = store if self.settings.get("use_store", True) else None
+
+        # key -> (expires_at, response), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, SharedStream] = {}
+
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _normalize(self, text: str) -> str:
+        text = WHITESPACE_PATTERN.sub(" ", text).strip()
+        return text.casefold() if self.ignore_case else text
+
+    def make_key(self, payload: Dict[str, Any]) -> str:
+        """Hash the normalized prompt together with the rest of the request body."""
+        prompt = [
+            self._normalize(part.get("text", ""))
+            for content in payload.get("contents", [])
+            for part in content.get("parts", [])
+        ]
+        options = {name: value for name, value in payload.items() if name != "contents"}
+        body = json.dumps({"prompt": prompt, "options": options}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, response: str, expires_at: float):
+        """Put an entry in the in-memory tier, evicting the least recently used."""
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        """Look a response up in both tiers."""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self.store is not None:
+            try:
+                row = await self.store.get_cached_response(key, now)
+            except Exception as e:
+                logger.error(f"Error reading response cache: {str(e)}")
+                row = None
+            if row is not None:
+                response, expires_at = row
+                self._remember(key, response, min(expires_at, now + self.ttl))
+                self.store_hits += 1
+                return response
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str):
+        """Store a response in both tiers."""
+        now = time.time()
+        self._remember(key, response, now + self.ttl)
+        self.stores += 1
+        if self.store is not None:
+            try:
+                await self.store.store_cached_response(key, response, now + self.store_ttl)
+            except Exception as e:
+                logger.error(f"Error writing response cache: {str(e)}")
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        response = await compute()
+        # None means there was no usable response; never cache that
+        if response is not None:
+            await self.put(key, response)
+        return response
+
+    def _finish_inflight(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # Mark the error as retrieved when every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Return the cached response for key, or compute it once for all concurrent callers."""
+        if not self.enabled:
+            return await compute()
+
+        response = await self.get(key)
+        if response is not None:
+            return response
+
+        task = self._inflight.get(key)
+        if task is None:
+            # Run the upstream call as its own task so a caller that gives up
+            # does not cancel it for everyone else waiting on the same key
+            task = asyncio.create_task(self._compute(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_inflight(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _produce(self, key: str, shared: SharedStream, stream: Callable[[], AsyncIterator[str]]):
+        try:
+            async for chunk in stream():
+                shared.add(chunk)
+        except asyncio.CancelledError:
+            # Followers were not cancelled themselves; fail them like any error
+            shared.finish(RuntimeError("The shared stream was cancelled"))
+            raise
+        except Exception as e:
+            shared.finish(e)
+            return
+        shared.finish()
+        await self.put(key, "".join(shared.chunks))
+
+    async def stream_or_compute(self, key: str, stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Yield the cached response for key as one chunk, or share one stream among concurrent callers.
+
+        The first caller starts stream() as its own task, so the stream runs to
+        the end and is cached even if that caller goes away. Callers with the
+        same key get its chunks so far and then follow it live.
+        """
+        if not self.enabled:
+            async for chunk in stream():
+                yield chunk
+            return
+
+        response = await self.get(key)
+        if response is not None:
+            yield response
+            return
+
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = self._streams[key] = SharedStream()
+            shared.task = asyncio.create_task(self._produce(key, shared, stream))
+            shared.task.add_done_callback(lambda done: self._streams.pop(key, None))
+        else:
+            self.coalesced += 1
+        async for chunk in shared.follow():
+            yield chunk
+
+    def clear(self):
+        """Drop every entry of the in-memory tier."""
+        self._entries.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Hit, miss and size counters of the cache."""
+        hits = self.memory_hits + self.store_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "coalesced": self.coalesced,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "inflight": len(self._inflight) + len(self._streams)
+        }
@@ -0,0 +1,62 @@
+import re
+from typing import Dict, Optional, Tuple
+
+# Word substitutions per preference bucket, applied on whole words only
+DEFAULT_REWRITE_RULES: Dict[str, Dict[str, str]] = {
+    "formal": {"yeah": "yes", "nope": "no", "gonna": "going to", "wanna": "want to"},
+    "casual": {"certainly": "sure", "additionally": "also", "however": "but"},
+    "technical": {"use": "utilize", "make": "implement", "fix": "resolve"},
+    "simple": {"utilize": "use", "implement": "make", "resolve": "fix"}
+}
+
+def _match_case(original: str, replacement: str) -> str:
+    """Give replacement the capitalization of the word it replaces."""
+    if original.isupper() and len(original) > 1:
+        return replacement.upper()
+    if original[0].isupper():
+        return replacement[0].upper() + replacement[1:]
+    return replacement
+
+class ResponseRewriter:
+    """Applies the substitutions of several preference buckets in one pass.
+
+    Each combination of buckets is compiled once into a single alternation
+    of whole words plus a lookup table, so a response is scanned once no
+    matter how many rules apply.
+    """
+
+    def __init__(self, rules: Optional[Dict[str, Dict[str, str]]] = None):
+        self.rules = rules or DEFAULT_REWRITE_RULES
+        self._compiled: Dict[Tuple[str, ...], Optional[Tuple[re.Pattern, Dict[str, str]]]] = {}
+
+    def _compile(self, buckets: Tuple[str, ...]) -> Optional[Tuple[re.Pattern, Dict[str, str]]]:
+        """Build (or fetch) the pattern and substitution table for some buckets."""
+        if buckets not in self._compiled:
+            table: Dict[str, str] = {}
+            for bucket in buckets:
+                for word, replacement in self.rules.get(bucket, {}).items():
+                    # Match the lower, Capitalized and UPPER forms of each word
+                    for variant in (word.lower(), word.capitalize(), word.upper()):
+                        table[variant] = _match_case(variant, replacement)
+
+            if table:
+                # Each alternative starts with its literal so the regex engine
+                # can skip ahead quickly; the left word boundary is checked
+                # with a fixed-width lookbehind after the literal. Longest
+                # words go first so a word never loses to its own prefix.
+                alternatives = "|".join(
+                    f"{re.escape(word)}(?<!\\w{re.escape(word)})"
+                    for word in sorted(table, key=len, reverse=True)
+                )
+                self._compiled[buckets] = (re.compile(f"(?:{alternatives})\\b"), table)
+            else:
+                self._compiled[buckets] = None
+        return self._compiled[buckets]
+
+    def rewrite(self, text: str, buckets: Tuple[str, ...]) -> str:
+        """Apply the rules of every bucket to text in a single scan."""
+        compiled = self._compile(buckets)
+        if compiled is None:
+            return text
+        pattern, table = compiled
+        return pattern.sub(lambda match: table[match.group(0)], text)
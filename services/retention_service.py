@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Optional
+from services.memory_service import MemoryService
+
+logger = logging.getLogger(__name__)
+
+class RetentionService:
+    """Background job that enforces MEMORY_SETTINGS limits on the memory store.
+
+    Rows are deleted in bounded batches, each in its own short transaction on
+    the writer connection, and the job yields to the event loop between
+    batches so message handlers are never blocked for long.
+    """
+
+    def __init__(self, memory_service: MemoryService, settings: Dict[str, Any]):
+        self.memory_service = memory_service
+        self.max_memories = settings["max_memories"]
+        self.max_recent_interactions = settings["max_recent_interactions"]
+        self.importance_threshold = settings["importance_threshold"]
+        self.retention_days = settings["retention_days"]
+        self.interval = settings.get("retention_interval", 3600)
+        self.batch_size = settings.get("retention_batch_size", 500)
+        self.vacuum_pages_per_step = settings.get("vacuum_pages_per_step", 1000)
+        self.search_merge_pages_per_step = settings.get("search_merge_pages_per_step", 500)
+        self._task: Optional[asyncio.Task] = None
+        self.last_report: Dict[str, int] = {}
+
+    def start(self):
+        """Schedule the periodic retention run."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        """Cancel the periodic retention run."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error running retention job: {str(e)}")
+
+    async def _delete_batches(self, table: str, select_ids: str, params: tuple) -> int:
+        """Repeatedly delete the batch of ids chosen by select_ids, return the total."""
+        total = 0
+        while True:
+            async with self.memory_service.pool.transaction() as db:
+                cursor = await db.execute(f"DELETE FROM {table} WHERE id IN ({select_ids})", params)
+                deleted = cursor.rowcount
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            # Let queued handlers use the writer before the next batch
+            await asyncio.sleep(0)
+
+    async def _users_over_limit(self, table: str, limit: int) -> list:
+        async with self.memory_service.pool.reader() as db:
+            cursor = await db.execute(
+                f"SELECT user_id FROM {table} GROUP BY user_id HAVING COUNT(*) > ?",
+                (limit,)
+            )
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def _prune_memories(self) -> int:
+        deleted = 0
+
+        # Expire old, unimportant memories
+        deleted += await self._delete_batches(
+            "memories",
+            "SELECT id FROM memories WHERE created_at < datetime('now', ?) AND importance < ? LIMIT ?",
+            (f"-{int(self.retention_days)} days", self.importance_threshold, self.batch_size)
+        )
+
+        # Keep only the most important memories of each user
+        for user_id in await self._users_over_limit("memories", self.max_memories):
+            deleted += await self._delete_batches(
+                "memories",
+                "SELECT id FROM memories WHERE user_id = ? "
+                "ORDER BY importance DESC, created_at DESC LIMIT ? OFFSET ?",
+                (user_id, self.batch_size, self.max_memories)
+            )
+        return deleted
+
+    async def _prune_interactions(self) -> int:
+        deleted = 0
+
+        # Expire old interactions
+        deleted += await self._delete_batches(
+            "interaction_history",
+            "SELECT id FROM interaction_history WHERE created_at < datetime('now', ?) LIMIT ?",
+            (f"-{int(self.retention_days)} days", self.batch_size)
+        )
+
+        # Keep only the most recent interactions of each user
+        for user_id in await self._users_over_limit("interaction_history", self.max_recent_interactions):
+            deleted += await self._delete_batches(
+                "interaction_history",
+                "SELECT id FROM interaction_history WHERE user_id = ? "
+                "ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                (user_id, self.batch_size, self.max_recent_interactions)
+            )
+        return deleted
+
+    async def _prune_response_cache(self) -> int:
+        """Delete expired response cache entries in batches."""
+        deleted = 0
+        now = time.time()
+        while True:
+            batch = await self.memory_service.delete_expired_responses(now, self.batch_size)
+            deleted += batch
+            if batch < self.batch_size:
+                return deleted
+            await asyncio.sleep(0)
+
+    async def _page_count(self) -> int:
+        async with self.memory_service.pool.reader() as db:
+            cursor = await db.execute("PRAGMA page_count")
+            return (await cursor.fetchone())[0]
+
+    async def _incremental_vacuum(self) -> int:
+        """Release free pages to the filesystem in bounded steps, return pages freed."""
+        freed = 0
+        while True:
+            async with self.memory_service.pool.writer() as db:
+                cursor = await db.execute("PRAGMA freelist_count")
+                free_pages = (await cursor.fetchone())[0]
+                if free_pages == 0:
+                    return freed
+                cursor = await db.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages_per_step)})")
+                await cursor.fetchall()
+                await db.commit()
+                cursor = await db.execute("PRAGMA freelist_count")
+                remaining = (await cursor.fetchone())[0]
+            freed += free_pages - remaining
+            if remaining == 0 or remaining == free_pages:
+                return freed
+            await asyncio.sleep(0)
+
+    async def _merge_search_indexes(self) -> int:
+        """Merge the FTS index segments in bounded steps, return the steps taken.
+
+        Every flush adds a small segment, and a search probes each segment
+        once per term, so an unmerged index slowly makes searches slower.
+        """
+        steps = 0
+        for table in ("memories_fts", "interaction_fts"):
+            while True:
+                async with self.memory_service.pool.transaction() as db:
+                    cursor = await db.execute("SELECT total_changes()")
+                    before = (await cursor.fetchone())[0]
+                    # A negative page count also merges segments of different levels
+                    await db.execute(
+                        f"INSERT INTO {table}({table}, rank) VALUES ('merge', ?)",
+                        (-int(self.search_merge_pages_per_step),)
+                    )
+                    cursor = await db.execute("SELECT total_changes()")
+                    changes = (await cursor.fetchone())[0] - before
+                steps += 1
+                # Fewer than two changes means there was nothing left to merge
+                if changes < 2:
+                    break
+                await asyncio.sleep(0)
+        return steps
+
+    async def run_once(self) -> Dict[str, int]:
+        """Prune rows beyond the configured limits and reclaim the freed space."""
+        await self.memory_service.initialize()
+
+        async with self.memory_service.pool.reader() as db:
+            cursor = await db.execute("PRAGMA page_size")
+            page_size = (await cursor.fetchone())[0]
+        pages_before = await self._page_count()
+
+        memories = await self._prune_memories()
+        interactions = await self._prune_interactions()
+        cache_entries = await self._prune_response_cache()
+        await self._merge_search_indexes()
+        await self._incremental_vacuum()
+
+        pages_reclaimed = pages_before - await self._page_count()
+        self.last_report = {
+            "memories_deleted": memories,
+            "interactions_deleted": interactions,
+            "cache_entries_deleted": cache_entries,
+            "pages_reclaimed": pages_reclaimed,
+            "bytes_reclaimed": pages_reclaimed * page_size
+        }
+        logger.info(
+            f"Retention run deleted {memories} memories and {interactions} interactions, "
+            f"reclaimed {self.last_report['bytes_reclaimed']} bytes"
+        )
+        return self.last_report
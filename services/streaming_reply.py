@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def split_message(text: str, max_length: int) -> List[str]:
+    """Split text into pages Telegram accepts, preferring line breaks."""
+    pages = []
+    while len(text) > max_length:
+        cut = text.rfind("\n", max_length // 2, max_length)
+        if cut == -1:
+            cut = max_length
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pages.append(text)
+    return pages
+
+
+class StreamingReply:
+    """Show a growing response by editing the messages already sent.
+
+    The first update sends a message straight away; later updates edit it at
+    most once per edit_interval, so Telegram's flood limits are respected no
+    matter how fast chunks arrive. Text longer than one message continues in
+    new messages. render(text, final) turns the raw streamed text into what
+    is displayed; final is True only for the complete text in finish().
+    """
+
+    def __init__(self, message: Message, settings: Optional[Dict[str, Any]] = None,
+                 render: Optional[Callable[[str, bool], str]] = None):
+        self.message = message
+        self.settings = settings or {}
+        self.edit_interval = self.settings.get("edit_interval", 1.0)
+        self.min_edit_chars = self.settings.get("min_edit_chars", 20)
+        self.max_length = self.settings.get("max_message_length", 4096)
+        self.render = render or (lambda text, final: text)
+
+        self.sent: List[Message] = []
+        self.shown: List[str] = []
+        self.edits = 0
+        self._last_edit = 0.0
+        self._not_before = 0.0
+        # Length of the raw text behind what is shown
+        self._shown_length = 0
+
+    async def update(self, text: str):
+        """Show the text streamed so far if an edit is due."""
+        # Rendering is skipped for chunks that would not be shown anyway
+        if self.sent:
+            now = time.monotonic()
+            if now < self._not_before or now - self._last_edit < self.edit_interval:
+                return
+            if len(text) - self._shown_length < self.min_edit_chars:
+                return
+
+        rendered = self.render(text, False)
+        if not rendered.strip():
+            return
+        if await self._show(rendered):
+            self._shown_length = len(text)
+
+    async def finish(self, text: str) -> str:
+        """Show the complete text, waiting out any flood limit, and return it."""
+        rendered = self.render(text, True)
+        if not rendered.strip():
+            return rendered
+
+        delay = self._not_before - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not await self._show(rendered):
+            # One more try once the limit Telegram asked for has passed
+            await asyncio.sleep(max(0.0, self._not_before - time.monotonic()))
+            await self._show(rendered)
+        return rendered
+
+    async def _show(self, rendered: str) -> bool:
+        """Send or edit the pages that changed; return False if rate limited."""
+        pages = split_message(rendered, self.max_length)
+        try:
+            for index, page in enumerate(pages):
+                if index == len(self.sent):
+                    self.sent.append(await self.message.reply_text(page))
+                    self.shown.append(page)
+                elif page != self.shown[index]:
+                    try:
+                        await self.sent[index].edit_text(page)
+                    except BadRequest as e:
+                        # Editing to identical text is rejected; nothing to do
+                        if "not modified" not in str(e):
+                            raise
+                    self.shown[index] = page
+                    self.edits += 1
+            # Post-processing can shorten the text; drop pages it no longer fills
+            while len(self.sent) > len(pages):
+                await self.sent.pop().delete()
+                self.shown.pop()
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, "total_seconds"):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Telegram asked to slow down edits for {retry_after}s")
+            self._not_before = time.monotonic() + retry_after
+            return False
+        self._last_edit = time.monotonic()
+        return True
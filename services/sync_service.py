@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+from services.memory_service import MemoryService
+from services.learning_service import LearningService
+from services.personality_service import PersonalityService
+from services.nlp_executor import NLPExecutor
+
+logger = logging.getLogger(__name__)
+
+class SyncService:
+    """Feeds stored interactions the learning services have not seen yet.
+
+    Each user has a watermark: the id of the last interaction the sync has
+    scanned. A sync only reads rows above it, skips rows that were learned
+    live by handle_message, and analyzes the rest as one batch.
+    """
+
+    def __init__(self, memory_service: MemoryService, learning_service: LearningService,
+                 personality_service: PersonalityService, nlp_executor: NLPExecutor,
+                 settings: Optional[Dict[str, Any]] = None):
+        settings = settings or {}
+        self.memory_service = memory_service
+        self.learning_service = learning_service
+        self.personality_service = personality_service
+        self.nlp_executor = nlp_executor
+        self.interval = settings.get("interval", 300)
+        self.batch_size = settings.get("batch_size", 200)
+        self.max_users_per_run = settings.get("max_users_per_run", 100)
+        self._task: Optional[asyncio.Task] = None
+        # Highest interaction id already covered by a background run
+        self._scan_watermark = 0
+
+    def start(self):
+        """Schedule the periodic background sync of all active users."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        """Cancel the periodic background sync."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync_active_users()
+            except Exception as e:
+                logger.error(f"Error running background sync: {str(e)}")
+
+    async def sync_user(self, user_id: int) -> int:
+        """Learn from a user's interactions above their watermark; return how many."""
+        self.learning_service.pin(user_id)
+        self.personality_service.pin(user_id)
+        try:
+            await self.learning_service.load_user(user_id)
+            await self.personality_service.load_user(user_id)
+            watermark = await self.memory_service.get_sync_watermark(user_id)
+            processed = 0
+
+            while True:
+                rows = await self.memory_service.get_interactions_after(user_id, watermark, self.batch_size)
+                if not rows:
+                    break
+
+                messages = [row["message"] for row in rows if not row["learned"]]
+                if messages:
+                    analyses = await self.nlp_executor.analyze_many(messages)
+                    self.learning_service.process_batch(user_id, analyses)
+                    self.personality_service.adapt_to_batch(user_id, analyses)
+                    processed += len(messages)
+
+                watermark = rows[-1]["id"]
+                await self.memory_service.set_sync_watermark(user_id, watermark)
+                if len(rows) < self.batch_size:
+                    break
+                await asyncio.sleep(0)
+        finally:
+            self.learning_service.unpin(user_id)
+            self.personality_service.unpin(user_id)
+
+        return processed
+
+    async def sync_active_users(self) -> Dict[str, int]:
+        """Sync every user with unlearned interactions since the last background run."""
+        users = await self.memory_service.get_unlearned_users(self._scan_watermark, self.max_users_per_run)
+        processed = 0
+        for user_id, _ in users:
+            processed += await self.sync_user(user_id)
+
+        # Skip the rows covered here on later runs, unless the user limit
+        # left some for the next run
+        if users and len(users) < self.max_users_per_run:
+            self._scan_watermark = max(self._scan_watermark, max(newest for _, newest in users))
+
+        # Hot users are otherwise only written back when evicted or at shutdown
+        self.learning_service.flush()
+
+        if processed:
+            logger.info(f"Background sync learned from {processed} interactions of {len(users)} users")
+        return {"users": len(users), "interactions": processed}
@@ -1,8 +1,10 @@
 import nltk
+from config.config import NLTK_DATA_DIR
 
-# Download required NLTK data
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('punkt_tab')
-nltk.download('averaged_perceptron_tagger')
-nltk.download('wordnet')
+# Download required NLTK data into the local bundle the bot loads from
+nltk.download('punkt', download_dir=NLTK_DATA_DIR)
+nltk.download('stopwords', download_dir=NLTK_DATA_DIR)
+nltk.download('punkt_tab', download_dir=NLTK_DATA_DIR)
+nltk.download('averaged_perceptron_tagger', download_dir=NLTK_DATA_DIR)
+nltk.download('wordnet', download_dir=NLTK_DATA_DIR)
+nltk.download('vader_lexicon', download_dir=NLTK_DATA_DIR)
@@ -0,0 +1,119 @@
+import asyncio
+
+from services.dispatcher import UserDispatcher
+
+
+def test_jobs_run_in_order_per_user_and_concurrently_across_users():
+    async def scenario():
+        dispatcher = UserDispatcher({"max_concurrent": 4})
+        calls = []
+        running = {}
+        overlapped = []
+
+        async def handler(key, number):
+            running[key] = running.get(key, 0) + 1
+            if running[key] > 1:
+                overlapped.append(key)
+            calls.append((key, number))
+            await asyncio.sleep(0.01)
+            running[key] -= 1
+
+        for number in range(5):
+            for key in ("a", "b"):
+                assert dispatcher.submit(key, handler, key, number)
+        await dispatcher.stop()
+        return dispatcher, calls, overlapped
+
+    dispatcher, calls, overlapped = asyncio.run(scenario())
+
+    assert [number for key, number in calls if key == "a"] == list(range(5))
+    assert [number for key, number in calls if key == "b"] == list(range(5))
+    # The users' jobs interleave instead of one user waiting for the other
+    assert calls[:2] == [("a", 0), ("b", 0)]
+    assert overlapped == []
+    assert dispatcher.processed == 10
+    assert dispatcher.metrics()["active_users"] == 0
+
+
+def test_overflow_merges_texts_into_the_last_queued_message():
+    async def scenario():
+        dispatcher = UserDispatcher({"max_queue_per_user": 1, "overflow": "merge"})
+        started = asyncio.Event()
+        release = asyncio.Event()
+        texts = []
+
+        async def handler(update, text=None):
+            texts.append((update, text))
+            started.set()
+            await release.wait()
+
+        dispatcher.submit(1, handler, "u1", text="first")
+        await started.wait()
+        # The first message is running, so the queue holds one more
+        dispatcher.submit(1, handler, "u2", text="second")
+        dispatcher.submit(1, handler, "u3", text="third")
+        dispatcher.submit(1, handler, "u4", text="fourth")
+        release.set()
+        await dispatcher.stop()
+        return dispatcher, texts
+
+    dispatcher, texts = asyncio.run(scenario())
+
+    # The merged job is answered as the newest update with every text
+    assert texts == [("u1", "first"), ("u4", "second\nthird\nfourth")]
+    assert dispatcher.merged == 2
+    assert dispatcher.dropped == 0
+
+
+def test_overflow_drops_the_oldest_message_but_never_a_command():
+    async def scenario():
+        dispatcher = UserDispatcher({"max_queue_per_user": 2, "overflow": "merge"})
+        started = asyncio.Event()
+        release = asyncio.Event()
+        calls = []
+
+        async def command(name):
+            calls.append(name)
+            started.set()
+            await release.wait()
+
+        async def message(name, text=None):
+            calls.append(text)
+
+        dispatcher.submit(1, command, "running")
+        await started.wait()
+        dispatcher.submit(1, command, "/clear")
+        dispatcher.submit(1, message, "u1", text="hello")
+        # A command cannot be merged; the queued message makes way for it
+        accepted = [dispatcher.submit(1, command, "/stats")]
+        # Only commands are queued now, so the next one is turned away
+        accepted.append(dispatcher.submit(1, command, "/mood"))
+        release.set()
+        await dispatcher.stop()
+        return dispatcher, accepted, calls
+
+    dispatcher, accepted, calls = asyncio.run(scenario())
+
+    assert accepted == [True, False]
+    assert calls == ["running", "/clear", "/stats"]
+    assert dispatcher.dropped == 1
+    assert dispatcher.rejected == 1
+
+
+def test_drop_newest_rejects_jobs_once_the_queue_is_full():
+    async def scenario():
+        dispatcher = UserDispatcher({"max_queue_per_user": 2, "overflow": "drop_newest"})
+        calls = []
+
+        async def handler(number):
+            calls.append(number)
+
+        accepted = [dispatcher.submit(1, handler, number) for number in range(3)]
+        await dispatcher.stop()
+        return dispatcher, accepted, calls
+
+    dispatcher, accepted, calls = asyncio.run(scenario())
+
+    assert accepted == [True, True, False]
+    assert calls == [0, 1]
+    assert dispatcher.rejected == 1
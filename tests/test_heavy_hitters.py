@@ -0,0 +1,74 @@
+import json
+import random
+from collections import Counter
+
+import pytest
+
+from services.heavy_hitters import SpaceSaving
+
+
+def skewed_stream(seed: int, length: int = 5000) -> list:
+    rng = random.Random(seed)
+    # A few heavy items over a long tail of rare ones
+    return [f"w{int(rng.paretovariate(1.2))}" for _ in range(length)]
+
+
+def test_counts_are_exact_below_capacity():
+    sketch = SpaceSaving(10)
+    sketch.update(["a", "b", "a"])
+    sketch.update({"c": 2, "a": 1})
+
+    assert sketch.counts == {"a": 3, "b": 1, "c": 2}
+    assert sketch.errors == {"a": 0, "b": 0, "c": 0}
+    assert sketch.most_common(2) == [("a", 3), ("c", 2)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_estimates_bound_the_true_counts(seed):
+    stream = skewed_stream(seed)
+    truth = Counter(stream)
+    capacity = 20
+    sketch = SpaceSaving(capacity)
+    for item in stream:
+        sketch.add(item)
+
+    assert len(sketch) == capacity
+    # Every occurrence is counted once, by whichever item holds the slot
+    assert sum(sketch.counts.values()) == len(stream)
+    for item, count in sketch.counts.items():
+        assert 0 <= sketch.errors[item] <= count
+        assert count - sketch.errors[item] <= truth[item] <= count
+    # Items seen more than N / capacity times are always tracked
+    for item, count in truth.items():
+        if count > len(stream) / capacity:
+            assert item in sketch.counts
+
+
+def test_a_new_item_takes_over_the_minimum_slot():
+    sketch = SpaceSaving(2)
+    sketch.update({"a": 5, "b": 2})
+    sketch.add("c")
+
+    assert sketch.counts == {"a": 5, "c": 3}
+    assert sketch.errors == {"a": 0, "c": 2}
+
+
+def test_stored_sketches_round_trip_through_json():
+    sketch = SpaceSaving(3)
+    sketch.update(["a", "a", "b", "c", "d", "a"])
+    stored = json.loads(json.dumps(sketch.to_list()))
+
+    restored = SpaceSaving.from_stored(3, stored)
+    assert (restored.counts, restored.errors) == (sketch.counts, sketch.errors)
+
+    # A smaller capacity keeps the heaviest items
+    shrunk = SpaceSaving.from_stored(1, stored)
+    assert shrunk.counts == {"a": 3}
+
+
+def test_plain_counters_load_with_no_error():
+    sketch = SpaceSaving.from_stored(5, {"hello there": 4, "good morning": 1})
+
+    assert sketch.counts == {"hello there": 4, "good morning": 1}
+    assert sketch.errors == {"hello there": 0, "good morning": 0}
+    assert len(SpaceSaving.from_stored(5, None)) == 0
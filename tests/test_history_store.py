@@ -0,0 +1,109 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import services.history_store
+from services.history_store import HistoryStore
+
+
+class FakeMemory:
+    """Interactions by user, newest first like get_recent_interactions."""
+
+    def __init__(self, interactions=None, error=None):
+        self.interactions = interactions or {}
+        self.error = error
+        self.calls = 0
+
+    async def get_recent_interactions(self, user_id, limit=10):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.interactions.get(user_id, [])[:limit]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(services.history_store, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def contents(history):
+    return [turn["content"] for turn in history]
+
+
+def test_each_user_keeps_only_the_newest_turns():
+    store = HistoryStore(settings={"max_messages": 4})
+    for number in range(3):
+        store.append_exchange(1, f"message {number}", f"response {number}")
+
+    history = asyncio.run(store.get(1))
+
+    assert contents(history) == ["message 1", "response 1", "message 2", "response 2"]
+    assert [turn["role"] for turn in history] == ["user", "assistant"] * 2
+
+
+def test_the_least_recently_active_users_are_evicted_beyond_max_users(clock):
+    store = HistoryStore(settings={"max_users": 2})
+    store.append(1, "user", "one")
+    store.append(2, "user", "two")
+    # Reading user 1 makes user 2 the least recently active
+    asyncio.run(store.get(1))
+    store.append(3, "user", "three")
+
+    assert list(store._histories) == [1, 3]
+    assert store.metrics() == {"users": 2, "reloads": 0, "evictions": 1}
+
+
+def test_idle_users_are_evicted(clock):
+    store = HistoryStore(settings={"idle_timeout": 60})
+    store.append(1, "user", "old")
+    clock.now += 30
+    store.append(2, "user", "recent")
+    clock.now += 31
+
+    assert contents(asyncio.run(store.get(2))) == ["recent"]
+    assert len(store) == 1
+    assert store.evictions == 1
+
+
+def test_an_evicted_user_is_reloaded_from_stored_interactions():
+    memory = FakeMemory({1: [
+        {"message": "newest", "response": "reply 2"},
+        {"message": "unanswered", "response": None},
+        {"message": "oldest", "response": "reply 1"},
+    ]})
+    store = HistoryStore(memory, {"max_messages": 6})
+
+    history = asyncio.run(store.get(1))
+    again = asyncio.run(store.get(1))
+
+    assert contents(history) == ["oldest", "reply 1", "unanswered", "newest", "reply 2"]
+    assert again == history
+    assert (memory.calls, store.reloads) == (1, 1)
+
+
+def test_a_failed_reload_starts_an_empty_conversation():
+    store = HistoryStore(FakeMemory(error=RuntimeError("database is locked")))
+
+    assert asyncio.run(store.get(1)) == []
+    assert store.reloads == 0
+
+
+def test_a_reset_conversation_is_not_reloaded():
+    memory = FakeMemory({1: [{"message": "stored", "response": "reply"}]})
+    store = HistoryStore(memory)
+
+    store.reset(1)
+
+    assert asyncio.run(store.get(1)) == []
+    assert memory.calls == 0
+
+
+def test_nothing_is_reloaded_with_reload_off():
+    memory = FakeMemory({1: [{"message": "stored", "response": "reply"}]})
+    store = HistoryStore(memory, {"reload": False})
+
+    assert asyncio.run(store.get(1)) == []
+    assert memory.calls == 0
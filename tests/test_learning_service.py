@@ -0,0 +1,126 @@
+import asyncio
+import json
+from collections import Counter
+
+from services.learning_service import LearningService
+from services.message_analysis import MessageAnalysis
+
+
+class FakeMemory:
+    """Stored preferences by user, and every write handed over."""
+
+    def __init__(self, stored=None):
+        self.stored = dict(stored or {})
+        self.queued = []
+
+    async def get_user_preferences(self, user_id):
+        return self.stored.get(user_id)
+
+    def queue_user_preferences(self, user_id, preferences):
+        self.queued.append(user_id)
+        # Round-trip through JSON as the real store does
+        self.stored[user_id] = json.loads(json.dumps(preferences))
+
+
+def analysis(text: str) -> MessageAnalysis:
+    tokens = text.lower().split()
+    bigrams = Counter(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+    return MessageAnalysis(text, tokens, tokens, bigrams,
+                           {"formal": 0, "casual": 0, "technical": 0}, len(tokens), {})
+
+
+def learn(service: LearningService, user_id: int, text: str = "hello there"):
+    service.process_message(user_id, text, analysis(text))
+
+
+def test_the_least_recently_used_user_is_evicted_and_persisted_if_dirty():
+    memory = FakeMemory()
+    service = LearningService(memory, {"max_cached_users": 2})
+
+    learn(service, 1)
+    service.get_response_context(2)
+    # Touching user 1 makes user 2 the least recently used
+    service.get_response_context(1)
+    learn(service, 3)
+    assert list(service.user_data) == [1, 3]
+    # User 2 never learned anything, so there was nothing to write
+    assert memory.queued == []
+
+    service.get_response_context(4)
+    assert list(service.user_data) == [3, 4]
+    assert memory.queued == [1]
+    assert memory.stored[1]["message_count"] == 1
+
+
+def test_pinned_users_are_never_evicted():
+    memory = FakeMemory()
+    service = LearningService(memory, {"max_cached_users": 2})
+
+    learn(service, 1)
+    service.pin(1)
+    service.pin(1)
+    learn(service, 2)
+    learn(service, 3)
+    assert list(service.user_data) == [1, 3]
+
+    # Evictable again only once every pin is released
+    service.unpin(1)
+    learn(service, 4)
+    assert 1 in service.user_data
+    service.unpin(1)
+    learn(service, 5)
+    assert list(service.user_data) == [4, 5]
+    assert memory.queued == [2, 3, 1]
+
+
+def test_a_new_user_is_cached_even_if_every_other_user_is_pinned():
+    service = LearningService(FakeMemory(), {"max_cached_users": 1})
+
+    learn(service, 1)
+    service.pin(1)
+    learn(service, 2)
+    assert list(service.user_data) == [1, 2]
+
+    service.unpin(1)
+    learn(service, 3)
+    assert list(service.user_data) == [3]
+
+
+def test_flush_persists_dirty_users_once():
+    memory = FakeMemory()
+    service = LearningService(memory)
+
+    learn(service, 1)
+    learn(service, 1)
+    service.get_response_context(2)
+    service.flush()
+    service.flush()
+
+    assert memory.queued == [1]
+    assert memory.stored[1]["message_count"] == 2
+
+
+def test_an_evicted_user_is_reloaded_from_the_store():
+    memory = FakeMemory()
+    service = LearningService(memory, {"max_cached_users": 1})
+
+    learn(service, 1, "tea tea please")
+    learn(service, 2)
+    asyncio.run(service.load_user(1))
+
+    context = service.get_response_context(1)
+    assert context["message_count"] == 1
+    assert context["topics"] == ["tea"]
+    assert context["patterns"] == {"tea tea": 1, "tea please": 1}
+
+
+def test_cleared_users_are_not_written_back():
+    memory = FakeMemory()
+    service = LearningService(memory)
+
+    learn(service, 1)
+    service.clear_user_data(1)
+    service.flush()
+
+    assert memory.queued == []
+    assert 1 not in service.user_data
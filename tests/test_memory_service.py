@@ -0,0 +1,210 @@
+import asyncio
+import sqlite3
+from contextlib import asynccontextmanager
+
+import pytest
+
+from services.memory_service import MemoryService
+
+# Keep the background flusher out of the way; tests flush explicitly
+MANUAL_FLUSH = {"batch_size": 10 ** 6, "flush_interval": 3600}
+
+
+def open_memory(tmp_path) -> MemoryService:
+    return MemoryService(str(tmp_path / "memory.db"), None, MANUAL_FLUSH)
+
+
+class HeldCommit:
+    """Stops a flush after its writes, before the commit, until released."""
+
+    def __init__(self, memory: MemoryService):
+        self.memory = memory
+        self.transaction = memory.pool.transaction
+        self.written = asyncio.Event()
+        self.release = asyncio.Event()
+
+    @asynccontextmanager
+    async def held(self):
+        async with self.transaction() as db:
+            yield db
+            self.written.set()
+            await self.release.wait()
+
+    async def flush(self) -> int:
+        """Flush with the commit held; returns once released and committed."""
+        self.memory.pool.transaction = self.held
+        try:
+            return await self.memory.flush()
+        finally:
+            self.memory.pool.transaction = self.transaction
+
+
+@asynccontextmanager
+async def failing_transaction():
+    raise sqlite3.OperationalError("database is locked")
+    yield
+
+
+def contents(rows):
+    return sorted(row["content"] for row in rows)
+
+
+def test_buffered_writes_commit_together_in_one_flush(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            await memory.store_memory(1, "likes tea", "preference")
+            await memory.store_memory(1, "lives in Oslo", "fact")
+            await memory.store_interaction(1, "hi", "hello")
+            memory.queue_user_preferences(1, {"message_count": 1})
+            pending = memory.pending_writes()
+            flushed = await memory.flush()
+            again = await memory.flush()
+            return pending, flushed, again, memory.metrics(), await memory.get_memories(1)
+        finally:
+            await memory.close()
+
+    pending, flushed, again, metrics, memories = asyncio.run(scenario())
+
+    assert (pending, flushed, again) == (4, 4, 0)
+    assert metrics == {"pending_writes": 0, "flushes": 1, "flushed_rows": 4}
+    assert contents(memories) == ["likes tea", "lives in Oslo"]
+
+
+def test_a_full_batch_wakes_the_flusher(tmp_path):
+    async def scenario():
+        memory = MemoryService(str(tmp_path / "memory.db"), None, {"batch_size": 2, "flush_interval": 3600})
+        await memory.initialize()
+        try:
+            await memory.store_memory(1, "one", "fact")
+            await asyncio.sleep(0.05)
+            before = memory.pending_writes()
+            await memory.store_memory(1, "two", "fact")
+            for _ in range(50):
+                if memory.flush_count:
+                    break
+                await asyncio.sleep(0.01)
+            return before, memory.pending_writes(), memory.flush_count
+        finally:
+            await memory.close()
+
+    assert asyncio.run(scenario()) == (1, 0, 1)
+
+
+def test_a_failed_flush_requeues_its_rows_behind_newer_values(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            await memory.store_memory(1, "older", "fact")
+            memory.queue_user_preferences(1, {"message_count": 1})
+            transaction, memory.pool.transaction = memory.pool.transaction, failing_transaction
+            with pytest.raises(sqlite3.OperationalError):
+                await memory.flush()
+            memory.pool.transaction = transaction
+            requeued = memory.pending_writes()
+
+            # Values buffered after the failure win over the re-queued ones
+            await memory.store_memory(1, "newer", "fact")
+            memory.queue_user_preferences(1, {"message_count": 2})
+            flushed = await memory.flush()
+            return (requeued, flushed, await memory.get_memories(1),
+                    await memory.get_user_preferences(1))
+        finally:
+            await memory.close()
+
+    requeued, flushed, memories, preferences = asyncio.run(scenario())
+
+    assert (requeued, flushed) == (2, 3)
+    assert contents(memories) == ["newer", "older"]
+    assert preferences == {"message_count": 2}
+
+
+def test_clearing_a_user_drops_buffered_and_stored_rows(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            await memory.store_memory(1, "stored", "fact")
+            await memory.store_memory(2, "other user", "fact")
+            await memory.flush()
+            await memory.store_memory(1, "buffered", "fact")
+            await memory.store_interaction(1, "hi", "hello")
+            memory.queue_user_preferences(1, {"message_count": 1})
+            memory.queue_personality(1, b"state")
+
+            await memory.clear_user_data(1)
+            await memory.flush()
+            return (await memory.get_memories(1), await memory.get_recent_interactions(1),
+                    await memory.get_user_preferences(1), await memory.get_personality(1),
+                    await memory.get_memories(2))
+        finally:
+            await memory.close()
+
+    memories, interactions, preferences, personality, other = asyncio.run(scenario())
+
+    assert (memories, interactions, preferences, personality) == ([], [], None, None)
+    assert contents(other) == ["other user"]
+
+
+def test_preferences_being_flushed_stay_readable_until_committed(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            memory.queue_user_preferences(1, {"message_count": 1})
+            await memory.flush()
+            memory.queue_user_preferences(1, {"message_count": 2})
+
+            commit = HeldCommit(memory)
+            flushing = asyncio.create_task(commit.flush())
+            await commit.written.wait()
+            during = await memory.get_user_preferences(1)
+            commit.release.set()
+            await flushing
+            return during, await memory.get_user_preferences(1)
+        finally:
+            await memory.close()
+
+    assert asyncio.run(scenario()) == ({"message_count": 2}, {"message_count": 2})
+
+
+def test_personalities_being_flushed_stay_readable_until_committed(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            memory.queue_personality(1, b"old")
+            await memory.flush()
+            memory.queue_personality(1, b"new")
+
+            commit = HeldCommit(memory)
+            flushing = asyncio.create_task(commit.flush())
+            await commit.written.wait()
+            during = await memory.get_personality(1)
+            commit.release.set()
+            await flushing
+            return during, await memory.get_personality(1)
+        finally:
+            await memory.close()
+
+    assert asyncio.run(scenario()) == (b"new", b"new")
+
+
+def test_words_after_punctuation_are_searchable(tmp_path):
+    async def scenario():
+        memory = open_memory(tmp_path)
+        await memory.initialize()
+        try:
+            await memory.store_memory(1, "Loves pizza,pasta and rock-climbing", "preference")
+            await memory.store_memory(2, "Also loves pasta", "preference")
+            await memory.flush()
+            return [
+                [row["content"] for row in await memory.search_relevant(1, query)]
+                for query in ("pasta?", "climbing", "(pizza/risotto)")
+            ]
+        finally:
+            await memory.close()
+
+    assert asyncio.run(scenario()) == [["Loves pizza,pasta and rock-climbing"]] * 3
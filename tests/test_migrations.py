@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+
+from services.memory_service import MemoryService
+from services.migrations import MIGRATIONS, apply_migrations
+
+LATEST = max(migration.version for migration in MIGRATIONS)
+
+# Schema the memory store created before versioned migrations existed
+PRE_SERIES_SCHEMA = """
+CREATE TABLE memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    type TEXT NOT NULL,
+    importance REAL DEFAULT 1.0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE interaction_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    response TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE user_preferences (
+    user_id INTEGER PRIMARY KEY,
+    preferences TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def schema(path: str) -> dict:
+    db = sqlite3.connect(path)
+    try:
+        rows = db.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'").fetchall()
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        db.close()
+    objects = {}
+    for kind, name in rows:
+        objects.setdefault(kind, set()).add(name)
+    return {"version": version, **objects}
+
+
+async def migrate(path: str) -> int:
+    async with aiosqlite.connect(path) as db:
+        return await apply_migrations(db)
+
+
+def test_migrates_an_empty_database_to_the_latest_version(tmp_path):
+    path = str(tmp_path / "fresh.db")
+
+    assert asyncio.run(migrate(path)) == LATEST
+    objects = schema(path)
+
+    assert objects["version"] == LATEST
+    assert {"memories", "interaction_history", "user_preferences", "sync_state",
+            "response_cache", "user_personality", "memories_fts", "interaction_fts"} <= objects["table"]
+    assert {"idx_memories_user_importance", "idx_interaction_user_created_id",
+            "idx_interaction_user_id"} <= objects["index"]
+    # Replaced by the index with the id tie-break
+    assert "idx_interaction_user_created" not in objects["index"]
+    assert {"memories_fts_insert", "interaction_fts_insert"} <= objects["trigger"]
+
+
+def test_migrating_again_changes_nothing(tmp_path):
+    path = str(tmp_path / "fresh.db")
+    asyncio.run(migrate(path))
+    before = schema(path)
+
+    assert asyncio.run(migrate(path)) == LATEST
+    assert schema(path) == before
+
+
+def test_migrates_a_populated_pre_series_database(tmp_path):
+    path = str(tmp_path / "old.db")
+    db = sqlite3.connect(path)
+    db.executescript(PRE_SERIES_SCHEMA)
+    db.executemany("INSERT INTO memories (user_id, content, type, importance) VALUES (?, ?, ?, ?)",
+                   [(1, "My sister lives in Lisbon", "user_note", 1.0),
+                    (2, "Allergic to peanuts", "user_note", 1.5)])
+    db.executemany("INSERT INTO interaction_history (user_id, message, response) VALUES (?, ?, ?)",
+                   [(1, "Tell me about Lisbon trams", "Tram 28 is the famous one."),
+                    (2, "Recipe without peanuts?", "Try a chickpea curry.")])
+    # Preferences used to be stored as a Python dict repr
+    db.execute("INSERT INTO user_preferences (user_id, preferences) VALUES (?, ?)",
+               (1, str({"topics": ["lisbon"], "message_count": 3})))
+    db.commit()
+    db.close()
+
+    async def scenario():
+        memory = MemoryService(path)
+        await memory.initialize()
+        try:
+            return (
+                memory.schema_version,
+                await memory.get_memories(1),
+                await memory.get_recent_interactions(1),
+                await memory.get_user_preferences(1),
+                await memory.search_relevant(1, "what about lisbon?"),
+                await memory.search_relevant(2, "lisbon"),
+                await memory.get_unlearned_users(0),
+            )
+        finally:
+            await memory.close()
+
+    version, memories, interactions, preferences, matches, other_user, unlearned = asyncio.run(scenario())
+
+    assert version == LATEST
+    assert [memory["content"] for memory in memories] == ["My sister lives in Lisbon"]
+    assert [interaction["message"] for interaction in interactions] == ["Tell me about Lisbon trams"]
+    assert preferences == {"topics": ["lisbon"], "message_count": 3}
+    # Rows from before the search indexes existed are indexed per user
+    assert {(match["source"], match["content"]) for match in matches} == {
+        ("memory", "My sister lives in Lisbon"), ("interaction", "Tell me about Lisbon trams")
+    }
+    assert other_user == []
+    # Old interactions were never learned from, so the sync picks them up
+    assert unlearned == [(1, 1), (2, 2)]
+
+    db = sqlite3.connect(path)
+    try:
+        for table in ("memories_fts", "interaction_fts"):
+            db.execute(f"INSERT INTO {table}({table}, rank) VALUES ('integrity-check', 1)")
+    finally:
+        db.close()
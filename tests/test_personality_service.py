@@ -0,0 +1,131 @@
+import asyncio
+from array import array
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+import services.personality_service
+from services.message_analysis import MessageAnalysis
+from services.personality_service import (
+    MAX_STATE_DURATION, STATE_RECORD, TRAIT_NAMES, EmotionalState, PersonalityService, PersonalityState
+)
+
+
+class FakeMemory:
+    def __init__(self, stored=None):
+        self.stored = dict(stored or {})
+        self.queued = []
+
+    async def get_personality(self, user_id):
+        return self.stored.get(user_id)
+
+    def queue_personality(self, user_id, record):
+        self.queued.append(user_id)
+        self.stored[user_id] = record
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1_700_000_000.0)
+    monkeypatch.setattr(services.personality_service, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def analysis(compound: float, text: str = "fine") -> MessageAnalysis:
+    tokens = text.split()
+    return MessageAnalysis(text, tokens, tokens, Counter(), {"formal": 0, "casual": 0, "technical": 0},
+                           len(tokens), {"compound": compound})
+
+
+def test_states_pack_into_a_fixed_size_record_and_back():
+    state = PersonalityState(array("f", [0.1, 0.2, 0.3, 0.4, 1.0]), EmotionalState.CURIOUS,
+                             1_700_000_123.5, MAX_STATE_DURATION)
+
+    record = state.pack()
+    restored = PersonalityState.unpack(record)
+
+    assert len(record) == STATE_RECORD.size == 31
+    assert restored.traits.tolist() == pytest.approx([0.1, 0.2, 0.3, 0.4, 1.0])
+    assert (restored.state, restored.changed_at, restored.duration) == (
+        EmotionalState.CURIOUS, 1_700_000_123.5, MAX_STATE_DURATION
+    )
+
+
+def test_traits_are_kept_between_zero_and_one():
+    state = PersonalityState(array("f", [0.98, 0.02, 0.5, 0.5, 0.5]), EmotionalState.NEUTRAL, 0.0, 60)
+
+    state.adjust("openness", 0.05)
+    state.adjust("conscientiousness", -0.05)
+
+    assert (state.trait("openness"), state.trait("conscientiousness")) == (1.0, 0.0)
+
+
+@pytest.mark.parametrize("minutes, expected", [
+    ({"min_minutes": 5, "max_minutes": 15}, (300, 900)),
+    # Longer than the record can hold
+    ({"min_minutes": 2000, "max_minutes": 3000}, (MAX_STATE_DURATION, MAX_STATE_DURATION)),
+    # A minimum above the maximum
+    ({"min_minutes": 20, "max_minutes": 10}, (600, 600)),
+])
+def test_state_durations_are_clamped_to_what_a_record_holds(minutes, expected):
+    service = PersonalityService(settings={"emotional_state_duration": minutes})
+
+    assert (service.min_duration, service.max_duration) == expected
+    # Every new state must pack
+    service.adapt_to_user(1, "fine", analysis(0.0))
+    assert expected[0] <= PersonalityState.unpack(service.records[1]).duration <= expected[1]
+
+
+def test_a_state_changes_once_its_duration_has_passed(clock):
+    service = PersonalityService(settings={"emotional_state_duration": {"min_minutes": 1, "max_minutes": 1}})
+    asyncio.run(service.load_user(1))
+
+    assert service.get_current_state(1) is EmotionalState.NEUTRAL
+    clock.now += 59
+    assert service.get_current_state(1) is EmotionalState.NEUTRAL
+    clock.now += 2
+    changed = service.get_current_state(1)
+
+    assert changed is not EmotionalState.NEUTRAL
+    assert PersonalityState.unpack(service.records[1]).changed_at == clock.now
+
+
+def test_changed_states_are_queued_and_unchanged_ones_are_not():
+    memory = FakeMemory()
+    service = PersonalityService(memory_service=memory)
+    asyncio.run(service.load_user(1))
+
+    service.adapt_to_user(1, "fine", analysis(0.0))
+    service.adapt_to_user(1, "great", analysis(0.4))
+    summary = service.get_personality_summary(1)
+
+    assert memory.queued == [1]
+    assert summary["traits"]["extraversion"] == pytest.approx(0.65)
+    assert set(summary["traits"]) == set(TRAIT_NAMES)
+
+
+def test_pinned_users_are_never_evicted():
+    memory = FakeMemory()
+    service = PersonalityService(memory_service=memory, settings={"max_cached_users": 1})
+
+    asyncio.run(service.load_user(1))
+    service.pin(1)
+    asyncio.run(service.load_user(2))
+    assert list(service.records) == [1, 2]
+
+    service.unpin(1)
+    asyncio.run(service.load_user(3))
+    assert list(service.records) == [3]
+
+
+def test_an_evicted_user_is_reloaded_from_the_store():
+    memory = FakeMemory()
+    service = PersonalityService(memory_service=memory, settings={"max_cached_users": 1})
+
+    asyncio.run(service.load_user(1))
+    service.adapt_to_user(1, "great", analysis(0.4))
+    asyncio.run(service.load_user(2))
+    asyncio.run(service.load_user(1))
+
+    assert service.get_personality_summary(1)["traits"]["extraversion"] == pytest.approx(0.65)
@@ -0,0 +1,110 @@
+import asyncio
+
+from services.prompt_builder import MESSAGE_OVERHEAD_TOKENS, PromptBuilder, estimate_tokens
+
+
+class FakeMemory:
+    def __init__(self, relevant=(), important=()):
+        self.relevant = [{"content": text} for text in relevant]
+        self.important = [{"content": text} for text in important]
+        self.loads = 0
+
+    async def search_relevant(self, user_id, text, k=3):
+        return self.relevant[:k]
+
+    async def get_memories(self, user_id, memory_type=None, limit=10):
+        self.loads += 1
+        return self.important[:limit]
+
+
+class FakeLearning:
+    def __init__(self, topics=()):
+        self.topics = list(topics)
+
+    def get_response_context(self, user_id):
+        return {"topics": self.topics}
+
+
+def conversation(turns: int, words: int = 20) -> list:
+    messages = []
+    for number in range(turns):
+        role = "user" if number % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"turn {number} " + "word " * words})
+    messages.append({"role": "user", "content": "and now?"})
+    return messages
+
+
+def build(builder, messages, user_id=1):
+    return asyncio.run(builder.build(messages, {"user_id": user_id}))
+
+
+def history_tokens(history) -> int:
+    return sum(estimate_tokens(turn["content"]) + MESSAGE_OVERHEAD_TOKENS for turn in history[:-1])
+
+
+def test_history_is_packed_newest_first_within_the_budget():
+    builder = PromptBuilder(settings={"max_prompt_tokens": 300})
+    messages = conversation(40)
+
+    history, prompt = build(builder, messages)
+
+    assert builder.last_prompt_tokens <= 300
+    assert history_tokens(history) + estimate_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS <= 300
+    # The newest turns that fit, in order, opening with a user turn
+    kept = history[:-1]
+    assert kept == messages[-1 - len(kept):-1]
+    assert kept[0]["role"] == "user"
+    assert 0 < len(kept) < 40
+    assert builder.history_dropped == 40 - len(kept)
+    assert history[-1] == {"role": "user", "content": "and now?"}
+    assert prompt.endswith("User message: and now?")
+
+
+def test_short_conversations_are_kept_whole():
+    builder = PromptBuilder(settings={"max_prompt_tokens": 3000})
+    messages = conversation(6)
+
+    history, _ = build(builder, messages)
+
+    assert history == messages
+    assert builder.history_dropped == 0
+
+
+def test_an_oversized_message_is_shortened_to_fit():
+    builder = PromptBuilder(settings={"max_prompt_tokens": 100})
+
+    history, prompt = build(builder, conversation(4)[:-1] + [{"role": "user", "content": "x" * 2000}])
+
+    assert history == [history[-1]]
+    assert 0 < len(history[-1]["content"]) < 2000
+    assert estimate_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS <= 100
+
+
+def test_memories_fill_their_own_budget_and_fall_back_to_important_ones():
+    relevant = ["matched " + "a" * 100, "matched " + "b" * 100, "matched " + "c" * 100]
+    builder = PromptBuilder(FakeMemory(relevant=relevant), settings={"memory_tokens": 50})
+
+    _, prompt = build(builder, conversation(0))
+    assert relevant[0] in prompt and relevant[1] not in prompt
+
+    memory = FakeMemory(important=["likes tea"])
+    builder = PromptBuilder(memory)
+    _, prompt = build(builder, conversation(0))
+    assert "- likes tea\n" in prompt
+
+
+def test_static_parts_are_cached_until_invalidated():
+    memory = FakeMemory(important=["likes tea"])
+    learning = FakeLearning(["tea", "travel"])
+    builder = PromptBuilder(memory, learning_service=learning, settings={"static_ttl": 60})
+
+    _, first = build(builder, conversation(0))
+    learning.topics = ["chess"]
+    _, second = build(builder, conversation(0))
+    builder.invalidate(1)
+    build(builder, conversation(0))
+
+    assert "User's topics of interest: tea, travel" in first
+    # Topics are read every time; only their rendering is cached
+    assert "User's topics of interest: chess" in second
+    assert (memory.loads, builder.static_hits) == (2, 1)
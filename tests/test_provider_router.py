@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from services.provider_router import Provider, ProviderError, ProviderHTTPError, ProviderRouter
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+# Hedge quickly: after 10 ms whenever a provider has no latency samples yet
+FAST_HEDGE = {"hedge": True, "hedge_default_delay": 0.01, "hedge_min_delay": 0.01}
+
+
+class FakeProvider:
+    """Scripted provider that records how each of its calls ended."""
+
+    def __init__(self, name: str, answer: str = "", delay: float = 0.0, error: Exception = None,
+                 first_chunk_delay: float = 0.0, chunks: tuple = ()):
+        self.name = name
+        self.answer = answer
+        self.delay = delay
+        self.error = error
+        self.first_chunk_delay = first_chunk_delay
+        self.chunks = chunks
+        self.calls = 0
+        self.cancelled = 0
+        self.closed = 0
+
+    async def generate(self, messages, prompt):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+    async def stream(self, messages, prompt):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.first_chunk_delay)
+            if self.error is not None:
+                raise self.error
+            for chunk in self.chunks:
+                yield chunk
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.closed += 1
+
+    def provider(self, streaming: bool = False) -> Provider:
+        return Provider(self.name, self.generate, self.stream if streaming else None)
+
+
+async def collect(chunks) -> list:
+    return [chunk async for chunk in chunks]
+
+
+def test_generate_fails_over_to_the_next_provider():
+    primary = FakeProvider("primary", error=ProviderHTTPError("down", 503))
+    backup = FakeProvider("backup", answer="from backup")
+    router = ProviderRouter([primary.provider(), backup.provider()], {"hedge": False})
+
+    assert asyncio.run(router.generate(MESSAGES, "hello")) == "from backup"
+    assert router.failovers == 1
+    assert router.stats["primary"].errors == {"http_503": 1}
+    assert router.stats["backup"].failures == 0
+
+
+def test_generate_raises_once_every_provider_failed():
+    first = FakeProvider("first", error=ProviderError("broken"))
+    second = FakeProvider("second", error=ProviderHTTPError("busy", 429))
+    router = ProviderRouter([first.provider(), second.provider()], {"hedge": False})
+
+    with pytest.raises(ProviderError, match="first: broken; second: busy"):
+        asyncio.run(router.generate(MESSAGES, "hello"))
+
+
+def test_repeated_failures_bench_a_provider_for_the_cooldown():
+    flaky = FakeProvider("flaky", error=ProviderError("broken"))
+    steady = FakeProvider("steady", answer="ok")
+    router = ProviderRouter([flaky.provider(), steady.provider()],
+                            {"hedge": False, "max_consecutive_failures": 2, "cooldown": 60})
+
+    async def scenario():
+        for _ in range(3):
+            await router.generate(MESSAGES, "hello")
+
+    asyncio.run(scenario())
+    # The third request no longer tries the benched provider first
+    assert flaky.calls == 2
+    assert [provider.name for provider in router.ranked()] == ["steady", "flaky"]
+
+
+def test_hedged_generate_takes_the_faster_answer_and_cancels_the_slow_one():
+    slow = FakeProvider("slow", answer="slow", delay=10)
+    fast = FakeProvider("fast", answer="fast")
+    router = ProviderRouter([slow.provider(), fast.provider()], FAST_HEDGE)
+
+    async def scenario():
+        answer = await router.generate(MESSAGES, "hello")
+        # Let the cancellation reach the losing call
+        await asyncio.sleep(0)
+        return answer
+
+    assert asyncio.run(scenario()) == "fast"
+    assert router.hedges == 1
+    assert router.hedge_wins == 1
+    assert slow.cancelled == 1
+    # A cancelled call says nothing about the provider, so it is not recorded
+    assert router.stats["slow"].requests == 0
+    assert router.stats["fast"].requests == 1
+
+
+def test_hedged_stream_races_on_the_first_chunk_and_closes_the_loser():
+    slow = FakeProvider("slow", first_chunk_delay=10, chunks=("never",))
+    fast = FakeProvider("fast", chunks=("hel", "lo"))
+    router = ProviderRouter([slow.provider(streaming=True), fast.provider(streaming=True)], FAST_HEDGE)
+
+    assert asyncio.run(collect(router.stream(MESSAGES, "hello"))) == ["hel", "lo"]
+    assert router.hedges == 1
+    assert router.hedge_wins == 1
+    assert slow.cancelled == 1
+    assert slow.closed == 1
+    assert fast.closed == 1
+    assert router.stats["fast"].requests == 1
+    assert len(router.stats["fast"].first_chunks) == 1
+
+
+def test_stream_fails_over_before_the_first_chunk():
+    broken = FakeProvider("broken", error=ProviderHTTPError("down", 500))
+    backup = FakeProvider("backup", chunks=("ok",))
+    router = ProviderRouter([broken.provider(streaming=True), backup.provider(streaming=True)], {"hedge": False})
+
+    assert asyncio.run(collect(router.stream(MESSAGES, "hello"))) == ["ok"]
+    assert router.failovers == 1
+    assert router.stats["broken"].errors == {"http_500": 1}
+
+
+def test_stream_falls_back_to_generate_for_providers_without_streaming():
+    plain = FakeProvider("plain", answer="whole answer")
+    router = ProviderRouter([plain.provider()], {"hedge": False})
+
+    assert asyncio.run(collect(router.stream(MESSAGES, "hello"))) == ["whole answer"]
+    assert router.stats["plain"].requests == 1
@@ -0,0 +1,130 @@
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from services.provider_router import DeadlineExceeded, ProviderHTTPError
+from services.rate_limiter import RateLimiter, parse_retry_after
+
+
+class Sleeps(list):
+    """Sleep function recording each delay instead of waiting it out."""
+
+    async def __call__(self, delay: float):
+        self.append(delay)
+
+
+@pytest.fixture
+def sleeps():
+    return Sleeps()
+
+
+def failing(*errors, answer: str = "ok"):
+    """A generate function raising each error in turn, then answering."""
+    remaining = list(errors)
+    calls = []
+
+    async def generate(*args):
+        calls.append(args)
+        if remaining:
+            raise remaining.pop(0)
+        return answer
+
+    return generate, calls
+
+
+def test_parse_retry_after_accepts_seconds_and_http_dates():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=120), usegmt=True)
+    assert 110 < parse_retry_after(later) <= 120
+
+
+def test_retries_wait_at_least_as_long_as_retry_after(sleeps):
+    limiter = RateLimiter({"base_delay": 0.01, "max_retries": 3}, sleeps)
+    generate, calls = failing(ProviderHTTPError("slow down", 429, retry_after=2.5))
+
+    assert asyncio.run(limiter.limit("google", generate)("prompt")) == "ok"
+    assert len(calls) == 2
+    assert sleeps == [2.5]
+    assert limiter.metrics()["google"] == {"throttled": 1, "retries": 1}
+
+
+def test_server_errors_back_off_exponentially_up_to_max_retries(sleeps):
+    limiter = RateLimiter({"base_delay": 0.5, "max_delay": 1.5, "max_retries": 3}, sleeps)
+    generate, calls = failing(*(ProviderHTTPError("down", 503) for _ in range(4)))
+
+    with pytest.raises(ProviderHTTPError):
+        asyncio.run(limiter.limit("google", generate)("prompt"))
+    assert len(calls) == 4
+    # Full jitter: each wait is up to its doubled delay, capped at max_delay
+    assert len(sleeps) == 3
+    assert all(0 <= delay <= limit for delay, limit in zip(sleeps, [0.5, 1.0, 1.5]))
+    assert limiter.metrics()["google"]["server_errors"] == 4
+
+
+def test_client_errors_are_not_retried(sleeps):
+    limiter = RateLimiter(sleep=sleeps)
+    generate, calls = failing(ProviderHTTPError("bad request", 400))
+
+    with pytest.raises(ProviderHTTPError):
+        asyncio.run(limiter.limit("google", generate)("prompt"))
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_a_retry_after_past_the_deadline_fails_straight_away(sleeps):
+    limiter = RateLimiter({"request_deadline": 5.0}, sleeps)
+    generate, calls = failing(ProviderHTTPError("slow down", 429, retry_after=30))
+
+    async def scenario():
+        with limiter.request():
+            return await limiter.limit("google", generate)("prompt")
+
+    with pytest.raises(ProviderHTTPError):
+        asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sleeps == []
+    assert limiter.metrics()["google"]["deadline_exceeded"] == 1
+
+
+def test_a_rate_limit_wait_past_the_deadline_raises_deadline_exceeded(sleeps):
+    limiter = RateLimiter({"request_deadline": 0.5, "providers": {"google": {"rate": 1.0, "burst": 1}}}, sleeps)
+    generate, calls = failing()
+    limited = limiter.limit("google", generate)
+
+    async def scenario():
+        with limiter.request():
+            await limited("first")
+            await limited("second")
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(scenario())
+    assert len(calls) == 1
+    assert limiter.metrics()["google"] == {"deadline_exceeded": 1}
+
+
+def test_streams_are_only_retried_before_the_first_chunk(sleeps):
+    limiter = RateLimiter({"base_delay": 0.01}, sleeps)
+    attempts = []
+
+    async def stream(*args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise ProviderHTTPError("slow down", 429, retry_after=1.0)
+        yield "partial"
+        raise ProviderHTTPError("down", 503)
+
+    async def scenario():
+        chunks = []
+        with pytest.raises(ProviderHTTPError):
+            async for chunk in limiter.limit_stream("google", stream)("prompt"):
+                chunks.append(chunk)
+        return chunks
+
+    assert asyncio.run(scenario()) == ["partial"]
+    assert len(attempts) == 2
+    assert sleeps == [1.0]
@@ -0,0 +1,207 @@
+import asyncio
+import types
+
+import pytest
+
+import services.response_cache
+from services import google_ai_service
+from services.response_cache import ResponseCache
+
+
+def make_cache(**settings) -> ResponseCache:
+    return ResponseCache({"use_store": False, **settings})
+
+
+def test_concurrent_identical_requests_share_one_computation():
+    async def scenario():
+        cache = make_cache()
+        release = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "answer"
+
+        waiters = [asyncio.create_task(cache.get_or_compute("key", compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return cache, calls, results
+
+    cache, calls, results = asyncio.run(scenario())
+
+    assert calls == [1]
+    assert results == ["answer"] * 5
+    assert cache.coalesced == 4
+    assert cache.metrics()["inflight"] == 0
+
+
+def test_a_cancelled_waiter_does_not_cancel_the_shared_computation():
+    async def scenario():
+        cache = make_cache()
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return "answer"
+
+        first = asyncio.create_task(cache.get_or_compute("key", compute))
+        second = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return await second, first.cancelled(), await cache.get("key")
+
+    assert asyncio.run(scenario()) == ("answer", True, "answer")
+
+
+def test_failures_are_not_cached():
+    async def scenario():
+        cache = make_cache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return None
+
+        await cache.get_or_compute("key", compute)
+        await cache.get_or_compute("key", compute)
+        return calls
+
+    assert asyncio.run(scenario()) == [1, 1]
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(services.response_cache, "time", types.SimpleNamespace(time=lambda: clock.now))
+
+    async def scenario():
+        cache = make_cache(ttl=10)
+        calls = []
+
+        async def compute():
+            calls.append(clock.now)
+            return f"answer at {clock.now}"
+
+        first = await cache.get_or_compute("key", compute)
+        clock.now += 9
+        cached = await cache.get_or_compute("key", compute)
+        clock.now += 2
+        expired = await cache.get_or_compute("key", compute)
+        return cache, calls, (first, cached, expired)
+
+    cache, calls, results = asyncio.run(scenario())
+
+    assert calls == [1000.0, 1011.0]
+    assert results == ("answer at 1000.0", "answer at 1000.0", "answer at 1011.0")
+    assert cache.memory_hits == 1
+    assert cache.misses == 2
+
+
+class FakeBuilder:
+    async def build(self, messages, user_context=None):
+        return messages, messages[-1]["content"]
+
+
+class FakeRouter:
+    """Provider router whose stream sends its chunks once released."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    async def stream(self, messages, prompt):
+        self.calls += 1
+        await self.release.wait()
+        for chunk in self.chunks:
+            yield chunk
+            await asyncio.sleep(0)
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    """google_ai_service wired to a fake router, a prompt builder and a cache."""
+    router = FakeRouter(["Hel", "lo ", "there"])
+    cache = make_cache()
+    monkeypatch.setattr(google_ai_service, "prompt_builder", FakeBuilder())
+    monkeypatch.setattr(google_ai_service, "provider_router", router)
+    monkeypatch.setattr(google_ai_service, "response_cache", cache)
+    monkeypatch.setattr(google_ai_service, "rate_limiter", None)
+    return router, cache
+
+
+async def collect(chunks) -> list:
+    return [chunk async for chunk in chunks]
+
+
+def test_concurrent_identical_streams_share_one_provider_stream(streaming):
+    router, cache = streaming
+    messages = [{"role": "user", "content": "hi"}]
+
+    async def scenario():
+        first = asyncio.create_task(collect(google_ai_service.stream_response(messages)))
+        second = asyncio.create_task(collect(google_ai_service.stream_response(messages)))
+        await asyncio.sleep(0.01)
+        router.release.set()
+        return await asyncio.gather(first, second)
+
+    first, second = asyncio.run(scenario())
+
+    assert router.calls == 1
+    assert first == second == ["Hel", "lo ", "there"]
+    assert cache.coalesced == 1
+    assert cache.metrics()["inflight"] == 0
+
+
+def test_a_late_follower_replays_the_chunks_already_streamed(streaming):
+    router, cache = streaming
+    messages = [{"role": "user", "content": "hi"}]
+
+    async def scenario():
+        first = google_ai_service.stream_response(messages)
+        router.release.set()
+        head = await first.__anext__()
+        # Joins after the first chunk went out
+        second = await collect(google_ai_service.stream_response(messages))
+        rest = await collect(first)
+        cached = await collect(google_ai_service.stream_response(messages))
+        return [head] + rest, second, cached
+
+    first, second, cached = asyncio.run(scenario())
+
+    assert first == second == ["Hel", "lo ", "there"]
+    assert cached == ["Hello there"]
+    assert router.calls == 1
+
+
+def test_a_failed_shared_stream_fails_every_follower_and_is_not_cached():
+    async def scenario():
+        cache = make_cache()
+        release = asyncio.Event()
+        calls = []
+
+        async def stream():
+            calls.append(1)
+            await release.wait()
+            yield "partial"
+            raise ValueError("provider went away")
+
+        async def follow():
+            chunks = []
+            with pytest.raises(ValueError):
+                async for chunk in cache.stream_or_compute("key", stream):
+                    chunks.append(chunk)
+            return chunks
+
+        followers = [asyncio.create_task(follow()) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        return calls, await asyncio.gather(*followers), await cache.get("key")
+
+    calls, results, cached = asyncio.run(scenario())
+
+    assert calls == [1]
+    assert results == [["partial"], ["partial"]]
+    assert cached is None
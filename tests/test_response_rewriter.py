@@ -0,0 +1,52 @@
+import pytest
+
+from services.response_rewriter import ResponseRewriter
+
+
+@pytest.fixture
+def rewriter():
+    return ResponseRewriter()
+
+
+@pytest.mark.parametrize("text", [
+    "It broke because of the cache.",
+    "We reuse the buffer.",
+    "See the use_case field.",
+    "Users, misuse, useful, fuse",
+    "The makers fixed it.",
+])
+def test_words_containing_a_rule_are_left_alone(rewriter, text):
+    assert rewriter.rewrite(text, ("technical",)) == text
+
+
+def test_whole_words_are_rewritten_next_to_punctuation(rewriter):
+    assert rewriter.rewrite("use, make. (fix) use-it", ("technical",)) == (
+        "utilize, implement. (resolve) utilize-it"
+    )
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("use it", "utilize it"),
+    ("Use it", "Utilize it"),
+    ("USE IT", "UTILIZE IT"),
+])
+def test_the_case_of_the_replaced_word_is_kept(rewriter, text, expected):
+    assert rewriter.rewrite(text, ("technical",)) == expected
+
+
+def test_formal_and_technical_rules_apply_in_one_pass(rewriter):
+    text = "Yeah, we're gonna use it to fix the bug. Nope, not because of reuse."
+
+    assert rewriter.rewrite(text, ("formal", "technical")) == (
+        "Yes, we're going to utilize it to resolve the bug. No, not because of reuse."
+    )
+
+
+def test_a_replacement_is_never_rewritten_again(rewriter):
+    # "use" becomes "utilize", and "utilize" becomes "use", each exactly once
+    assert rewriter.rewrite("use utilize", ("technical", "simple")) == "utilize use"
+
+
+def test_buckets_without_rules_leave_the_text_unchanged(rewriter):
+    assert rewriter.rewrite("use it", ()) == "use it"
+    assert rewriter.rewrite("use it", ("unknown",)) == "use it"
@@ -0,0 +1,38 @@
+import asyncio
+
+import services.memory_service
+from services.memory_service import MemoryService
+from services.retention_service import RetentionService
+
+SETTINGS = {
+    "max_memories": 100,
+    "max_recent_interactions": 2,
+    "importance_threshold": 0.5,
+    "retention_days": 30,
+}
+
+
+def test_pruning_keeps_the_interactions_recent_reads_return(tmp_path, monkeypatch):
+    # Interactions written within the same second share a created_at
+    now = services.memory_service._timestamp()
+    monkeypatch.setattr(services.memory_service, "_timestamp", lambda: now)
+
+    async def scenario():
+        memory = MemoryService(str(tmp_path / "memory.db"))
+        await memory.initialize()
+        try:
+            for n in range(5):
+                await memory.store_interaction(1, f"message {n}", f"response {n}")
+            expected = await memory.get_recent_interactions(1, SETTINGS["max_recent_interactions"])
+
+            retention = RetentionService(memory, SETTINGS)
+            deleted = await retention._prune_interactions()
+            return deleted, expected, await memory.get_recent_interactions(1, 10)
+        finally:
+            await memory.close()
+
+    deleted, expected, kept = asyncio.run(scenario())
+    assert deleted == 3
+    assert [row["message"] for row in kept] == [row["message"] for row in expected] == [
+        "message 4", "message 3"
+    ]
@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import services.streaming_reply
+from services.streaming_reply import StreamingReply
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+        self.edits = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+        return SentMessage(self)
+
+
+class SentMessage:
+    def __init__(self, chat: FakeMessage):
+        self.chat = chat
+
+    async def edit_text(self, text):
+        self.chat.edits.append(text)
+
+    async def delete(self):
+        pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(services.streaming_reply, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+class CountingRender:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text, final):
+        self.calls += 1
+        return text.upper()
+
+
+def test_text_is_only_rendered_when_an_edit_is_due(clock):
+    message, render = FakeMessage(), CountingRender()
+    reply = StreamingReply(message, {"edit_interval": 1.0, "min_edit_chars": 5}, render)
+
+    async def scenario():
+        await reply.update("hello")
+        # Inside the edit interval: neither rendered nor shown
+        for length in range(6, 30):
+            await reply.update("x" * length)
+        assert render.calls == 1
+        clock.now += 2
+        await reply.update("hello world")
+
+    asyncio.run(scenario())
+    assert render.calls == 2
+    assert message.replies == ["HELLO"]
+    assert message.edits == ["HELLO WORLD"]
+
+
+def test_edits_are_due_on_new_raw_text_even_if_rendering_hides_it(clock):
+    message = FakeMessage()
+    reply = StreamingReply(message, {"edit_interval": 1.0, "min_edit_chars": 5},
+                           lambda text, final: text.replace("*", ""))
+
+    async def scenario():
+        await reply.update("hello")
+        clock.now += 2
+        await reply.update("hell")
+        await reply.update("hello wo")
+        assert message.edits == []
+        await reply.update("hello ****wo")
+
+    asyncio.run(scenario())
+    assert message.replies == ["hello"]
+    assert message.edits == ["hello wo"]